@@ -0,0 +1,106 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+#######
+# note.com のAPIの代わりにローカルで応答するサーバー
+#######
+# /api/v3/searches，/api/v3/notes/{key}，/api/v2/creators/{username}/contents に
+# SyntheticCorpus の記事を返す．latency 秒の遅延を入れて通信の待ち時間を再現できる．
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # ヘッダーと本文を別々に送るので，Nagleアルゴリズムで応答が遅れないようにする
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, payload=None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8') if payload is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        server.count_request()
+        if server.latency:
+            time.sleep(server.latency)
+        corpus = server.corpus
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+
+        if parts[:3] == ['api', 'v3', 'searches']:
+            start = int(params.get('start', ['0'])[0])
+            size = int(params.get('size', ['10'])[0])
+            return self._send(200, {'data': {'notes': {'contents': corpus.search(start, size)}}})
+        if parts[:3] == ['api', 'v3', 'notes'] and len(parts) == 4:
+            return self._send(200, {'data': corpus.note(parts[3])})
+        if parts[:3] == ['api', 'v2', 'creators'] and len(parts) == 5 and parts[4] == 'contents':
+            page = int(params.get('page', ['1'])[0])
+            keys = corpus.page(parts[3], page)
+            if server.full_listing:
+                contents = [corpus.note(key) for key in keys]
+            else:
+                contents = [corpus.listing_item(key) for key in keys]
+            return self._send(200, {'data': {'contents': contents, 'isLastPage': not corpus.page(parts[3], page + 1)}})
+        return self._send(404, {'error': 'not found'})
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, corpus, latency, full_listing):
+        super().__init__(address, _Handler)
+        self.corpus = corpus
+        self.latency = latency
+        self.full_listing = full_listing
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+
+class MockNoteAPI:
+    '''
+    別スレッドで動くモックサーバー．with文で起動・停止し，base_url を fetch_engine.set_base_url に渡して使う．
+    full_listing=Trueなら記事一覧に記事本文と同じ列を入れる（記事本文の取得を省ける場合の計測用）．
+    '''
+
+    def __init__(self, corpus, latency=0.0, full_listing=False, host='127.0.0.1', port=0):
+        self._server = _Server((host, port), corpus, latency, full_listing)
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def requests(self):
+        '''これまでに受けたリクエスト数'''
+        return self._server.requests
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,298 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+from sklearn.decomposition import LatentDirichletAllocation
+from sqlalchemy import create_engine
+
+from my_codes import database_operation
+from my_codes import document_term_matrix
+from my_codes import fetch_articles
+from my_codes import fetch_engine
+from my_codes import http_session
+from my_codes import jmfd_calculation
+from my_codes import preprocessing
+from my_codes.notes_database import Notes
+
+from benchmarks.mock_server import MockNoteAPI
+from benchmarks.synthetic import SyntheticCorpus, synthetic_dictionary
+
+#######
+# 合成コーパスとモックサーバーを使ったベンチマーク
+#######
+# 取得（同期・並行），clean_text，tokenize，DBへの一括upsert，LDAの学習，JMFDスコアの処理速度とメモリを計り，
+# 結果をJSONに保存する．バージョン間の比較は compare で行う．
+#   python -m benchmarks.run --users 20 --notes-per-user 50 --body-chars 2000
+#   python -m benchmarks.run --compare data/benchmarks/old.json data/benchmarks/new.json
+
+DEFAULT_OUTPUT_DIR = 'data/benchmarks'
+
+
+class BenchmarkContext:
+    '''ベンチマークの間で共有する合成データ．計測の前に setup で必要なものだけを作る'''
+
+    def __init__(self, corpus, workdir, n_workers=None, latency=0.0):
+        self.corpus = corpus
+        self.workdir = workdir
+        self.n_workers = n_workers
+        self.latency = latency
+        self._bodies = None
+        self._cleaned = None
+        self._tokens = None
+
+    @property
+    def bodies(self):
+        if self._bodies is None:
+            self._bodies = [self.corpus.note(key)['body'] for key in self.corpus.all_keys()]
+        return self._bodies
+
+    @property
+    def cleaned(self):
+        if self._cleaned is None:
+            self._cleaned = [preprocessing.clean_text(body) for body in self.bodies]
+        return self._cleaned
+
+    @property
+    def tokens(self):
+        if self._tokens is None:
+            self._tokens = preprocessing.tokenize_parallel(self.cleaned, n_workers=self.n_workers)
+        return self._tokens
+
+
+class Benchmark:
+    '''setup(ctx) で計測に使う引数を用意し，run(*引数) が処理した件数を返す'''
+
+    def __init__(self, name, run, setup=None, unit='notes'):
+        self.name = name
+        self.run = run
+        self.setup = setup or (lambda ctx: (ctx,))
+        self.unit = unit
+
+
+#######
+# 各ベンチマーク
+#######
+# 取得のベンチマークはディスクキャッシュを使わず，毎回モックサーバーから取得する（終わったら前の設定に戻す）．
+# 条件付きリクエストの検証子も作業用の一時ディレクトリに保存し，呼び出し元のdata/には何も書かない
+def _isolated_http(ctx):
+    return http_session.use_validators(http_session.ValidatorStore(os.path.join(ctx.workdir, 'validators.db')))
+
+def _crawl_sync(ctx):
+    with http_session.use_cache(False), _isolated_http(ctx), MockNoteAPI(ctx.corpus, latency=ctx.latency) as api:
+        fetch_engine.set_base_url(api.base_url)
+        try:
+            n_notes = 0
+            for username in ctx.corpus.usernames():
+                n_notes += len(fetch_articles.get_user_all_notes(username, interval=0, as_frame=False, rate=1000.0))
+        finally:
+            fetch_engine.set_base_url(None)
+    return n_notes, {'requests': api.requests}
+
+def _crawl_async(ctx):
+    n_notes = 0
+
+    def on_user_done(index, username, contents, error):
+        nonlocal n_notes
+        if error is not None:
+            raise error
+        n_notes += len(contents)
+
+    with http_session.use_cache(False), _isolated_http(ctx), MockNoteAPI(ctx.corpus, latency=ctx.latency) as api:
+        fetch_engine.set_base_url(api.base_url)
+        try:
+            fetch_engine.fetch_users_notes(ctx.corpus.usernames(), on_user_done, rate=1000.0, concurrency=16)
+        finally:
+            fetch_engine.set_base_url(None)
+    return n_notes, {'requests': api.requests}
+
+def _clean_text(bodies):
+    for body in bodies:
+        preprocessing.clean_text(body)
+    return len(bodies)
+
+def _tokenize(texts, n_workers):
+    return len(preprocessing.tokenize_parallel(texts, n_workers=n_workers))
+
+def _db_ingest_setup(ctx):
+    path = os.path.join(ctx.workdir, 'notes.db')
+    if os.path.exists(path):
+        os.remove(path)
+    engine = create_engine(f'sqlite:///{path}')
+    Notes.__table__.create(engine)
+    df = pd.DataFrame([fetch_articles.flatten_note(ctx.corpus.note(key)) for key in ctx.corpus.all_keys()])
+    df['body'] = ctx.cleaned
+    df['tokenized_body'] = [body.split() for body in ctx.cleaned]
+    return df, engine
+
+def _db_ingest(df, engine):
+    report = database_operation.bulk_upsert_notes(df, engine)
+    return report['rows']
+
+def _lda_setup(ctx):
+    X, _ = document_term_matrix.build_document_term_matrix(ctx.tokens, lowercase=True, sort_vocabulary=True)
+    return (X,)
+
+def _lda_fit(X):
+    LatentDirichletAllocation(n_components=10, max_iter=10, random_state=0).fit(X)
+    return X.shape[0]
+
+def _jmfd_setup(ctx):
+    matcher = jmfd_calculation.JMFDMatcher.from_file(synthetic_dictionary(os.path.join(ctx.workdir, 'dictionary.txt')))
+    return ctx.tokens, matcher
+
+def _jmfd_score(tokens, matcher):
+    return len(jmfd_calculation.score_corpus(tokens, matcher))
+
+
+BENCHMARKS = {
+    benchmark.name: benchmark for benchmark in [
+        Benchmark('crawl_sync', _crawl_sync),
+        Benchmark('crawl_async', _crawl_async),
+        Benchmark('clean_text', _clean_text, setup=lambda ctx: (ctx.bodies,)),
+        Benchmark('tokenize', _tokenize, setup=lambda ctx: (ctx.cleaned, ctx.n_workers)),
+        Benchmark('db_ingest', _db_ingest, setup=_db_ingest_setup),
+        Benchmark('lda_fit', _lda_fit, setup=_lda_setup),
+        Benchmark('jmfd_score', _jmfd_score, setup=_jmfd_setup),
+    ]
+}
+
+
+#######
+# 計測と保存
+#######
+def measure(benchmark, ctx, memory=True):
+    '''
+    処理時間を計り，memory=Trueならtracemallocでもう一度実行してメモリのピークを計る
+    （tracemallocは処理を遅くするので，時間の計測とは別に実行する．子プロセスのメモリは含まない）．
+    '''
+    args = benchmark.setup(ctx)
+    start = time.perf_counter()
+    result = benchmark.run(*args)
+    seconds = time.perf_counter() - start
+    items, extra = result if isinstance(result, tuple) else (result, {})
+
+    record = {
+        'items': items,
+        'unit': benchmark.unit,
+        'seconds': seconds,
+        'items_per_sec': items / seconds if seconds else None,
+    }
+    if memory:
+        args = benchmark.setup(ctx)
+        tracemalloc.start()
+        try:
+            benchmark.run(*args)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        record['peak_mb'] = peak / 1024 ** 2
+    record.update(extra)
+    return record
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(names=None, n_users=20, notes_per_user=50, body_chars=2000, seed=0, n_workers=None,
+                   latency=0.0, memory=True, workdir=None):
+    '''ベンチマークを実行し，メタ情報と結果の辞書を返す'''
+    names = list(names or BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        raise ValueError(f'unknown benchmarks {unknown}, expected some of {list(BENCHMARKS)}')
+    corpus = SyntheticCorpus(n_users=n_users, notes_per_user=notes_per_user, body_chars=body_chars, seed=seed)
+
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        ctx = BenchmarkContext(corpus, tmp, n_workers=n_workers, latency=latency)
+        results = {}
+        for name in names:
+            results[name] = measure(BENCHMARKS[name], ctx, memory=memory)
+            print(f"{name}: {results[name]['items']} {results[name]['unit']} in {results[name]['seconds']:.2f}s "
+                  f"({results[name]['items_per_sec']:.1f}/s)"
+                  + (f", peak {results[name]['peak_mb']:.1f} MB" if 'peak_mb' in results[name] else ''))
+
+    return {
+        'meta': {
+            'commit': _git_commit(),
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'corpus': {'n_users': n_users, 'notes_per_user': notes_per_user, 'body_chars': body_chars, 'seed': seed},
+            'n_workers': n_workers,
+            'latency': latency,
+        },
+        'results': results,
+    }
+
+def save_results(report, output=None):
+    '''結果をJSONに保存し，パスを返す．outputを省略すると data/benchmarks/{日時}_{コミット}.json'''
+    if output is None:
+        stamp = report['meta']['timestamp'].replace(':', '').replace('-', '')
+        output = os.path.join(DEFAULT_OUTPUT_DIR, f"{stamp}_{report['meta']['commit'] or 'unknown'}.json")
+    directory = os.path.dirname(output)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return output
+
+def compare(baseline_path, current_path):
+    '''2つの結果のJSONを比べ，ベンチマークごとの処理速度とメモリの比（current / baseline）のDataFrameを返す'''
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+    with open(current_path, encoding='utf-8') as f:
+        current = json.load(f)['results']
+    rows = []
+    for name in baseline:
+        if name not in current:
+            continue
+        old, new = baseline[name], current[name]
+        rows.append({
+            'benchmark': name,
+            'baseline_per_sec': old['items_per_sec'],
+            'current_per_sec': new['items_per_sec'],
+            'speedup': new['items_per_sec'] / old['items_per_sec'] if old['items_per_sec'] else None,
+            'baseline_peak_mb': old.get('peak_mb'),
+            'current_peak_mb': new.get('peak_mb'),
+            'memory_ratio': new['peak_mb'] / old['peak_mb'] if old.get('peak_mb') and 'peak_mb' in new else None,
+        })
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='合成コーパスとモックサーバーでベンチマークを実行する')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='実行するベンチマーク')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--notes-per-user', type=int, default=50)
+    parser.add_argument('--body-chars', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--n-workers', type=int, default=None, help='トークン化のプロセス数（省略するとコア数）')
+    parser.add_argument('--latency', type=float, default=0.0, help='モックサーバーの応答の遅延（秒）')
+    parser.add_argument('--no-memory', action='store_true', help='メモリのピークを計らない')
+    parser.add_argument('--output', help='結果のJSONの保存先')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'), help='2つの結果のJSONを比べる')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        print(compare(*args.compare).to_string(index=False))
+        return
+    report = run_benchmarks(
+        args.only, n_users=args.users, notes_per_user=args.notes_per_user, body_chars=args.body_chars,
+        seed=args.seed, n_workers=args.n_workers, latency=args.latency, memory=not args.no_memory,
+    )
+    print(f'saved to {save_results(report, args.output)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import random
+
+#######
+# ベンチマーク用の合成データ
+#######
+# note.com のAPIと同じ形の記事を，記事数・本文の長さを指定して決定的に作る．
+# 同じ seed なら同じkeyの記事は常に同じ内容になるので，サーバー側で記事を保存しておく必要はない．
+
+# 本文に使う語．JMFD風の語（synthetic_dictionary でスコアが付く）と一般的な語を混ぜる
+MORAL_WORDS = {
+    '思いやり': 1, '優しさ': 1, '傷つける': 2, '暴力': 2, '公平': 3, '平等': 3, '不正': 4, '差別': 4,
+    '仲間': 5, '忠誠': 5, '裏切り': 6, '敬意': 7, '伝統': 7, '反抗': 8, '純粋': 9, '清潔': 9, '汚染': 10,
+}
+COMMON_WORDS = [
+    '今日', '仕事', '時間', '自分', '友達', '家族', '会社', '季節', '料理', '散歩', '旅行', '音楽', '映画',
+    '読書', '天気', '気持ち', '社会', '問題', '考える', '感じる', '楽しい', '難しい', '新しい', '大切',
+    '本当に', 'とても', '少し', '最近', '毎日', '学校', '先生', '子ども', '地域', '農業', '野菜', '有機',
+]
+PARTICLES = ['は', 'が', 'を', 'に', 'で', 'と', 'の', 'も']
+
+
+def make_body(rng, n_chars):
+    '''HTMLの段落・リンク・文字参照を含む，およそ n_chars 文字の本文を作る'''
+    paragraphs = []
+    length = 0
+    while length < n_chars:
+        words = []
+        for _ in range(rng.randint(8, 20)):
+            word = rng.choice(list(MORAL_WORDS)) if rng.random() < 0.1 else rng.choice(COMMON_WORDS)
+            words.append(word + rng.choice(PARTICLES))
+        sentence = ''.join(words) + '。'
+        if rng.random() < 0.1:
+            sentence += ' https://example.com/' + str(rng.randint(0, 10 ** 6))
+        if rng.random() < 0.1:
+            sentence = f'<b>{sentence}</b>&nbsp;'
+        paragraphs.append(f'<p>{sentence}</p>')
+        length += len(sentence)
+    return ''.join(paragraphs)
+
+
+class SyntheticCorpus:
+    '''
+    n_users 人のユーザーがそれぞれ notes_per_user 件の記事を持つ合成コーパス．
+    記事の本文は body_chars 文字程度で，keyとseedから決まる．
+    '''
+
+    def __init__(self, n_users=20, notes_per_user=50, body_chars=2000, page_size=6, seed=0):
+        self.n_users = n_users
+        self.notes_per_user = notes_per_user
+        self.body_chars = body_chars
+        self.page_size = page_size
+        self.seed = seed
+
+    @property
+    def n_notes(self):
+        return self.n_users * self.notes_per_user
+
+    def usernames(self):
+        return [f'user{i:06d}' for i in range(self.n_users)]
+
+    def keys(self, username):
+        return [f'n{username[4:]}{j:06d}' for j in range(self.notes_per_user)]
+
+    def all_keys(self):
+        return [key for username in self.usernames() for key in self.keys(username)]
+
+    def _user(self, username):
+        return {
+            'id': int(username[4:]), 'key': f'u{username[4:]}', 'urlname': username, 'name': username,
+            'nickname': f'nick {username}', 'note_count': self.notes_per_user, 'created_at': '2020-01-01T00:00:00+09:00',
+        }
+
+    def note(self, key):
+        '''/api/v3/notes/{key} の data と同じ形の記事'''
+        username = f'user{key[1:7]}'
+        index = int(key[7:])
+        rng = random.Random(f'{self.seed}:{key}')
+        body = make_body(rng, self.body_chars)
+        return {
+            'id': int(key[1:]), 'user_id': int(username[4:]), 'status': 'published', 'type': 'TextNote',
+            'key': key, 'slug': f'slug-{key}', 'name': f'記事 {key}', 'body': body, 'body_length': len(body),
+            'created_at': f'2024-01-{index % 28 + 1:02d}T12:00:00+09:00', 'can_read': rng.random() > 0.05,
+            'publish_at': f'2024-01-{index % 28 + 1:02d}T12:00:00+09:00', 'user': self._user(username),
+        }
+
+    def listing_item(self, key):
+        '''/api/v2/creators/{username}/contents の1件．本文などは含まないので，記事本文の取得が必要になる'''
+        username = f'user{key[1:7]}'
+        index = int(key[7:])
+        return {
+            'key': key, 'name': f'記事 {key}', 'type': 'TextNote',
+            'publishAt': f'2024-01-{index % 28 + 1:02d}T12:00:00+09:00', 'user': {'urlname': username},
+        }
+
+    def page(self, username, page):
+        '''ユーザーの記事一覧の page ページ目（1から）のkey'''
+        keys = self.keys(username)
+        start = (page - 1) * self.page_size
+        return keys[start:start + self.page_size] if page >= 1 else []
+
+    def search(self, start, size):
+        '''/api/v3/searches の結果として返す記事（全ユーザーの記事を順に並べたもの）'''
+        keys = self.all_keys()[start:start + size]
+        return [self.note(key) for key in keys]
+
+
+def synthetic_dictionary(path):
+    '''MORAL_WORDS からJMFD辞書と同じ形式のファイルを作り，パスを返す'''
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('%\n')
+        for i in range(1, 12):
+            f.write(f'{i}\tFoundation{i}\n')
+        f.write('%\n')
+        for word, foundation in MORAL_WORDS.items():
+            f.write(f'{word}\t{foundation}\t\n')
+    return path
@@ -0,0 +1,310 @@
+import glob
+import json
+import operator
+import os
+
+import pandas as pd
+
+from my_codes.document_term_matrix import parse_tokenized_body
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrowがなければCSVで保存する
+    pa = None
+
+########
+# 各段階のデータの保存・読み込み
+########
+# Parquet（列指向）で保存し，必要な列と行だけを読み込めるようにする．
+# 文字列の列は辞書エンコード，tokenized_body はトークンのリスト型で保存するので，文字列化と literal_eval は不要になる．
+# pyarrowが入っていない環境や，以前に保存したCSVしかない場合はCSVを読み書きする．
+# TableWriter で書き足す途中で列が増えたり型が決まったりしたときは，続きを {名前}.part-0001.parquet などの
+# 別のファイルに書き，読み込むときに全ファイルの列と型をまとめる．
+
+# 段階の名前 -> data/{query}/ の下のファイル名（拡張子なし）
+STAGES = {
+    'search_results': '{query}_fetchtd_df',
+    'query_keys_raw': '{query}_fetched_query_keys_all_raw',
+    'raw_user_posts': '{query}_fetched_user_all_post_raw',
+    'user_posts': '{query}_user_all_post_df',
+    'query_notes': '{query}_fetched_query_keys_all_df',
+    'preprocessed': '{query}_data_preprocessed',
+    'jmfd_scores': '{query}_jmfd_scores',
+}
+
+# トークンのリストを持つ列
+TOKEN_COLUMNS = ('tokenized_body',)
+
+# 1つの行グループの行数．行グループごとの最小値・最大値で，filtersに合わない行グループは読み飛ばされる
+ROW_GROUP_SIZE = 50000
+
+_FILTER_OPERATORS = {
+    '==': operator.eq, '=': operator.eq, '!=': operator.ne,
+    '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+}
+
+
+def has_parquet():
+    return pa is not None
+
+def stage_path(query, stage, data_dict_path='data', fmt=None):
+    '''段階のファイルのパスを返す．fmtは 'parquet' か 'csv'（Noneなら使える方）'''
+    if stage not in STAGES:
+        raise ValueError(f'unknown stage {stage!r}, expected one of {list(STAGES)}')
+    if fmt is None:
+        fmt = 'parquet' if has_parquet() else 'csv'
+    return f"{data_dict_path}/{query}/{STAGES[stage].format(query=query)}.{fmt}"
+
+def part_paths(path):
+    '''段階のファイルと，TableWriter が続きを書いたファイル（{名前}.part-0001.parquet など）のパスのリスト'''
+    stem, ext = os.path.splitext(path)
+    return [path] + sorted(glob.glob(f'{glob.escape(stem)}.part-*{ext}'))
+
+def _part_path(path, part):
+    stem, ext = os.path.splitext(path)
+    return path if part == 0 else f'{stem}.part-{part:04d}{ext}'
+
+def _remove_parts(path):
+    '''前に書いた続きのファイルを消す（段階のファイルは上書きするので残す）'''
+    for part in part_paths(path)[1:]:
+        os.remove(part)
+
+def existing_stage_path(query, stage, data_dict_path='data'):
+    '''保存されている段階のファイルのパスを返す．ParquetとCSVの両方があればParquetを使う'''
+    for fmt in ('parquet', 'csv'):
+        if fmt == 'parquet' and not has_parquet():
+            continue
+        path = stage_path(query, stage, data_dict_path, fmt=fmt)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(stage_path(query, stage, data_dict_path))
+
+
+########
+# DataFrame <-> Arrow
+########
+def _json_default(value):
+    return str(value)
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and pd.isna(value))
+
+def _to_text(value):
+    if _is_missing(value):
+        return None
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False, default=_json_default)
+    return str(value)
+
+def _normalize_object_column(series):
+    '''型が混ざったobject列を文字列にする（辞書・リストはJSON）．Noneはそのまま残す'''
+    kind = pd.api.types.infer_dtype(series, skipna=True)
+    if kind in ('string', 'empty', 'boolean', 'bytes', 'datetime', 'date', 'integer', 'floating'):
+        return series
+    return series.map(_to_text)
+
+def _to_arrow(df, as_text=False):
+    df = df.reset_index(drop=True)
+    columns = {}
+    for column in df.columns:
+        series = df[column]
+        if column in TOKEN_COLUMNS:
+            columns[column] = series.map(lambda v: None if _is_missing(v) else parse_tokenized_body(v))
+        elif as_text:
+            columns[column] = series.astype(object).map(_to_text)
+        elif series.dtype == object:
+            columns[column] = _normalize_object_column(series)
+        else:
+            columns[column] = series
+    df = pd.DataFrame(columns)
+    if as_text:
+        fields = [pa.field(c, pa.list_(pa.string()) if c in TOKEN_COLUMNS else pa.string()) for c in df.columns]
+        return pa.Table.from_pandas(df, schema=pa.schema(fields), preserve_index=False)
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+def _fits(schema, other):
+    '''otherの表を schema に合わせて書けるか（新しい列がなく，schemaで型の決まっていない列に値がない）'''
+    for field in other:
+        index = schema.get_field_index(field.name)
+        if index < 0 or (pa.types.is_null(schema.field(index).type) and not pa.types.is_null(field.type)):
+            return False
+    return True
+
+def _conform(table, schema):
+    '''表の列を schema の順と型に合わせる．ない列はすべて欠損値にする'''
+    columns = [
+        table.column(field.name).cast(field.type) if field.name in table.column_names
+        else pa.nulls(table.num_rows, field.type)
+        for field in schema
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+def _to_pandas(table):
+    '''Arrowの表をDataFrameにする．トークンの列はPythonのリストにする'''
+    df = table.to_pandas()
+    for column in TOKEN_COLUMNS:
+        if column in df.columns:
+            df[column] = table.column(column).to_pylist()
+    return df
+
+
+########
+# 書き込み
+########
+def write_table(df, query, stage, data_dict_path='data', fmt=None):
+    '''DataFrameを段階のファイルに保存し，保存先のパスを返す'''
+    path = stage_path(query, stage, data_dict_path, fmt=fmt)
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    if path.endswith('.parquet'):
+        _remove_parts(path)
+        pq.write_table(_to_arrow(df), path, row_group_size=ROW_GROUP_SIZE, use_dictionary=True, compression='snappy')
+    else:
+        df.to_csv(path)
+    return path
+
+class TableWriter:
+    '''
+    大きな段階のデータを塊ごとに書き足す．塊は今のファイルの列と型に合わせ，
+    合わせられない塊（新しい列がある，それまで値のなかった列に値がある）が来たら，列と型をまとめ直して
+    続きを次のファイル（part_paths を参照）に書く．
+    as_text=Trueなら，塊ごとに型が変わりやすい生データをすべて文字列として保存する（CSVと同じ扱い）．
+    '''
+
+    def __init__(self, query, stage, data_dict_path='data', as_text=False, fmt=None):
+        self.path = stage_path(query, stage, data_dict_path, fmt=fmt)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.as_text = as_text
+        self.rows = 0
+        self._writer = None
+        self._schema = None
+        self._part = 0
+        if self.path.endswith('.parquet'):
+            _remove_parts(self.path)
+
+    def write(self, df):
+        if self.path.endswith('.csv'):
+            df.to_csv(self.path, mode='w' if self.rows == 0 else 'a', header=(self.rows == 0))
+        else:
+            table = _to_arrow(df, as_text=self.as_text)
+            if self._schema is None:
+                self._schema = table.schema
+            elif not _fits(self._schema, table.schema):
+                # 列と型をまとめ直し，続きは次のファイルに書く
+                self._schema = pa.unify_schemas([self._schema, table.schema], promote_options='permissive')
+                self.close()
+                self._part += 1
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(_part_path(self.path, self._part), self._schema,
+                                                use_dictionary=True, compression='snappy')
+            self._writer.write_table(_conform(table, self._schema), row_group_size=ROW_GROUP_SIZE)
+        self.rows += len(df)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+########
+# 読み込み
+########
+def _apply_filters(df, filters):
+    '''pyarrowと同じ形式のfilters（[(列, 演算子, 値), ...] のAND）をDataFrameに適用する'''
+    mask = pd.Series(True, index=df.index)
+    for column, op, value in filters:
+        if op == 'in':
+            mask &= df[column].isin(value)
+        elif op == 'not in':
+            mask &= ~df[column].isin(value)
+        else:
+            mask &= _FILTER_OPERATORS[op](df[column], value)
+    return df[mask]
+
+def _read_csv(path, columns=None, filters=None, chunksize=None):
+    usecols = None
+    if columns is not None:
+        # フィルターに使う列も読み込み，あとで落とす
+        wanted = set(columns) | {f[0] for f in filters or []}
+        usecols = lambda c: c in wanted or c.startswith('Unnamed')
+    # to_csvで書いたファイルは1列目が行番号（列名なし）
+    has_index = pd.read_csv(path, nrows=0).columns[:1].str.startswith('Unnamed').any()
+    reader = pd.read_csv(path, index_col=0 if has_index else None, usecols=usecols, chunksize=chunksize)
+    for chunk in ([reader] if chunksize is None else reader):
+        if filters:
+            chunk = _apply_filters(chunk, filters)
+        if columns is not None:
+            chunk = chunk[[c for c in columns if c in chunk.columns]]
+        for column in TOKEN_COLUMNS:
+            if column in chunk.columns:
+                chunk[column] = chunk[column].map(parse_tokenized_body)
+        yield chunk
+
+def _parquet_schema(paths):
+    '''続きのファイルも含めた列と型（後のファイルで増えた列や決まった型もまとめる）'''
+    return pa.unify_schemas([pq.read_schema(p) for p in paths], promote_options='permissive')
+
+def _parquet_dataset(path):
+    paths = part_paths(path)
+    return ds.dataset(paths, schema=_parquet_schema(paths), format='parquet')
+
+def _as_categories(df):
+    for column in df.select_dtypes(include=['object', 'string']).columns.difference(TOKEN_COLUMNS):
+        df[column] = df[column].astype('category')
+    return df
+
+def file_columns(path):
+    '''ファイルの列名のリストを返す（データは読まない）'''
+    if path.endswith('.parquet'):
+        return _parquet_schema(part_paths(path)).names
+    return [c for c in pd.read_csv(path, nrows=0).columns if not c.startswith('Unnamed')]
+
+def read_file(path, columns=None, filters=None, categories=False):
+    '''
+    ParquetかCSVのファイルを読み込む．columnsで読む列を，filters（[(列, 演算子, 値), ...]）で読む行を絞る．
+    Parquetでは条件に合わない行グループを読み飛ばし，指定していない列は読まない．
+    categories=Trueなら文字列の列をカテゴリ型で返す．
+    '''
+    if path.endswith('.parquet') and len(part_paths(path)) > 1:
+        expression = pq.filters_to_expression(filters) if filters else None
+        df = _to_pandas(_parquet_dataset(path).to_table(columns=columns, filter=expression))
+        return _as_categories(df) if categories else df
+    if path.endswith('.parquet'):
+        read_dictionary = None
+        if categories:
+            # 辞書エンコードのまま読み込むとカテゴリ型になる
+            read_dictionary = [f.name for f in pq.read_schema(path) if pa.types.is_string(f.type) or pa.types.is_large_string(f.type)]
+        table = pq.read_table(path, columns=columns, filters=filters or None, read_dictionary=read_dictionary)
+        return _to_pandas(table)
+    df = next(_read_csv(path, columns=columns, filters=filters))
+    return _as_categories(df) if categories else df
+
+def iter_file(path, columns=None, filters=None, batch_size=ROW_GROUP_SIZE):
+    '''read_file と同じ条件で，batch_size 行程度ずつDataFrameを返す'''
+    if path.endswith('.parquet'):
+        dataset = _parquet_dataset(path)
+        expression = pq.filters_to_expression(filters) if filters else None
+        for batch in dataset.to_batches(columns=columns, filter=expression, batch_size=batch_size):
+            if batch.num_rows:
+                yield _to_pandas(pa.Table.from_batches([batch]))
+    else:
+        yield from _read_csv(path, columns=columns, filters=filters, chunksize=batch_size)
+
+def read_table(query, stage, columns=None, filters=None, data_dict_path='data', categories=False):
+    '''段階のデータを読み込む（read_file を参照）'''
+    return read_file(existing_stage_path(query, stage, data_dict_path), columns=columns, filters=filters, categories=categories)
+
+def iter_table(query, stage, columns=None, filters=None, data_dict_path='data', batch_size=ROW_GROUP_SIZE):
+    '''段階のデータを塊ごとに読み込む'''
+    yield from iter_file(existing_stage_path(query, stage, data_dict_path), columns=columns, filters=filters, batch_size=batch_size)
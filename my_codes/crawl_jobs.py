@@ -0,0 +1,196 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+#######
+# ユーザーごとの記事取得の進み具合を保存するジョブ表
+#######
+# data/{query}/crawl_jobs.db にユーザーごとの状態（pending / running / done / failed）と，
+# 書き終えた最後のページ・記事のkeyを保存する．複数のプロセスが同じ表からユーザーを取り合っても，
+# 1人のユーザーは1つのプロセスにしか割り当てられない．
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# この秒数のあいだ進捗がない running のユーザーは，止まったプロセスのものとみなして取り直す
+DEFAULT_LEASE_SECONDS = 30 * 60
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+def crawl_jobs_path(query):
+    return f'data/{query}/crawl_jobs.db'
+
+
+def worker_id(index=0):
+    """
+    このプロセスのワーカーID（ホスト名-プロセスID-番号）．割り当ての持ち主と書き出すファイルの名前に使う．
+    別々に起動したプロセスどうしでも重ならないので，他のプロセスの割り当てを release で戻してしまうことはない．
+    """
+    return f'{socket.gethostname()}-{os.getpid()}-{index}'
+
+
+class CrawlJob:
+    """割り当てられた1人分のジョブ"""
+
+    def __init__(self, username, position, last_page, last_note_key, n_notes, attempts):
+        self.username = username
+        self.position = position
+        self.last_page = last_page
+        self.last_note_key = last_note_key
+        self.n_notes = n_notes
+        self.attempts = attempts
+
+    @property
+    def next_page(self):
+        """続きを取得するページ"""
+        return self.last_page + 1
+
+
+class CrawlJobs:
+    """
+    SQLiteのジョブ表．ユーザーは登録した順に割り当て，ページを書き終えるたびに record_page で進捗を保存する．
+    再開時は書き終えたページの次から取得するので，終わった分の取得はやり直さない．
+    """
+
+    def __init__(self, path, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=60, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS crawl_jobs (
+                username TEXT PRIMARY KEY,
+                position INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                last_page INTEGER NOT NULL DEFAULT 0,
+                last_note_key TEXT,
+                n_notes INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                claimed_at REAL,
+                updated_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS ix_crawl_jobs_state_position ON crawl_jobs (state, position);
+        ''')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @contextmanager
+    def _transaction(self):
+        """書き込みロックを最初に取るトランザクション．他のプロセスと同じユーザーを取り合わない"""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def add_users(self, usernames, done=()):
+        """
+        ユーザーを順番どおりに登録する（重複は最初の位置を使い，登録済みのユーザーはそのまま）．
+        doneに含まれるユーザーは終わったものとして登録する．新しく登録した人数を返す．
+        """
+        usernames = list(dict.fromkeys(usernames))
+        done = set(done)
+        now = time.time()
+        with self._transaction() as conn:
+            start = conn.execute('SELECT COALESCE(MAX(position), -1) + 1 FROM crawl_jobs').fetchone()[0]
+            before = conn.total_changes
+            conn.executemany(
+                'INSERT OR IGNORE INTO crawl_jobs (username, position, state, updated_at) VALUES (?, ?, ?, ?)',
+                ((u, start + i, DONE if u in done else PENDING, now) for i, u in enumerate(usernames)),
+            )
+            return conn.total_changes - before
+
+    def claim(self, worker, limit=1):
+        """
+        まだ終わっていないユーザーを登録順に最大limit人割り当て，CrawlJobのリストを返す．
+        進捗が lease_seconds 以上止まっている running のユーザーも取り直す．
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            rows = conn.execute(
+                'SELECT username, position, last_page, last_note_key, n_notes, attempts FROM crawl_jobs '
+                'WHERE state = ? OR (state = ? AND claimed_at < ?) ORDER BY position LIMIT ?',
+                (PENDING, RUNNING, now - self.lease_seconds, limit),
+            ).fetchall()
+            conn.executemany(
+                'UPDATE crawl_jobs SET state = ?, worker = ?, attempts = attempts + 1, claimed_at = ?, updated_at = ? '
+                'WHERE username = ?',
+                ((RUNNING, worker, now, now, row[0]) for row in rows),
+            )
+        return [CrawlJob(username, position, last_page, last_note_key, n_notes, attempts + 1)
+                for username, position, last_page, last_note_key, n_notes, attempts in rows]
+
+    def record_page(self, username, page, last_note_key, n_notes):
+        """ページを書き終えたことを保存する．割り当ての期限も延ばす"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                'UPDATE crawl_jobs SET last_page = ?, last_note_key = COALESCE(?, last_note_key), '
+                'n_notes = n_notes + ?, claimed_at = ?, updated_at = ? WHERE username = ?',
+                (page, last_note_key, n_notes, now, now, username),
+            )
+
+    def complete(self, username, n_notes=0, last_note_key=None):
+        """ユーザーを取得済みにする．n_notes・last_note_key はページごとに記録していない場合に渡す"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                'UPDATE crawl_jobs SET state = ?, error = NULL, n_notes = n_notes + ?, '
+                'last_note_key = COALESCE(?, last_note_key), updated_at = ? WHERE username = ?',
+                (DONE, n_notes, last_note_key, now, username),
+            )
+
+    def fail(self, username, error):
+        """失敗を記録する．max_attempts 回までは pending に戻し，次の割り当てで続きから取得する"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                'UPDATE crawl_jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, error = ?, updated_at = ? '
+                'WHERE username = ?',
+                (self.max_attempts, FAILED, PENDING, str(error), now, username),
+            )
+
+    def release(self, worker):
+        """workerが持っている割り当てのうち，終わっていないユーザーを pending に戻す（中断したとき用）"""
+        with self._transaction() as conn:
+            conn.execute('UPDATE crawl_jobs SET state = ?, attempts = MAX(attempts - 1, 0) WHERE state = ? AND worker = ?',
+                         (PENDING, RUNNING, worker))
+
+    def retry_failed(self):
+        """failed のユーザーを pending に戻す"""
+        with self._transaction() as conn:
+            conn.execute('UPDATE crawl_jobs SET state = ?, attempts = 0 WHERE state = ?', (PENDING, FAILED))
+
+    def progress(self):
+        """状態ごとのユーザー数と，取得した記事数を返す"""
+        with self._lock:
+            counts = dict(self._conn.execute('SELECT state, COUNT(*) FROM crawl_jobs GROUP BY state').fetchall())
+            n_notes = self._conn.execute('SELECT COALESCE(SUM(n_notes), 0) FROM crawl_jobs').fetchone()[0]
+        progress = {state: counts.get(state, 0) for state in (PENDING, RUNNING, DONE, FAILED)}
+        progress['total'] = sum(counts.values())
+        progress['notes'] = n_notes
+        return progress
@@ -0,0 +1,173 @@
+import random
+import time
+
+from sqlalchemy import text
+
+from my_codes.database_setting import Engine
+from my_codes.database_setting import Base
+
+from my_codes.notes_database import Notes, TokenCache
+
+########
+# user_all_post.db のスキーマ管理
+########
+# スキーマのバージョンは PRAGMA user_version に保存する．
+# マイグレーションは (バージョン, 説明, 関数) の順に並べ，まだ適用していないものだけを順に適用する．
+
+def _create_tables(conn):
+    '''notesテーブルとtoken_cacheテーブルを作る（すでにあれば何もしない）'''
+    Base.metadata.create_all(conn, tables=[Notes.__table__, TokenCache.__table__], checkfirst=True)
+
+def _create_secondary_indexes(conn):
+    '''分析で絞り込みに使う列に索引を張る'''
+    for index in Notes.__table__.indexes:
+        index.create(conn, checkfirst=True)
+    conn.execute(text('ANALYZE notes'))
+
+# notes_fts の行はnotesと同じrowidを持たせ，トリガーで挿入・更新・削除に追従させる（バージョン3）．
+# tokenized_body はリストの文字列表現だが，unicode61は括弧・引用符・カンマで区切るのでMeCabのトークン単位で索引される
+FTS_STATEMENTS = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(key UNINDEXED, tokens, tokenize='unicode61')",
+    """CREATE TRIGGER IF NOT EXISTS notes_fts_ai AFTER INSERT ON notes BEGIN
+        INSERT INTO notes_fts (rowid, key, tokens) VALUES (new.rowid, new.key, new.tokenized_body);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS notes_fts_ad AFTER DELETE ON notes BEGIN
+        DELETE FROM notes_fts WHERE rowid = old.rowid;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS notes_fts_au AFTER UPDATE OF key, tokenized_body ON notes BEGIN
+        DELETE FROM notes_fts WHERE rowid = old.rowid;
+        INSERT INTO notes_fts (rowid, key, tokens) VALUES (new.rowid, new.key, new.tokenized_body);
+    END""",
+]
+
+def _create_fts_index(conn):
+    '''トークン化した本文の全文検索用の索引（FTS5）を作り，既存の記事を登録する'''
+    for statement in FTS_STATEMENTS:
+        conn.execute(text(statement))
+    conn.execute(text('DELETE FROM notes_fts'))
+    conn.execute(text('INSERT INTO notes_fts (rowid, key, tokens) SELECT rowid, key, tokenized_body FROM notes'))
+
+# notesは主キーがTEXTなので，VACUUMでrowidが振り直されることがある（バージョン4）．
+# notes_fts の行はkeyで記事と対応させ，rowidは notes_fts_keys（INTEGER PRIMARY KEYなので振り直されない）の id を使う．
+# UNINDEXEDの列では行を探せないので，トリガーは notes_fts_keys で notes_fts の行を探して消す
+FTS_KEY_STATEMENTS = [
+    'DROP TRIGGER IF EXISTS notes_fts_ai',
+    'DROP TRIGGER IF EXISTS notes_fts_ad',
+    'DROP TRIGGER IF EXISTS notes_fts_au',
+    'CREATE TABLE IF NOT EXISTS notes_fts_keys (id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE)',
+    """CREATE TRIGGER notes_fts_ai AFTER INSERT ON notes BEGIN
+        INSERT OR IGNORE INTO notes_fts_keys (key) VALUES (new.key);
+        INSERT INTO notes_fts (rowid, key, tokens)
+            SELECT id, new.key, new.tokenized_body FROM notes_fts_keys WHERE key = new.key;
+    END""",
+    """CREATE TRIGGER notes_fts_ad AFTER DELETE ON notes BEGIN
+        DELETE FROM notes_fts WHERE rowid = (SELECT id FROM notes_fts_keys WHERE key = old.key);
+        DELETE FROM notes_fts_keys WHERE key = old.key;
+    END""",
+    """CREATE TRIGGER notes_fts_au AFTER UPDATE OF key, tokenized_body ON notes BEGIN
+        DELETE FROM notes_fts WHERE rowid = (SELECT id FROM notes_fts_keys WHERE key = old.key);
+        DELETE FROM notes_fts_keys WHERE key = old.key;
+        INSERT OR IGNORE INTO notes_fts_keys (key) VALUES (new.key);
+        INSERT INTO notes_fts (rowid, key, tokens)
+            SELECT id, new.key, new.tokenized_body FROM notes_fts_keys WHERE key = new.key;
+    END""",
+]
+
+def _key_fts_index(conn):
+    '''notes_fts の行をrowidではなくkeyで記事と対応させ，既存の記事を登録し直す'''
+    for statement in FTS_KEY_STATEMENTS:
+        conn.execute(text(statement))
+    _fill_fts_index(conn)
+
+def _fill_fts_index(conn):
+    conn.execute(text('DELETE FROM notes_fts'))
+    conn.execute(text('DELETE FROM notes_fts_keys'))
+    # 同じkeyの行が残っている古いテーブルでは，最後に書いた行を使う
+    conn.execute(text('INSERT INTO notes_fts_keys (key) SELECT DISTINCT key FROM notes'))
+    conn.execute(text(
+        'INSERT INTO notes_fts (rowid, key, tokens) '
+        'SELECT k.id, n.key, n.tokenized_body FROM notes n JOIN notes_fts_keys k ON k.key = n.key '
+        'WHERE n.rowid IN (SELECT MAX(rowid) FROM notes GROUP BY key)'
+    ))
+
+def rebuild_fts_index(engine=Engine):
+    '''notes_fts を作り直して最適化する（VACUUMの後も作り直す必要はない）'''
+    with engine.begin() as conn:
+        _fill_fts_index(conn)
+        conn.execute(text("INSERT INTO notes_fts (notes_fts) VALUES ('optimize')"))
+
+MIGRATIONS = [
+    (1, 'create notes and token_cache tables', _create_tables),
+    (2, 'add secondary indexes on urlname, user_id and created_at', _create_secondary_indexes),
+    (3, 'add FTS5 index over tokenized_body', _create_fts_index),
+    (4, 'match FTS5 rows to notes by key instead of rowid', _key_fts_index),
+]
+
+def get_schema_version(engine=Engine):
+    '''DBのスキーマのバージョンを返す'''
+    with engine.connect() as conn:
+        return conn.execute(text('PRAGMA user_version')).scalar()
+
+def migrate(engine=Engine):
+    '''まだ適用していないマイグレーションを順に適用し，適用後のバージョンを返す'''
+    version = get_schema_version(engine)
+    for target, description, apply in MIGRATIONS:
+        if target <= version:
+            continue
+        # マイグレーションごとに1つのトランザクションで適用し，途中で失敗したら元に戻す
+        with engine.begin() as conn:
+            apply(conn)
+            conn.execute(text(f'PRAGMA user_version = {int(target)}'))
+        print(f'migrated to version {target}: {description}')
+        version = target
+    return version
+
+
+########
+# よく使う検索の速さを測る
+########
+LOOKUPS = {
+    'urlname': 'SELECT key, body FROM notes WHERE urlname = :value',
+    'user_id': 'SELECT key, body FROM notes WHERE user_id = :value',
+    'created_at': 'SELECT key FROM notes WHERE created_at >= :value ORDER BY created_at LIMIT 1000',
+}
+
+def benchmark_lookups(engine=Engine, n_samples=100, seed=0):
+    '''
+    urlname・user_id・created_atによる検索を n_samples 回ずつ実行し，
+    検索ごとの平均秒数と実行計画（索引を使っているか）を返す．migrate の前後で比べる．
+    '''
+    rng = random.Random(seed)
+    results = {}
+    with engine.connect() as conn:
+        if conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'notes'")).first() is None:
+            return results
+        for column, query in LOOKUPS.items():
+            values = [row[0] for row in conn.execute(text(f'SELECT DISTINCT {column} FROM notes WHERE {column} IS NOT NULL'))]
+            if not values:
+                continue
+            samples = [rng.choice(values) for _ in range(n_samples)]
+            plan = ' / '.join(row[-1] for row in conn.execute(text('EXPLAIN QUERY PLAN ' + query), {'value': samples[0]}))
+
+            start = time.perf_counter()
+            for value in samples:
+                conn.execute(text(query), {'value': value}).fetchall()
+            results[column] = {
+                'mean_seconds': (time.perf_counter() - start) / n_samples,
+                'plan': plan,
+            }
+    return results
+
+def main(engine=Engine, n_samples=100):
+    '''現在のDBで検索の速さを測り，マイグレーションを適用してからもう一度測る'''
+    before = benchmark_lookups(engine, n_samples=n_samples)
+    version = migrate(engine)
+    after = benchmark_lookups(engine, n_samples=n_samples)
+    for column in after:
+        b = before.get(column, {}).get('mean_seconds')
+        a = after[column]['mean_seconds']
+        print(f"{column}: {b * 1000 if b else float('nan'):.3f} ms -> {a * 1000:.3f} ms ({after[column]['plan']})")
+    return {'version': version, 'before': before, 'after': after}
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,12 @@
+import time
+
 import pandas as pd
-from sqlalchemy import create_engine, Column, Integer, String, Text, Boolean, DateTime
+from sqlalchemy import create_engine, Column, Integer, String, Text, Boolean, DateTime, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from my_codes import corpus_storage
+from my_codes import database_migration
 from my_codes.database_setting import Engine
 from my_codes.database_setting import Base
 
@@ -12,7 +16,16 @@ from my_codes.notes_database import Notes
 # 前処理したデータから，データベースに新しいデータを追加する
 ########
 # メイン関数
-def add_csv_to_database(query):
+def add_csv_to_database(query, bulk=False, chunksize=10000):
+    '''前処理したCSVをnotesテーブルに追加する．
+    bulk=Trueなら既存の記事も更新する一括upsertを使い，追加・更新の件数と速度を返す'''
+    if bulk:
+        df = read_csv_file(query)
+        report = bulk_upsert_notes(df, Engine, chunksize=chunksize)
+        print(f"{report['inserted']} rows inserted, {report['updated']} rows updated "
+              f"in {report['seconds']:.2f}s ({report['rows_per_sec']:.0f} rows/s)")
+        return report
+
     # データベースのセッションを作成
     Session = sessionmaker(bind=Engine)
     session = Session()
@@ -38,10 +51,14 @@ def get_database_keys(session):
     return df_database
 
 def read_csv_file(query):
-    # CSV ファイルのパス
-    csv_file_path = f'data/{query}/{query}_data_preprocessed.csv'
-    # CSV ファイルの読み込み
-    df = pd.read_csv(csv_file_path, index_col=0)
+    # 前処理したデータの読み込み（Parquet，なければCSV）
+    df = corpus_storage.read_table(query, 'preprocessed')
+    return df
+
+def _stringify_tokens(df):
+    '''トークンのリストは既存のデータと同じくリストの文字列表現で保存する'''
+    if 'tokenized_body' in df.columns:
+        df = df.assign(tokenized_body=df['tokenized_body'].map(lambda x: str(x) if isinstance(x, list) else x))
     return df
 
 def insert_new_data(df, df_database, engine):
@@ -50,12 +67,174 @@ def insert_new_data(df, df_database, engine):
 
     # 新しいデータをデータベースに挿入
     if not new_df.empty:
+        new_df = _stringify_tokens(new_df)
         new_df.to_sql('notes', con=engine, if_exists='append', index=False)
     else:
         print("新しいデータはありません。")
 
+########
+# 一括upsert
+########
+# 一括書き込みの間だけ使うSQLiteの設定
+BULK_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'temp_store': 'MEMORY',
+    'cache_size': '-200000',  # 約200MB
+}
+
+def _has_unique_key(cursor):
+    '''notesテーブルに key だけの一意な索引（主キーを含む）があるか'''
+    for _, name, unique, *_ in cursor.execute('PRAGMA index_list(notes)').fetchall():
+        if unique and [row[2] for row in cursor.execute(f'PRAGMA index_info("{name}")').fetchall()] == ['key']:
+            return True
+    return False
+
+def ensure_notes_table(engine):
+    '''
+    notesテーブルがなければ作り，ON CONFLICT(key) に必要な key の一意な索引があることを保証する．
+    to_sql で作られたテーブルには主キーがないので，同じkeyの行は最後に書いたものだけを残してから索引を張る．
+    最後にマイグレーションを適用し，全文検索の索引（notes_fts）が書き込みに追従するようにする．
+    '''
+    Notes.__table__.create(engine, checkfirst=True)
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        if not _has_unique_key(cursor):
+            cursor.execute('DELETE FROM notes WHERE rowid NOT IN (SELECT MAX(rowid) FROM notes GROUP BY key)')
+            cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS ux_notes_key ON notes (key)')
+            conn.commit()
+    finally:
+        conn.close()
+    database_migration.migrate(engine)
+
+def bulk_upsert_notes(df, engine, chunksize=10000):
+    '''
+    DataFrameを一時テーブルに書き込み，1つのトランザクションで
+    INSERT ... ON CONFLICT(key) DO UPDATE によりnotesテーブルへ反映する．
+    返り値は {'rows', 'inserted', 'updated', 'seconds', 'rows_per_sec'} の辞書．
+    '''
+    start = time.perf_counter()
+    # notesテーブルにある列だけを使い，同じkeyは後のものを残す
+    columns = [c.name for c in Notes.__table__.columns if c.name in df.columns]
+    if 'key' not in columns:
+        raise ValueError("DataFrame must have a 'key' column")
+    df = df[columns].drop_duplicates(subset='key', keep='last')
+    df = _stringify_tokens(df)
+    # sqlite3に渡せるように，NaNをNoneに，NumPyの値をPythonの値にする
+    df = df.astype(object).where(pd.notnull(df), None)
+
+    column_list = ', '.join(columns)
+    placeholders = ', '.join('?' for _ in columns)
+    updates = ', '.join(f'{c} = excluded.{c}' for c in columns if c != 'key')
+
+    ensure_notes_table(engine)
+    conn = engine.raw_connection()
+    # 接続はプールに戻って使い回されるので，設定は終わったら元に戻す
+    saved_pragmas = {}
+    try:
+        cursor = conn.cursor()
+        for name, value in BULK_PRAGMAS.items():
+            saved_pragmas[name] = cursor.execute(f'PRAGMA {name}').fetchone()[0]
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.execute('DROP TABLE IF EXISTS temp.notes_stage')
+        cursor.execute(f'CREATE TEMP TABLE notes_stage AS SELECT {column_list} FROM notes WHERE 0')
+
+        # 一時テーブルにまとめて書き込む
+        rows = df.itertuples(index=False, name=None)
+        while True:
+            chunk = [row for _, row in zip(range(chunksize), rows)]
+            if not chunk:
+                break
+            cursor.executemany(f'INSERT INTO notes_stage ({column_list}) VALUES ({placeholders})', chunk)
+
+        # 既存のkeyの数が更新件数になる
+        updated = cursor.execute(
+            'SELECT COUNT(*) FROM notes_stage s WHERE EXISTS (SELECT 1 FROM notes n WHERE n.key = s.key)'
+        ).fetchone()[0]
+
+        # SELECTを使うupsertでは構文の曖昧さを避けるために WHERE true が必要
+        cursor.execute(
+            f'INSERT INTO notes ({column_list}) SELECT {column_list} FROM notes_stage WHERE true '
+            f'ON CONFLICT(key) DO ' + (f'UPDATE SET {updates}' if updates else 'NOTHING')
+        )
+        cursor.execute('DROP TABLE temp.notes_stage')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor = conn.cursor()
+        for name, value in saved_pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        conn.close()
+
+    seconds = time.perf_counter() - start
+    return {
+        'rows': len(df),
+        'inserted': len(df) - updated,
+        'updated': updated,
+        'seconds': seconds,
+        'rows_per_sec': len(df) / seconds if seconds else 0.0,
+    }
+
 ########
 # query検索
 ########
+# notes_fts（database_migrationのバージョン3で作成し，バージョン4でkeyと対応させた）を使って，取得済みの記事をトークン単位で全文検索する
+_query_mecab = None
+
+def build_match_expression(query, match='all'):
+    '''
+    検索語をFTS5の検索式にする．空白で区切った語ごとにMeCabでトークン化し，
+    1つの語から出たトークンは連続するフレーズ（または語そのもの）として，語同士は match='all' ならAND，'any' ならORでつなぐ．
+    '''
+    global _query_mecab
+    if match not in ('all', 'any'):
+        raise ValueError("match must be 'all' or 'any'")
+    if _query_mecab is None:
+        import MeCab
+        _query_mecab = MeCab.Tagger()
+    from my_codes.preprocessing import tokenize
+
+    phrases = []
+    for term in query.split():
+        tokens = [t for t in tokenize(term, _query_mecab) if t]
+        if not tokens:
+            # 品詞で落とされた語は，そのまま1つのトークンとして検索する
+            tokens = [term]
+        # 二重引用符はFTS5の文字列として二重にしてエスケープする
+        phrase = '"' + ' '.join(tokens).replace('"', '""') + '"'
+        if tokens != [term]:
+            # 索引側で1つのトークンとして登録されている場合にもヒットするように，語そのものでも検索する
+            phrase = f'({phrase} OR "' + term.replace('"', '""') + '")'
+        phrases.append(phrase)
+    return (' AND ' if match == 'all' else ' OR ').join(phrases)
+
+def search_notes(query, limit=20, offset=0, match='all', engine=Engine):
+    '''
+    取得済みの記事を全文検索し，関連度（bm25，小さいほど関連が強い）の順にDataFrameで返す．
+    limitとoffsetでページ送りする．
+    '''
+    expression = build_match_expression(query, match=match)
+    if not expression:
+        return pd.DataFrame(columns=['key', 'urlname', 'name', 'created_at', 'score'])
+    sql = text(
+        'SELECT n.key, n.urlname, n.name, n.created_at, bm25(notes_fts) AS score '
+        'FROM notes_fts JOIN notes n ON n.key = notes_fts.key '
+        'WHERE notes_fts MATCH :expression ORDER BY score LIMIT :limit OFFSET :offset'
+    )
+    with engine.connect() as conn:
+        return pd.read_sql(sql, conn, params={'expression': expression, 'limit': limit, 'offset': offset})
+
+def count_notes(query, match='all', engine=Engine):
+    '''search_notesでヒットする記事の総数を返す（ページ数の計算に使う）'''
+    expression = build_match_expression(query, match=match)
+    if not expression:
+        return 0
+    with engine.connect() as conn:
+        return conn.execute(
+            text('SELECT COUNT(*) FROM notes_fts WHERE notes_fts MATCH :expression'),
+            {'expression': expression},
+        ).scalar()
 
 
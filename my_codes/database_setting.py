@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import Session
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -12,6 +12,21 @@ Engine = create_engine(
 )
 Base = declarative_base()
 
+# 接続ごとのSQLiteの設定
+# WALモードにすると，クローラーが書き込んでいる間も分析側の読み込みがブロックされない
+SQLITE_PRAGMAS = {
+  'journal_mode': 'WAL',
+  'synchronous': 'NORMAL',
+  'busy_timeout': '30000',
+}
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragma(dbapi_connection, connection_record):
+  cursor = dbapi_connection.cursor()
+  for name, value in SQLITE_PRAGMAS.items():
+    cursor.execute(f'PRAGMA {name} = {value}')
+  cursor.close()
+
 # Sessionの作成
 
 # modelで使用する
@@ -0,0 +1,191 @@
+import ast
+import os
+import struct
+import zipfile
+from array import array
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+########
+# トークンのリストから文書-単語行列（CSR）を作る
+########
+# LDAとJMFDのスコア計算で共通に使う．トークンを文字列に結合してCountVectorizerで分割し直すことはせず，
+# chunksize文書ずつ疎行列の配列を作って最後に1つにまとめる．
+
+def parse_tokenized_body(value):
+    '''tokenized_body列の値をトークンのリストに変換する．CSVやDBでは文字列化されているので元に戻す'''
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return list(value)
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return []
+    value = str(value)
+    if value.startswith('['):
+        return ast.literal_eval(value)
+    return value.split()
+
+def build_document_term_matrix(token_lists, vocabulary=None, chunksize=10000, lowercase=False,
+                               sort_vocabulary=False, grow_vocabulary=True):
+    '''
+    トークンのリストの列から，文書×語彙の出現回数のCSR行列と語彙（トークン -> 列番号の辞書）を返す．
+
+    - vocabulary: 既存の語彙．指定するとその列番号を使い，新しいトークンは末尾に追加する
+    - grow_vocabulary: Falseなら語彙にないトークンは無視する（学習済みモデルに合わせるとき）
+    - lowercase: 英字を小文字にする（CountVectorizerの既定と同じ）
+    - sort_vocabulary: 語彙をトークンの順に並べ替える（CountVectorizerと同じ列の順番になる）
+    空文字のトークンは数えない．
+    '''
+    vocabulary = dict(vocabulary or {})
+    data_chunks, indices_chunks, indptr_chunks = [], [], []
+    n_docs = 0
+    nnz = 0
+
+    chunk_indices = array('i')
+    chunk_indptr = [0]
+    for tokens in token_lists:
+        for token in parse_tokenized_body(tokens):
+            if not token:
+                continue
+            if lowercase:
+                token = token.lower()
+            index = vocabulary.get(token)
+            if index is None:
+                if not grow_vocabulary:
+                    continue
+                index = vocabulary[token] = len(vocabulary)
+            chunk_indices.append(index)
+        chunk_indptr.append(len(chunk_indices))
+
+        if len(chunk_indptr) > chunksize:
+            nnz = _flush_chunk(chunk_indices, chunk_indptr, len(vocabulary), nnz,
+                               data_chunks, indices_chunks, indptr_chunks)
+            n_docs += len(chunk_indptr) - 1
+            chunk_indices = array('i')
+            chunk_indptr = [0]
+    if len(chunk_indptr) > 1:
+        nnz = _flush_chunk(chunk_indices, chunk_indptr, len(vocabulary), nnz,
+                           data_chunks, indices_chunks, indptr_chunks)
+        n_docs += len(chunk_indptr) - 1
+
+    index_dtype = np.int32 if max(nnz, len(vocabulary)) < np.iinfo(np.int32).max else np.int64
+    data = np.concatenate(data_chunks) if data_chunks else np.zeros(0, dtype=np.int32)
+    indices = np.concatenate(indices_chunks).astype(index_dtype, copy=False) if indices_chunks else np.zeros(0, dtype=index_dtype)
+    indptr = np.concatenate([np.zeros(1, dtype=np.int64)] + indptr_chunks).astype(index_dtype, copy=False)
+    X = sparse.csr_matrix((data, indices, indptr), shape=(n_docs, len(vocabulary)))
+
+    if sort_vocabulary:
+        X, vocabulary = _sort_vocabulary(X, vocabulary)
+    return X, vocabulary
+
+def _flush_chunk(chunk_indices, chunk_indptr, n_terms, nnz, data_chunks, indices_chunks, indptr_chunks):
+    '''1チャンク分の文書を，同じ文書内の重複トークンをまとめたCSRの配列にして追加する'''
+    indices = np.frombuffer(chunk_indices, dtype=np.int32) if len(chunk_indices) else np.zeros(0, dtype=np.int32)
+    indptr = np.asarray(chunk_indptr, dtype=np.int64)
+    X = sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.int32), indices, indptr),
+        shape=(len(indptr) - 1, n_terms),
+    )
+    X.sum_duplicates()
+    data_chunks.append(X.data.astype(np.int32, copy=False))
+    indices_chunks.append(X.indices.astype(np.int64, copy=False))
+    indptr_chunks.append(X.indptr[1:].astype(np.int64) + nnz)
+    return nnz + X.nnz
+
+def _sort_vocabulary(X, vocabulary):
+    '''語彙をトークンの順に並べ替え，行列の列もそれに合わせる'''
+    terms = sorted(vocabulary)
+    old_to_new = np.empty(len(terms), dtype=X.indices.dtype)
+    for new, term in enumerate(terms):
+        old_to_new[vocabulary[term]] = new
+    X = sparse.csr_matrix((X.data, old_to_new[X.indices], X.indptr), shape=X.shape)
+    X.sort_indices()
+    return X, {term: i for i, term in enumerate(terms)}
+
+def feature_names(vocabulary):
+    '''語彙の辞書から，列番号の順に並べたトークンの配列を返す'''
+    names = np.empty(len(vocabulary), dtype=object)
+    for term, i in vocabulary.items():
+        names[i] = term
+    return names
+
+
+########
+# .npz での保存と読み込み（メモリマップ）
+########
+def save_document_term_matrix(path, X, vocabulary):
+    '''
+    行列と語彙を非圧縮の.npzに保存する．語彙はUTF-8のバイト列とその区切り位置として保存するので，
+    load_document_term_matrix で行列も語彙もメモリマップで読み込める．
+    '''
+    X = sparse.csr_matrix(X)
+    vocabulary_bytes, vocabulary_offsets = encode_terms(feature_names(vocabulary))
+    save_npz_arrays(
+        path,
+        data=X.data, indices=X.indices, indptr=X.indptr, shape=np.asarray(X.shape, dtype=np.int64),
+        vocabulary_bytes=vocabulary_bytes, vocabulary_offsets=vocabulary_offsets,
+    )
+
+def encode_terms(terms):
+    '''トークンの列を，UTF-8のバイト列（uint8の配列）と各トークンの区切り位置の配列にする'''
+    encoded = [term.encode('utf-8') for term in terms]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+def decode_terms(data, offsets):
+    '''encode_terms の逆．トークンのリストを返す'''
+    blob = bytes(data)
+    return [blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+def _memmap_npz_member(path, zf, name):
+    '''非圧縮の.npzの中の配列をコピーせずにメモリマップする．圧縮されていれば普通に読み込む'''
+    info = zf.getinfo(name)
+    if info.compress_type != zipfile.ZIP_STORED:
+        with zf.open(name) as f:
+            return np.lib.format.read_array(f)
+    with open(path, 'rb') as f:
+        # ローカルファイルヘッダーの後ろに.npyのデータがある
+        f.seek(info.header_offset)
+        header = f.read(30)
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if not shape or 0 in shape:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape, offset=offset,
+                     order='F' if fortran_order else 'C')
+
+def load_npz_arrays(path, mmap=True):
+    '''.npzの配列を名前 -> 配列の辞書で返す．mmap=Trueならメモリマップで開く'''
+    if not mmap:
+        with np.load(path) as npz:
+            return {name: npz[name] for name in npz.files}
+    with zipfile.ZipFile(path) as zf:
+        return {name[:-len('.npy')]: _memmap_npz_member(path, zf, name) for name in zf.namelist()}
+
+def save_npz_arrays(path, **arrays):
+    '''配列を非圧縮の.npzに保存する．一時ファイルに書いてから置き換えるので，同じファイルをメモリマップで開いていても壊さない'''
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+def load_document_term_matrix(path, mmap=True):
+    '''save_document_term_matrix で保存した行列と語彙を読み込む．mmap=Trueならメモリマップで開く'''
+    arrays = load_npz_arrays(path, mmap=mmap)
+
+    X = sparse.csr_matrix(
+        (arrays['data'], arrays['indices'], arrays['indptr']),
+        shape=tuple(int(n) for n in arrays['shape']), copy=False,
+    )
+    terms = decode_terms(arrays['vocabulary_bytes'], arrays['vocabulary_offsets'])
+    return X, {term: i for i, term in enumerate(terms)}
@@ -4,6 +4,15 @@ import pandas as pd
 import json
 import os
 import ast
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from my_codes import corpus_storage
+from my_codes import crawl_jobs
+from my_codes import fetch_engine
+from my_codes import http_session
+from my_codes import note_details
+from my_codes import response_cache
 
 #######
 # 特定のクエリを含む記事を全取得
@@ -13,7 +22,7 @@ from requests.exceptions import HTTPError, ConnectionError, Timeout, RequestExce
 
 # 単一のクエリに対して，指定した数の記事を取得
 def fetch_articles(query, size=1, start=0, max_retries=3, backoff_factor=1):
-    base_url = "https://note.com/api/v3/searches"
+    base_url = fetch_engine.SEARCH_URL
     params = {
         "context": "note",
         "q": query,
@@ -24,7 +33,7 @@ def fetch_articles(query, size=1, start=0, max_retries=3, backoff_factor=1):
     retries = 0
     while True:
         try:
-            response = requests.get(base_url, params=params)
+            response = http_session.get(base_url, params=params)
             response.raise_for_status()  # HTTPエラーをチェック
             # 成功した場合はデータを返す
             if response.status_code == 200:
@@ -49,8 +58,12 @@ def fetch_articles(query, size=1, start=0, max_retries=3, backoff_factor=1):
             return f"An unexpected error occurred: {e}"
 
 # 複数のバッチを指定して，任意の数のデータを取得
-def fetch_multiple_batches(query, size=1, batches=1, interval=1):
-    '''バッチ数を指定して，任意の数のデータを取得する．取得できるデータがなくなったら終了．'''
+def fetch_multiple_batches(query, size=1, batches=1, interval=1, backend='sync', **fetcher_kwargs):
+    '''バッチ数を指定して，任意の数のデータを取得する．取得できるデータがなくなったら終了．
+    backend='async'のときは fetch_engine で並行取得する（fetcher_kwargsは AsyncFetcher の引数）．'''
+    if backend == 'async':
+        return fetch_engine.fetch_multiple_batches(query, size=size, batches=batches, **fetcher_kwargs)
+
     all_articles = []
     
     for i in range(batches):
@@ -103,19 +116,28 @@ def extract_data_to_dataframe(all_articles):
     return df
 
 # クエリ検索では全文取得でいないため，クエリ検索取得したkeyから全文取得する
-def fetch_articles_by_keys(data,interval=1):
+def fetch_articles_by_keys(data,interval=1, backend='sync', **fetcher_kwargs):
     '''全文取得をするために，keyから読み込む'''
     keys = list(data['key'])
+    if backend == 'async':
+        all_articls = fetch_engine.fetch_articles_by_keys(keys, **fetcher_kwargs)
+        print(f'fetching complete!')
+        return pd.DataFrame([flatten_note(article) for article in all_articls])
+
     all_articls = []
     counter = 0
     for key in keys:
-        res = requests.get(f'https://note.com/api/v3/notes/{key}')
+        # キャッシュにあれば通信せず，待ち時間も入れない
+        cache_key = response_cache.note_cache_key(key)
+        res, cache_entry = http_session.lookup_cache(cache_key)
+        if res is None:
+            res = http_session.get(fetch_engine.NOTE_URL.format(key=key), cache_key=cache_key, cache_entry=cache_entry)
+            time.sleep(interval)
         data_json = json.loads(res.text) #JSON->Dict
         content = data_json['data'] #データ抽出
 
-        all_articls.append(data_json['data']) #データ抽出
+        all_articls.append(flatten_note(data_json['data'])) #データ抽出
         
-        time.sleep(interval)
         counter += 1
         if counter % 10 == 0:
             print(f'{counter}/{len(keys)} has fetched')
@@ -128,10 +150,11 @@ def fetch_articles_by_keys(data,interval=1):
 #######
 # 特定のユーザーの全ポストを取得する
 #######
-def request_with_retry(url, max_retries=5):
+def request_with_retry(url, max_retries=5, **cache_kwargs):
+    '''cache_kwargs（cache_key, ttl, cache_entry）を指定すると，http_sessionのディスクキャッシュを使う'''
     for _ in range(max_retries):
         try:
-            response = requests.get(url, timeout=10)  # タイムアウトを10秒に設定
+            response = http_session.get(url, timeout=10, **cache_kwargs)  # タイムアウトを10秒に設定
             response.raise_for_status()  # ステータスコードが200でない場合はエラーを発生させる
             return response
         except requests.RequestException as e:
@@ -139,128 +162,280 @@ def request_with_retry(url, max_retries=5):
             time.sleep(5)  # 5秒待ってから再試行
     raise Exception("Max retries reached. Exiting.")
 
-def get_user_all_notes(username:str, maxpage:int=10000, interval:int=1.0):
-    """ユーザーごとの全記事を取得する"""
-    all_contents = []
-    for numpage in range(1, maxpage+1):
-        time.sleep(interval) # サーバー負荷軽減のため
-        
-        url = f'https://note.com/api/v2/creators/{username}/contents?kind=note&page={numpage}'
-        res = request_with_retry(url)
+def iter_user_note_pages(username:str, maxpage:int=10000, interval:int=1.0, start_page:int=1, detail_policy=None, **fetcher_kwargs):
+    """
+    ユーザーの記事をページごとに (ページ番号, 記事の辞書のリスト) で返すジェネレーター．空のページで終わる．
+    記事本文は detail_policy（note_details.DetailPolicy）で一覧やキャッシュで済む記事を除き，残りをページごとにまとめて
+    fetch_engine で取得する．fetcher_kwargs（rate, concurrency など）は fetch_engine.AsyncFetcher に渡す．
+    指定がなければ，本文もintervalの間隔で1件ずつ取得する（一覧と同じ頻度にする）．
+    """
+    detail_policy = detail_policy if detail_policy is not None else note_details.DetailPolicy()
+    detail_kwargs = dict(fetcher_kwargs)
+    if interval:
+        detail_kwargs.setdefault('rate', 1 / interval)
+        detail_kwargs.setdefault('concurrency', 1)
+
+    def fetch_details(keys):
+        return fetch_engine.fetch_articles_by_keys(keys, **detail_kwargs)
+
+    for numpage in range(start_page, maxpage+1):
+        url = fetch_engine.CREATOR_CONTENTS_URL.format(username=username) + f'?kind=note&page={numpage}'
+        cache_key = response_cache.contents_cache_key(username, numpage)
+        res, cache_entry = http_session.lookup_cache(cache_key)
+        if res is None:
+            time.sleep(interval) # サーバー負荷軽減のため
+            res = request_with_retry(url, cache_key=cache_key, ttl=response_cache.CONTENTS_TTL, cache_entry=cache_entry)
         user_data_json = json.loads(res.text)  # JSON -> Dict
         
         if user_data_json['data']['contents']:  # データが空でない場合
             contents = user_data_json['data']['contents']  # キー抽出
-            for content in contents:
-                key = content['key']
-                url = f'https://note.com/api/v3/notes/{key}'
-                res = request_with_retry(url)
-                data_json = json.loads(res.text)  # JSON -> Dict
-                key_data = data_json['data']  # データ抽出
-                all_contents.append(key_data)
+            # 一覧で足りない記事の本文だけを取得する
+            yield numpage, note_details.resolve(contents, fetch_details, detail_policy)
             print(f'page {numpage} has fetched')
         else:
             print(f'page {numpage} is empty, finishing process!')
-            return pd.DataFrame(all_contents)
+            break
+
+def get_user_all_notes(username:str, maxpage:int=10000, interval:int=1.0, as_frame:bool=True, start_page:int=1, on_page=None,
+                       detail_policy=None, **fetcher_kwargs):
+    """
+    ユーザーごとの全記事を取得する．as_frame=Falseなら記事の辞書のリストで返す．
+    start_pageから取得を始める．on_pageを指定すると，ページを取得するたびに on_page(ページ番号, 記事の辞書のリスト) を呼び，
+    そのページの記事は戻り値に含めない（記事を抱えずに書き出すとき用）．
+    detail_policy と fetcher_kwargs は iter_user_note_pages に渡す．
+    """
+    all_contents = []
+    for numpage, page_contents in iter_user_note_pages(username, maxpage=maxpage, interval=interval, start_page=start_page,
+                                                       detail_policy=detail_policy, **fetcher_kwargs):
+        if on_page is not None:
+            on_page(numpage, page_contents)
+        else:
+            all_contents.extend(page_contents)
     
-    return pd.DataFrame(all_contents)
+    return pd.DataFrame(all_contents) if as_frame else all_contents
 
 #######
 # 特定のクエリを含む記事を投稿した全ユーザーの全ポストを取得する
 #######
-def save_user_data(temp_df, counter, query):
-    """各ユーザーのデータを保存する関数"""
-    user_data_path = f'data/{query}/user_posts_{str(counter)}.csv'
-    temp_df.to_csv(user_data_path, index=False)
-    print(f'User {counter} data saved at {user_data_path}')
-
-def save_checkpoint(counter, query):
-    """中間結果を保存する関数"""
-    checkpoint_path = f'data/{query}/checkpoint.csv'
-    with open(checkpoint_path, 'w') as f:
-        f.write(str(counter))
-    print(f'CHECK POINT {counter} st user has fetched!')
-
-def load_checkpoint(query):
-    """再開地点を読み込む関数"""
-    checkpoint_path = f'data/{query}/checkpoint.csv'
-    if os.path.exists(checkpoint_path):
-        with open(checkpoint_path, 'r') as f:
-            counter = int(f.read().strip())
-        return counter
-    return 0
-
-def get_all_post_per_user(data, maxpage=10000, interval=1, query='temp', start_at=None):
-    # 中間結果と再開地点を読み込む
-    if start_at:
-        start_counter = start_at
-    else:
-        start_counter = load_checkpoint(query)
-    
-    # ユーザーURLの重複を削除する
-    urlname_list = list(set(data['urlname'].tolist()))
-
-    # 未処理のユーザーから再開
-    for counter, user in enumerate(urlname_list[start_counter:], start=start_counter + 1):
-        try:
-            print(f'{counter}/{len(urlname_list)} st user start fetching')
-            temp_df = get_user_all_notes(username=user, maxpage=maxpage, interval=interval)
-            
-            # 各ユーザーのデータを保存
-            save_user_data(temp_df, counter, query)
-            
-            # 中間結果を保存
-            save_checkpoint(counter, query)
-                
-        except Exception as e:
-            print(f"Error fetching data for user {user}. Error: {e}")
-    
-    # 最後の結果も保存
-
-    save_checkpoint(counter, query)
-    
-    print('Fetching has completed!')
+class UserPostSink:
+    """
+    ユーザーごとの記事を data/{query}/user_posts/part-{part}.ndjson に1記事1行で追記する．
+    ユーザーごとにCSVを作らず，取得しながら1つのログに書き足していく．
+    """
 
-def load_and_combine_user_data(query):
-    """保存されたユーザーデータをすべて読み込み、結合する関数"""
-    combined_df = pd.DataFrame()
+    def __init__(self, query, part='0'):
+        self.directory = user_posts_directory(query)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.path = os.path.join(self.directory, f'part-{part}.ndjson')
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def write(self, contents):
+        """記事の辞書のリストを，userを展開してから追記し，すぐにディスクへ書き出す"""
+        self._file.writelines(json.dumps(flatten_note(content), ensure_ascii=False) + '\n' for content in contents)
+        self._file.flush()
+        return len(contents)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def user_posts_directory(query):
+    """ユーザーごとの記事のログを置くディレクトリ"""
+    return f'data/{query}/user_posts'
+
+def iter_user_data(query, chunksize=10000):
+    """保存されたユーザーデータを chunksize 行ずつのDataFrameとして順に読み込む"""
+    directory = user_posts_directory(query)
+    if os.path.exists(directory):
+        for file in sorted(os.listdir(directory)):
+            if not file.endswith('.ndjson'):
+                continue
+            with open(os.path.join(directory, file), encoding='utf-8') as f:
+                records = []
+                for line in f:
+                    if not line.strip():
+                        continue
+                    records.append(json.loads(line))
+                    if len(records) >= chunksize:
+                        yield pd.DataFrame.from_records(records)
+                        records = []
+                if records:
+                    yield pd.DataFrame.from_records(records)
+
+    # 以前の形式（ユーザーごとのCSV）も読み込む
     data_directory = f'data/{query}/'
-    
-    # ディレクトリ内のすべてのファイルを取得
     files = [f for f in os.listdir(data_directory) if f.startswith('user_posts_') and f.endswith('.csv')]
-    
-    # 各ファイルを読み込み、データフレームに結合
     for file in files:
         file_path = os.path.join(data_directory, file)
-        
         # ファイルのサイズをチェックし、サイズが大きい場合のみ読み込む
         if os.path.getsize(file_path) > 1:
-            temp_df = pd.read_csv(file_path)
-            combined_df = pd.concat([combined_df, temp_df], axis=0, ignore_index=True)
+            yield flatten_user_column(pd.read_csv(file_path))
         else:
             print(f"Skipped empty file: {file_path}")
-    
-    return combined_df
 
-#######
+def get_all_post_per_user(data, maxpage=10000, interval=1, query='temp', start_at=None, backend='sync', n_workers=1, **fetcher_kwargs):
+    '''
+    ユーザーごとに全記事を取得して保存する．進み具合は data/{query}/crawl_jobs.db のジョブ表に保存し，
+    中断しても取得済みのユーザー・ページの続きから再開する．
+    n_workers > 1 なら複数のプロセスでユーザーを分担する（各プロセスが interval ごとにリクエストするので，全体の頻度は n_workers 倍になる）．
+    backend='async'のときは1つのプロセスで複数ユーザーを並行取得する．
+    start_atを指定すると，先頭からstart_at人を取得済みとして扱う．
+    fetcher_kwargs（rate, concurrency, detail_policy など）は記事本文の並行取得に使う．
+    '''
+    # ユーザーURLの重複を削除する（最初に現れた順を保つので，実行のたびに同じ順番になる）
+    urlname_list = list(dict.fromkeys(data['urlname'].tolist()))
+
+    with crawl_jobs.CrawlJobs(crawl_jobs.crawl_jobs_path(query)) as jobs:
+        added = jobs.add_users(urlname_list, done=urlname_list[:start_at] if start_at else ())
+        print(f'{added} users added to the crawl jobs: {jobs.progress()}')
+
+    if backend == 'async':
+        get_all_post_per_user_async(query, maxpage=maxpage, **fetcher_kwargs)
+    elif n_workers <= 1:
+        crawl_users(query, maxpage=maxpage, interval=interval, **fetcher_kwargs)
+    else:
+        # 子プロセスは新しく起動し（SQLiteの接続を引き継がない），親と同じディスクキャッシュの設定を使う
+        cache = http_session.get_cache()
+        with ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_crawl_worker,
+            initargs=(cache.path if cache is not None else response_cache.DEFAULT_CACHE_PATH, cache is not None),
+        ) as executor:
+            futures = [executor.submit(_crawl_users_in_pool, i, query, maxpage, interval, **fetcher_kwargs) for i in range(n_workers)]
+            for future in futures:
+                future.result()
+
+    with crawl_jobs.CrawlJobs(crawl_jobs.crawl_jobs_path(query)) as jobs:
+        print(f'Fetching has completed! {jobs.progress()}')
+
+def _init_crawl_worker(cache_path, cache_enabled):
+    http_session.configure_cache(cache_path, enabled=cache_enabled)
+
+def _crawl_users_in_pool(index, query, maxpage, interval, **fetcher_kwargs):
+    # ワーカーIDは子プロセスのプロセスIDから作る
+    crawl_users(query, maxpage=maxpage, interval=interval, worker=crawl_jobs.worker_id(index), **fetcher_kwargs)
+
+def crawl_users(query, maxpage=10000, interval=1, worker=None, detail_policy=None, **fetcher_kwargs):
+    '''
+    ジョブ表からユーザーを1人ずつ割り当てて取得し，data/{query}/user_posts/part-{worker}.ndjson に書く．
+    workerを省略すると crawl_jobs.worker_id() を使う（別々に起動したプロセスでも重ならない）．
+    ページを書き終えるたびにジョブ表へ記録するので，途中で止まっても次は続きのページから取得する．
+    fetcher_kwargs は記事本文の取得（get_user_all_notes）に渡す．
+    '''
+    worker = worker if worker is not None else crawl_jobs.worker_id()
+    detail_policy = detail_policy if detail_policy is not None else note_details.DetailPolicy()
+    with crawl_jobs.CrawlJobs(crawl_jobs.crawl_jobs_path(query)) as jobs, UserPostSink(query, part=worker) as sink:
+        try:
+            while True:
+                claimed = jobs.claim(worker)
+                if not claimed:
+                    break
+                job = claimed[0]
+
+                def on_page(numpage, contents, username=job.username):
+                    # 書き出してから進捗を記録する（記録の前に止まったページは取り直し，重複は読み込み時に除く）
+                    sink.write(contents)
+                    jobs.record_page(username, numpage, contents[-1]['key'] if contents else None, len(contents))
+
+                try:
+                    print(f'[worker {worker}] user {job.position + 1} ({job.username}) start fetching from page {job.next_page}')
+                    get_user_all_notes(username=job.username, maxpage=maxpage, interval=interval,
+                                       start_page=job.next_page, on_page=on_page,
+                                       detail_policy=detail_policy, **fetcher_kwargs)
+                    jobs.complete(job.username)
+                except Exception as e:
+                    print(f"Error fetching data for user {job.username}. Error: {e}")
+                    jobs.fail(job.username, e)
+        finally:
+            # 中断したときに割り当てたままのユーザーを他のプロセスが取れるようにする
+            jobs.release(worker)
+            print(f'[worker {worker}] note details: {detail_policy.stats()}')
+
+def get_all_post_per_user_async(query, maxpage=10000, **fetcher_kwargs):
+    '''ジョブ表の未処理のユーザーを並行取得する．ユーザーは取得済みのページの続きから取得する'''
+    worker = crawl_jobs.worker_id('async')
+    with crawl_jobs.CrawlJobs(crawl_jobs.crawl_jobs_path(query)) as jobs, UserPostSink(query, part=worker) as sink:
+        claimed = jobs.claim(worker, limit=-1)
+
+        def on_user_done(index, user, contents, error):
+            if error is None:
+                # 各ユーザーのデータを保存
+                sink.write(contents)
+                jobs.complete(user, n_notes=len(contents), last_note_key=contents[-1]['key'] if contents else None)
+            else:
+                print(f"Error fetching data for user {user}. Error: {error}")
+                jobs.fail(user, error)
 
+        print(f'{len(claimed)} users start fetching')
+        try:
+            fetch_engine.fetch_users_notes(
+                [job.username for job in claimed], on_user_done, maxpage=maxpage,
+                start_pages=[job.next_page for job in claimed], **fetcher_kwargs)
+        finally:
+            jobs.release(worker)
+
+def iter_unique_user_data(query, chunksize=10000):
+    """iter_user_data と同じだが，再開時に書き足された同じ記事（key）を除く"""
+    seen_keys = set()
+    for chunk in iter_user_data(query, chunksize=chunksize):
+        if 'key' in chunk.columns:
+            # 既出のkeyの集合は大きくなるので，isinに渡さず集合の検索で判定する
+            keep = []
+            for key in chunk['key'].tolist():
+                keep.append(key not in seen_keys)
+                seen_keys.add(key)
+            chunk = chunk[keep]
+        if not chunk.empty:
+            yield chunk
+
+def load_and_combine_user_data(query, chunksize=10000):
+    """保存されたユーザーデータをすべて読み込み、結合する関数"""
+    # 読み込んだ塊はリストに貯め，最後に一度だけ結合する（ループ内でconcatすると二乗のコピーになる）
+    chunks = list(iter_unique_user_data(query, chunksize=chunksize))
+    if not chunks:
+        return pd.DataFrame()
+    return pd.concat(chunks, axis=0, ignore_index=True)
 
+#######
 
-def select_columns(user_df):
-    select_columns = ['id','user_id','status','type','key','slug','name','body','created_at','can_read']
-    usercolumns = ['key','urlname','nickname','note_count','created_at']
 
-    selected_df = user_df[select_columns]
-    selected_df = selected_df.reset_index(drop=True)
 
-    user_info_dict = {key:[ast.literal_eval(user_df['user'].iloc[row])[key] for row in range(len(user_df))] for key in usercolumns}
-    user_info_df = pd.DataFrame(user_info_dict)
-    user_info_df = user_info_df.rename(columns={'key':'user_key','created_at':'user_created_at'})
-    user_info_df = user_info_df.reset_index(drop=True)
+# select_columnsで残す記事の列と，ネストしたuserから取り出す列（userの列名 -> 出力の列名）
+NOTE_COLUMNS = note_details.NOTE_COLUMNS
+USER_COLUMNS = note_details.USER_COLUMNS
 
-    selected_df_adduserinfo = pd.concat([selected_df,user_info_df],axis=1)
+def flatten_note(note):
+    """APIの記事データのネストしたuserを，user_key・urlnameなどの列に展開する"""
+    flat = {key: value for key, value in note.items() if key != 'user'}
+    user = note.get('user') or {}
+    for key, column in USER_COLUMNS.items():
+        flat[column] = user.get(key)
+    return flat
 
-    return selected_df_adduserinfo
+def select_columns(user_df):
+    '''記事の列とユーザー情報の列を選ぶ．取得時に flatten_note で展開済みならそのまま選ぶだけ'''
+    output_columns = NOTE_COLUMNS + list(USER_COLUMNS.values())
+    if 'user' not in user_df.columns:
+        return user_df[output_columns].reset_index(drop=True)
+
+    # 以前の形式：userが辞書を文字列にしたものとして保存されている
+    return flatten_user_column(user_df)[output_columns].reset_index(drop=True)
+
+def flatten_user_column(user_df):
+    """以前の形式のuser列（辞書を文字列にしたもの）を展開する．1行につき一度だけ解析する"""
+    users = [user if isinstance(user, dict) else ast.literal_eval(user) for user in user_df['user'].tolist()]
+    user_info_df = pd.DataFrame.from_records(
+        [[user.get(key) for key in USER_COLUMNS] for user in users],
+        columns=list(USER_COLUMNS.values()),
+        index=user_df.index,
+    )
+    return pd.concat([user_df.drop(columns=['user']), user_info_df], axis=1)
 
 #######
 # クエリデータの操作に関わる
@@ -301,66 +476,77 @@ def load_query_keys(query_key_path='data/query_key.csv'):
 #######
 # main関数
 #######
-def main(query, size=50, batches = 10000, interval=1, query_keys=None):
-    
-    directory = f'data/{query}'
-    # 指定したディレクトリが存在するか確認します。
-    if not os.path.exists(directory):
-        # 存在しない場合、ディレクトリを作成します。
-        os.makedirs(directory)
-
-    # クエリを指定して，クエリに該当する記事を全件取得
-    query_all = fetch_multiple_batches(query=query, size=size, batches=batches, interval=interval)
-    print(f'fetching all articles by query has completed!')
-    # 生データを保存
-    with open(f'data/{query}/{query}_fetched_query_raw.json','w') as file:
-        json.dump(query_all,file)
-    print(f'all articles by query has saved')
-    # データフレーム形式にする
-    query_df = extract_data_to_dataframe(query_all)
-    query_df.to_csv(f'data/{query}/{query}_fetchtd_df.csv')
-
-    # query keysの読み込み
-    loaded_query_keys = load_query_keys()
-    print(f'query keys has loaded!')
-
-    # query_dfからload_query_keysに含まれていないものを抽出
-    query_df = query_df[~query_df['key'].isin(loaded_query_keys['key'])]
-    print(f'query keys has extracted!')
-
-    # queryごとの全文記事全件取得, デフォルトでは動かない
-    if query_keys:
-        query_keys_all = fetch_articles_by_keys(data=query_all,interval=interval)
-        print(f'fetching all articles by keys has completed!')
-        query_keys_all.to_csv(f'data/{query}/{query}_fetched_query_keys_all_raw.csv')
-        print(f'all articles by keys has saved')
-
-    # ユーザーごとの記事を取得する
-    print(f'sart fetchnig all user post')
-    get_all_post_per_user(data=query_df,interval=interval,query=query)
-    print(f'fetching all user post has completed!')
-    # ユーザー情報を抽出
-    all_user_data = load_and_combine_user_data(query)
-
-    all_user_data.to_csv(f'data/{query}/{query}_fetched_user_all_post_raw.csv')
+def main(query, size=50, batches = 10000, interval=1, query_keys=None, use_cache=True):
+    # 取得済みの記事はディスクキャッシュ（data/cache）から読む．use_cache=Falseならこの実行の間だけ使わない
+    with http_session.use_cache(use_cache):
+        directory = f'data/{query}'
+        # 指定したディレクトリが存在するか確認します。
+        if not os.path.exists(directory):
+            # 存在しない場合、ディレクトリを作成します。
+            os.makedirs(directory)
+
+        # クエリを指定して，クエリに該当する記事を全件取得
+        query_all = fetch_multiple_batches(query=query, size=size, batches=batches, interval=interval)
+        print(f'fetching all articles by query has completed!')
+        # 生データを保存
+        with open(f'data/{query}/{query}_fetched_query_raw.json','w') as file:
+            json.dump(query_all,file)
+        print(f'all articles by query has saved')
+        # データフレーム形式にする
+        query_df = extract_data_to_dataframe(query_all)
+        corpus_storage.write_table(query_df, query, 'search_results')
+
+        # query keysの読み込み
+        loaded_query_keys = load_query_keys()
+        print(f'query keys has loaded!')
+
+        # query_dfからload_query_keysに含まれていないものを抽出
+        query_df = query_df[~query_df['key'].isin(loaded_query_keys['key'])]
+        print(f'query keys has extracted!')
+
+        # queryごとの全文記事全件取得, デフォルトでは動かない
+        if query_keys:
+            query_keys_all = fetch_articles_by_keys(data=query_all,interval=interval)
+            print(f'fetching all articles by keys has completed!')
+            corpus_storage.write_table(query_keys_all, query, 'query_keys_raw')
+            print(f'all articles by keys has saved')
+
+        # ユーザーごとの記事を取得する
+        print(f'sart fetchnig all user post')
+        get_all_post_per_user(data=query_df,interval=interval,query=query)
+        print(f'fetching all user post has completed!')
+        # ユーザー情報を抽出
+        # 生データは塊ごとに書き足し，必要な列だけをメモリに残す
+        selected_chunks = []
+        offset = 0
+        with corpus_storage.TableWriter(query, 'raw_user_posts', as_text=True) as raw_writer:
+            for chunk in iter_unique_user_data(query):
+                chunk.index = range(offset, offset + len(chunk))
+                offset += len(chunk)
+                raw_writer.write(chunk)
+                selected_chunks.append(select_columns(chunk))
     
-    print(f'all user post has saved')
+        print(f'all user post has saved')
 
 
-    # 抽出
-    selected_all_user_data = select_columns(all_user_data)
-    selected_all_user_data.to_csv(f'data/{query}/{query}_user_all_post_df.csv')
+        # 抽出
+        selected_all_user_data = pd.concat(selected_chunks, axis=0, ignore_index=True) if selected_chunks else pd.DataFrame()
+        corpus_storage.write_table(selected_all_user_data, query, 'user_posts')
 
-    print(f'selected all user data has saved!')
+        print(f'selected all user data has saved!')
 
-    add_query_keys(selected_all_user_data)
-    print(f'query keys has added!')
+        add_query_keys(selected_all_user_data)
+        print(f'query keys has added!')
     
-    # queryに合致するものを保存
-    query_keys_all_df = selected_all_user_data[
-        selected_all_user_data['id'].isin(list(query_df['note_id']))
-        ]
-    query_keys_all_df.to_csv(f'data/{query}/{query}_fetched_query_keys_all_df.csv')
-    print(f'all articles mattched with query searched by keys has saved')
-
-    return query_keys_all_df, selected_all_user_data
\ No newline at end of file
+        # queryに合致するものを保存
+        query_keys_all_df = selected_all_user_data[
+            selected_all_user_data['id'].isin(list(query_df['note_id']))
+            ]
+        corpus_storage.write_table(query_keys_all_df, query, 'query_notes')
+        print(f'all articles mattched with query searched by keys has saved')
+
+        cache = http_session.get_cache()
+        if cache is not None:
+            print(f'cache stats: {cache.stats()}')
+
+        return query_keys_all_df, selected_all_user_data
\ No newline at end of file
@@ -0,0 +1,254 @@
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from my_codes import http_session
+from my_codes import note_details
+from my_codes import response_cache
+
+#######
+# note.com APIのエンドポイント
+#######
+DEFAULT_BASE_URL = 'https://note.com'
+BASE_URL = DEFAULT_BASE_URL
+SEARCH_URL = BASE_URL + '/api/v3/searches'
+NOTE_URL = BASE_URL + '/api/v3/notes/{key}'
+CREATOR_CONTENTS_URL = BASE_URL + '/api/v2/creators/{username}/contents'
+
+
+def set_base_url(base_url=None):
+    """エンドポイントの接続先を変える（ベンチマーク用のローカルのサーバーなど）．Noneでnote.comに戻す"""
+    global BASE_URL, SEARCH_URL, NOTE_URL, CREATOR_CONTENTS_URL
+    BASE_URL = (base_url or DEFAULT_BASE_URL).rstrip('/')
+    SEARCH_URL = BASE_URL + '/api/v3/searches'
+    NOTE_URL = BASE_URL + '/api/v3/notes/{key}'
+    CREATOR_CONTENTS_URL = BASE_URL + '/api/v2/creators/{username}/contents'
+
+# 再試行してよいステータスコード（これ以外の4xxはすぐに諦める）
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class FetchError(Exception):
+    """再試行しても取得できなかった，または再試行できないエラーで失敗したリクエスト"""
+
+    def __init__(self, url, status_code=None, message=''):
+        self.url = url
+        self.status_code = status_code
+        super().__init__(f'{url}: {message or status_code}')
+
+
+#######
+# 全体で共有するトークンバケット
+#######
+class TokenBucket:
+    """rate（リクエスト/秒）を上限に，burst個までのまとまったリクエストを許すレートリミッター"""
+
+    def __init__(self, rate, burst=1):
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self):
+        """トークンを1つ取得するまで待つ．ロックで順番を守るので，待ち時間は公平に割り当てられる"""
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+
+#######
+# 非同期の取得エンジン
+#######
+class AsyncFetcher:
+    """
+    同時実行数を制限しつつ，共有のトークンバケットでリクエスト頻度を抑えてnote.comから取得する．
+    HTTP通信はrequestsをスレッドで実行し，イベントループ側で並行数と頻度を管理する．
+    """
+
+    def __init__(self, rate=4.0, burst=1, concurrency=8, max_retries=5,
+                 backoff_factor=1.0, max_backoff=60.0, timeout=10, detail_policy=None):
+        self.limiter = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        # ユーザーの記事一覧から本文を取得するかどうかの方針
+        self.detail_policy = detail_policy if detail_policy is not None else note_details.DetailPolicy()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        # 共有セッションのコネクションプールを同時実行数に合わせる
+        http_session.get_session(pool_maxsize=max(concurrency, http_session.DEFAULT_POOL_MAXSIZE))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def _backoff(self, attempt, retry_after=None):
+        """指数バックオフにジッターを加えた待ち時間．Retry-Afterがあればそれ以上待つ"""
+        delay = min(self.max_backoff, self.backoff_factor * (2 ** attempt))
+        delay = random.uniform(delay / 2, delay)
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        return delay
+
+    def _get(self, url, params, cache_key=None, ttl=None, cache_entry=None):
+        if cache_key is None:
+            return http_session.get(url, params=params, timeout=self.timeout)
+        return http_session.get(url, params=params, timeout=self.timeout,
+                                cache_key=cache_key, ttl=ttl, cache_entry=cache_entry)
+
+    async def get_json(self, url, params=None, cache_key=None, ttl=response_cache.NOTE_TTL):
+        """URLをJSONで取得する．再試行できるエラーのみジッター付きバックオフで再試行する．
+        cache_keyを指定すると先にディスクキャッシュを引き，ヒットすればレート制限も受けずに返す"""
+        cache_entry = None
+        if cache_key is not None:
+            cached, cache_entry = http_session.lookup_cache(cache_key, url)
+            if cached is not None:
+                return cached.json()
+
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries):
+            async with self._semaphore:
+                await self.limiter.acquire()
+                try:
+                    response = await loop.run_in_executor(
+                        self._executor, self._get, url, params, cache_key, ttl, cache_entry)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    print(f'Network error: {e}. Retrying...')
+                    response = None
+
+            if response is not None:
+                if response.status_code == 200:
+                    return response.json()
+                if response.status_code not in RETRYABLE_STATUS:
+                    raise FetchError(url, response.status_code)
+                print(f'HTTP {response.status_code} for {url}. Retrying...')
+                retry_after = response.headers.get('Retry-After')
+            else:
+                retry_after = None
+
+            # 最後の試行の後は待たない．待っている間はセマフォを離し，他のリクエストを進める
+            if attempt < self.max_retries - 1:
+                await asyncio.sleep(self._backoff(attempt, retry_after))
+        raise FetchError(url, message='Max retries reached.')
+
+    async def fetch_search_pages(self, query, size=1, batches=1):
+        """検索結果をページ単位で並行取得する．空のページが出たらそれ以降は取得しない"""
+        all_articles = []
+        # 同時実行数ぶんのページをまとめて取得し，空のページが現れるまで繰り返す
+        for window_start in range(0, batches, self.concurrency):
+            pages = range(window_start, min(batches, window_start + self.concurrency))
+            results = await asyncio.gather(*[
+                self.get_json(SEARCH_URL, params={'context': 'note', 'q': query, 'size': size, 'start': i * size})
+                for i in pages
+            ], return_exceptions=True)
+            for i, data in zip(pages, results):
+                if isinstance(data, Exception):
+                    print(f'Failed to retrieve articles: {data}')
+                    return all_articles
+                contents = data.get('data', {}).get('notes', {}).get('contents', [])
+                if not contents:
+                    return all_articles
+                all_articles.extend(contents)
+            print(f'{pages[-1] + 1}/{batches} has been fetched')
+        return all_articles
+
+    async def fetch_notes_by_keys(self, keys):
+        """keyのリストから全文を並行取得する．順番はkeysと同じ"""
+        results = await asyncio.gather(*[
+            self.get_json(NOTE_URL.format(key=key), cache_key=response_cache.note_cache_key(key))
+            for key in keys
+        ])
+        return [data['data'] for data in results]
+
+    async def fetch_user_notes(self, username, maxpage=10000, start_page=1):
+        """ユーザーの全記事を取得する．一覧のページは順番に，各ページの記事本文は一覧で足りないものだけを並行に取得する"""
+        all_contents = []
+        for numpage in range(start_page, maxpage + 1):
+            url = CREATOR_CONTENTS_URL.format(username=username)
+            user_data_json = await self.get_json(
+                url, params={'kind': 'note', 'page': numpage},
+                cache_key=response_cache.contents_cache_key(username, numpage), ttl=response_cache.CONTENTS_TTL)
+            contents = user_data_json['data']['contents']
+            if not contents:
+                print(f'{username}: page {numpage} is empty, finishing process!')
+                break
+            notes, missing = self.detail_policy.plan(contents)
+            all_contents.extend(self.detail_policy.fill(notes, await self.fetch_notes_by_keys(missing) if missing else []))
+        return all_contents
+
+
+def run(coro):
+    """コルーチンを実行する．Jupyterのようにイベントループが動いている場合は別スレッドで実行する"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+#######
+# fetch_articles から使う同期的な入口
+#######
+def fetch_multiple_batches(query, size=1, batches=1, **fetcher_kwargs):
+    """fetch_articles.fetch_multiple_batches の非同期版"""
+    async def _run():
+        async with AsyncFetcher(**fetcher_kwargs) as fetcher:
+            return await fetcher.fetch_search_pages(query, size=size, batches=batches)
+    return run(_run())
+
+def fetch_articles_by_keys(keys, **fetcher_kwargs):
+    """fetch_articles.fetch_articles_by_keys の非同期版"""
+    async def _run():
+        async with AsyncFetcher(**fetcher_kwargs) as fetcher:
+            return await fetcher.fetch_notes_by_keys(keys)
+    return run(_run())
+
+def fetch_users_notes(usernames, on_user_done, maxpage=10000, start_pages=None, **fetcher_kwargs):
+    """
+    複数ユーザーの全記事を並行取得する．ユーザーごとに取得が終わった順に
+    on_user_done(index, username, contents, error) を呼ぶ（errorは失敗時の例外，成功時はNone）．
+    start_pagesを指定すると，ユーザーごとにそのページから取得する．
+    """
+    start_pages = start_pages or [1] * len(usernames)
+    async def _run():
+        async with AsyncFetcher(**fetcher_kwargs) as fetcher:
+            # 同時に取得中のユーザー数も制限し，途中結果を抱えすぎないようにする
+            user_semaphore = asyncio.Semaphore(fetcher.concurrency)
+
+            async def _fetch_one(index, username):
+                async with user_semaphore:
+                    try:
+                        contents = await fetcher.fetch_user_notes(username, maxpage=maxpage, start_page=start_pages[index])
+                        return index, username, contents, None
+                    except Exception as e:
+                        return index, username, None, e
+
+            tasks = [asyncio.create_task(_fetch_one(i, u)) for i, u in enumerate(usernames)]
+            for finished in asyncio.as_completed(tasks):
+                on_user_done(*(await finished))
+    run(_run())
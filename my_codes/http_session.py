@@ -0,0 +1,267 @@
+import threading
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from my_codes import response_cache
+
+#######
+# note.com への接続を使い回すための共有セッション
+#######
+# (接続タイムアウト, 読み込みタイムアウト) 秒
+DEFAULT_TIMEOUT = (5, 30)
+DEFAULT_POOL_MAXSIZE = 16
+
+DEFAULT_HEADERS = {
+    'Accept': 'application/json',
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive',
+}
+
+_session = None
+_pool_maxsize = 0
+_session_lock = threading.Lock()
+
+
+def get_session(pool_maxsize=DEFAULT_POOL_MAXSIZE):
+    """
+    共有セッションを返す．コネクションプールがpool_maxsizeより小さければ作り直す．
+    前のセッションは他のスレッドが使っている途中かもしれないので閉じず，使われなくなったら解放される．
+    """
+    global _session, _pool_maxsize
+    with _session_lock:
+        if _session is None or pool_maxsize > _pool_maxsize:
+            session = requests.Session()
+            session.headers.update(DEFAULT_HEADERS)
+            # 再試行は呼び出し側で行うので，アダプターでは再試行しない
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=0)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+            _pool_maxsize = pool_maxsize
+        return _session
+
+
+def close_session():
+    """共有セッションを閉じる"""
+    global _session, _pool_maxsize
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        _pool_maxsize = 0
+
+
+#######
+# ETag / Last-Modified を使った条件付きリクエスト
+#######
+DEFAULT_VALIDATOR_PATH = 'data/cache/validators.db'
+
+
+class ValidatorStore:
+    """
+    URLごとにETag・Last-Modifiedと本文を response_cache.ResponseCache に保存するので，プロセスをまたいで使える．
+    本文はTTL 0（常に期限切れ）で保存し，条件付きリクエストで変わっていないと確かめたときだけ使う．
+    合計サイズが max_bytes を超えたら，最後に使われたのが古いものから追い出される．
+    """
+
+    def __init__(self, path=DEFAULT_VALIDATOR_PATH, max_bytes=response_cache.DEFAULT_MAX_BYTES // 4):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._cache = None
+        self._lock = threading.Lock()
+        self.not_modified = 0
+
+    def _store(self):
+        """保存先を初めて使うときに開く"""
+        with self._lock:
+            if self._cache is None:
+                self._cache = response_cache.ResponseCache(self.path, max_bytes=self.max_bytes)
+            return self._cache
+
+    @staticmethod
+    def _key(url):
+        return f'url:{url}'
+
+    def headers_for(self, url):
+        """条件付きリクエストに付けるヘッダーを返す"""
+        entry = self._store().lookup(self._key(url))
+        if entry is None:
+            return {}
+        headers = {}
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def update(self, url, response):
+        """200のレスポンスから検証子と本文を記録する"""
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not (etag or last_modified):
+            return
+        self._store().put(self._key(url), response.content, 0, etag=etag, last_modified=last_modified)
+
+    def restore(self, url, response):
+        """304のレスポンスに保持している本文を戻し，200として扱えるようにする．本文がなければFalse"""
+        entry = self._store().lookup(self._key(url))
+        if entry is None:
+            return False
+        with self._lock:
+            self.not_modified += 1
+        response.status_code = 200
+        response._content = entry.content
+        response.not_modified = True
+        return True
+
+    def clear(self):
+        self._store().clear()
+
+    def close(self):
+        with self._lock:
+            if self._cache is not None:
+                self._cache.close()
+                self._cache = None
+
+
+validators = ValidatorStore()
+
+
+@contextmanager
+def use_validators(store):
+    """with文の間だけ条件付きリクエストの検証子を store に保存し，抜けると store を閉じて前の保存先に戻す"""
+    global validators
+    with _session_lock:
+        saved, validators = validators, store
+    try:
+        yield store
+    finally:
+        with _session_lock:
+            validators = saved
+        store.close()
+
+
+#######
+# ディスクキャッシュ（response_cache）との連携
+#######
+_cache = None
+_cache_enabled = True
+_NOT_LOOKED_UP = object()
+
+
+def configure_cache(path=response_cache.DEFAULT_CACHE_PATH, enabled=True, **kwargs):
+    """ディスクキャッシュの保存先や上限を設定する．enabled=Falseでキャッシュを使わない"""
+    global _cache, _cache_enabled
+    with _session_lock:
+        if _cache is not None:
+            _cache.close()
+        _cache = response_cache.ResponseCache(path, **kwargs) if enabled else None
+        _cache_enabled = enabled
+
+
+@contextmanager
+def use_cache(enabled=True):
+    """
+    with文の間だけディスクキャッシュを使うかを切り替え，抜けると前の設定に戻す．
+    enabled=Trueなら今の設定のまま．使わない間も前のキャッシュは閉じずに取っておく．
+    """
+    global _cache, _cache_enabled
+    if enabled:
+        yield
+        return
+    with _session_lock:
+        saved = (_cache, _cache_enabled)
+        _cache, _cache_enabled = None, False
+    try:
+        yield
+    finally:
+        with _session_lock:
+            _cache, _cache_enabled = saved
+
+
+def get_cache():
+    """ディスクキャッシュを返す．初めて使うときに既定の場所に作る"""
+    global _cache
+    if not _cache_enabled:
+        return None
+    if _cache is None:
+        with _session_lock:
+            if _cache is None:
+                _cache = response_cache.ResponseCache()
+    return _cache
+
+
+def _cached_response(url, content, not_modified=False):
+    """キャッシュの本文から200のレスポンスを作る"""
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response._content = content
+    response.encoding = 'utf-8'
+    response.from_cache = True
+    response.not_modified = not_modified
+    return response
+
+
+def lookup_cache(cache_key, url=''):
+    """
+    キャッシュを引く．(レスポンス, エントリ) を返し，TTL内ならレスポンスに本文が入る．
+    TTL切れのエントリは get(..., cache_entry=entry) に渡すと再検証に使われる．
+    """
+    cache = get_cache()
+    if cache is None:
+        return None, None
+    content, entry = cache.get(cache_key)
+    if content is not None:
+        return _cached_response(url, content), entry
+    return None, entry
+
+
+def get(url, params=None, timeout=DEFAULT_TIMEOUT, conditional=True,
+        cache_key=None, ttl=response_cache.NOTE_TTL, cache_entry=_NOT_LOOKED_UP, **kwargs):
+    """
+    共有セッションでGETする．conditional=Trueなら前回のETag/Last-Modifiedを送り，
+    304が返ってきたら前回の本文を入れたレスポンス（status_code=200, not_modified=True）を返す．
+    cache_keyを指定するとディスクキャッシュを先に引き，TTL内なら通信しない．
+    """
+    cache = get_cache() if cache_key else None
+    if cache is not None and cache_entry is _NOT_LOOKED_UP:
+        cached, cache_entry = lookup_cache(cache_key, url)
+        if cached is not None:
+            return cached
+
+    session = get_session()
+    extra_headers = kwargs.pop('headers', None)
+    headers = dict(extra_headers or {})
+    if cache is not None:
+        # キャッシュにTTL切れの本文があれば，その検証子で条件付きリクエストにする
+        if conditional and cache_entry is not None:
+            if cache_entry.etag:
+                headers['If-None-Match'] = cache_entry.etag
+            if cache_entry.last_modified:
+                headers['If-Modified-Since'] = cache_entry.last_modified
+    elif conditional:
+        full_url = requests.Request('GET', url, params=params).prepare().url
+        headers.update(validators.headers_for(full_url))
+
+    response = session.get(url, params=params, timeout=timeout, headers=headers, **kwargs)
+    response.not_modified = False
+    response.from_cache = False
+
+    if cache is not None:
+        if response.status_code == 304 and cache_entry is not None:
+            cache.touch(cache_key, ttl)
+            return _cached_response(response.url, cache_entry.content, not_modified=True)
+        if response.status_code == 200:
+            cache.put(cache_key, response.content, ttl,
+                      etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified'))
+    elif conditional:
+        if response.status_code == 304:
+            if not validators.restore(full_url, response):
+                # 本文がすでに捨てられていたら，条件なしで取り直す
+                return get(url, params=params, timeout=timeout, conditional=False, headers=extra_headers, **kwargs)
+        elif response.status_code == 200:
+            validators.update(full_url, response)
+    return response
@@ -1,11 +1,17 @@
+from functools import lru_cache
+
 import MeCab
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from my_codes.document_term_matrix import build_document_term_matrix, feature_names, parse_tokenized_body
 
 def main(file_path,text,hit_word_list=True):
-    jmfd = parse_dictionary_file(file_path)
+    matcher = load_matcher(file_path)
     wakati_base_list = wakati_base_form(text)
-    score =  calculate_score(wakati_base_list,jmfd['dictionary'])
+    score, hit_word = matcher.match(wakati_base_list)
     if hit_word_list:
-        hit_word = search_words(wakati_base_list,jmfd['dictionary'])
         return score, hit_word
     return score
 
@@ -33,15 +39,21 @@ def parse_dictionary_file(file_path):
     return {'examples': examples, 'dictionary': dictionary}
 
 
+@lru_cache(maxsize=None)
+def get_tagger(option=''):
+    '''MeCabのTaggerは生成が重いので，オプションごとに一度だけ作成して使い回す'''
+    return MeCab.Tagger(option)
+
 def wakati(text):
     '''分かち書きを行うための関数'''
-    mecab = MeCab.Tagger("-Owakati")
+    mecab = get_tagger("-Owakati")
     wakati_text = mecab.parse(text).strip()
     return wakati_text
 
-def wakati_base_form(text):
+def wakati_base_form(text, mecab=None):
     '''分かち書きを行い，原型で表示'''
-    mecab = MeCab.Tagger()
+    if mecab is None:
+        mecab = get_tagger()
     node = mecab.parseToNode(text)
     base_form_words = []
 
@@ -59,34 +71,189 @@ def wakati_base_form(text):
 
 def calculate_score(lst, dic):
     '''分かち書きされたリストと辞書を用いて，スコアを出す．'''
-    score = [0] * 11  # スコアを初期化
-    
-    for word in lst:
-        for key in dic.keys():
-            if key.endswith('*') and word.startswith(key[:-1]):  # '*'が付いた単語に対しては、前方一致をチェックする
-                score = [score[i] + dic[key][i] for i in range(11)]
-            elif word == key:
-                score = [score[i] + dic[key][i] for i in range(11)]
-    
+    score, _ = JMFDMatcher(dic).match(lst)
     return score
 
 def search_words(lst, dic):
     '''どの単語がヒットしたのかを検索する'''
-    result = {}
-    
-    for word in lst:
-        for key in dic.keys():
-            if key.endswith('*') and word.startswith(key[:-1]):  # '*'が付いた単語に対しては、前方一致をチェックする
-                if key in result:
-                    result[key][1] += 1
-                else:
-                    result[key] = [dic[key], 1]
-            elif word == key:
+    _, result = JMFDMatcher(dic).match(lst)
+    return result
+
+
+########
+# コンパイル済みの辞書マッチャー
+########
+_TERMINAL = None  # トライ木の終端を表すキー（1文字の文字列とは衝突しない）
+
+class JMFDMatcher:
+    '''JMFD辞書を一度だけコンパイルし，完全一致はハッシュ，前方一致（'*'付き）はトライ木で検索する．
+    calculate_score と search_words と同じ結果を一回の走査で返す．'''
+
+    def __init__(self, dictionary, foundations=None):
+        self.dictionary = dictionary
+        # スコアの各列（1〜11）の名前．辞書ファイルの見出しがあればそれを使う
+        self.foundations = foundations or [str(i) for i in range(1, 12)]
+        self._exact = {}
+        self._trie = {}
+        # 辞書の並び順を保持し，ヒットの順番を従来の実装と揃える
+        for order, (key, values) in enumerate(dictionary.items()):
+            entry = (order, key, values)
+            if key.endswith('*'):
+                node = self._trie
+                for char in key[:-1]:
+                    node = node.setdefault(char, {})
+                node.setdefault(_TERMINAL, []).append(entry)
+            else:
+                self._exact[key] = entry
+        self._cache = {}
+
+    @classmethod
+    def from_file(cls, file_path):
+        '''dictionary.txtから直接マッチャーを作成する'''
+        jmfd = parse_dictionary_file(file_path)
+        foundations = [jmfd['examples'].get(str(i), str(i)) for i in range(1, 12)]
+        return cls(jmfd['dictionary'], foundations=foundations)
+
+    def lookup(self, word):
+        '''単語にヒットする辞書エントリを辞書順のタプルで返す（結果は単語ごとにキャッシュする）'''
+        entries = self._cache.get(word)
+        if entries is not None:
+            return entries
+
+        matched = []
+        # '*'付きの見出し語は前方一致なので，単語の接頭辞をトライ木でたどる
+        node = self._trie
+        if _TERMINAL in node:
+            matched.extend(node[_TERMINAL])
+        for char in word:
+            node = node.get(char)
+            if node is None:
+                break
+            if _TERMINAL in node:
+                matched.extend(node[_TERMINAL])
+        # '*'なしの見出し語は完全一致
+        exact = self._exact.get(word)
+        if exact is not None:
+            matched.append(exact)
+        if len(matched) > 1:
+            matched.sort()
+
+        entries = tuple(matched)
+        self._cache[word] = entries
+        return entries
+
+    def match(self, lst):
+        '''分かち書きされたリストから，(スコア, ヒットした単語の辞書)を返す'''
+        score = [0] * 11
+        result = {}
+        # 同じ単語はまとめて数え，スコアには出現回数を掛けて足し込む
+        counts = {}
+        for word in lst:
+            counts[word] = counts.get(word, 0) + 1
+
+        for word, count in counts.items():
+            for _, key, values in self.lookup(word):
+                for i, value in enumerate(values):
+                    if value:
+                        score[i] += value * count
                 if key in result:
-                    result[key][1] += 1
+                    result[key][1] += count
                 else:
-                    result[key] = [dic[key], 1]
-    
-    return result
+                    result[key] = [values, count]
+
+        return score, result
+
+    def projection_matrix(self, vocabulary):
+        '''語彙（トークンのリスト）から，語彙数×11 のトークン→道徳基盤の疎行列を作成する'''
+        rows, cols, data = [], [], []
+        for row, word in enumerate(vocabulary):
+            for _, _, values in self.lookup(word):
+                for i, value in enumerate(values):
+                    if value:
+                        rows.append(row)
+                        cols.append(i)
+                        data.append(value)
+        # 同じトークンが複数の見出し語にヒットした場合は足し合わされる
+        return sparse.csr_matrix((data, (rows, cols)), shape=(len(vocabulary), 11), dtype=np.int64)
+
+    def hit_vector(self, vocabulary):
+        '''語彙の各トークンがヒットする見出し語の数を返す'''
+        return np.array([len(self.lookup(word)) for word in vocabulary], dtype=np.int64)
+
+
+@lru_cache(maxsize=None)
+def load_matcher(file_path):
+    '''辞書ファイルごとにコンパイル済みのマッチャーを使い回す'''
+    return JMFDMatcher.from_file(file_path)
+
+
+########
+# コーパス全体のスコアを疎行列の積で一括計算する
+########
+NORMALIZE_OPTIONS = (None, 'tokens', 'hits', 'l1', 'l2')
+
+def build_document_term_counts(tokenized_bodies):
+    '''トークンのリストの列から，文書×トークンの出現回数の疎行列と語彙（列の順のリスト）を作成する'''
+    X, vocabulary = build_document_term_matrix(tokenized_bodies)
+    return X, list(feature_names(vocabulary))
+
+def score_corpus(tokenized_bodies, matcher, normalize=None):
+    '''
+    コーパス全体のJMFDスコアを N×11 のNumPy配列で返す．
+    tokenized_bodiesは preprocessing.main が作る tokenized_body 列（リストまたは文字列化されたリスト）．
+    normalizeは None（ヒット数そのまま），'tokens'（文書のトークン数で割る），
+    'hits'（辞書にヒットした数で割る），'l1'，'l2'（スコアベクトルのノルムで割る）のいずれか．
+    '''
+    if normalize not in NORMALIZE_OPTIONS:
+        raise ValueError(f'normalize must be one of {NORMALIZE_OPTIONS}, got {normalize!r}')
+
+    X, vocabulary = build_document_term_counts(tokenized_bodies)
+    return score_matrix(X, vocabulary, matcher, normalize=normalize)
+
+def score_matrix(X, vocabulary, matcher, normalize=None):
+    '''
+    作成済みの文書-単語行列（document_term_matrix で保存したものなど）からJMFDスコアを計算する．
+    vocabularyは列の順のトークンのリスト，またはトークン -> 列番号の辞書．
+    '''
+    if normalize not in NORMALIZE_OPTIONS:
+        raise ValueError(f'normalize must be one of {NORMALIZE_OPTIONS}, got {normalize!r}')
+    if isinstance(vocabulary, dict):
+        vocabulary = list(feature_names(vocabulary))
+
+    # 語彙ごとに一度だけ辞書を引き，文書×語彙 と 語彙×道徳基盤 の積でスコアを求める
+    scores = np.asarray((X @ matcher.projection_matrix(vocabulary)).todense(), dtype=np.float64)
+
+    if normalize is None:
+        return scores
+    if normalize == 'tokens':
+        denominator = np.asarray(X.sum(axis=1)).ravel()
+    elif normalize == 'hits':
+        denominator = X @ matcher.hit_vector(vocabulary)
+    elif normalize == 'l1':
+        denominator = np.abs(scores).sum(axis=1)
+    else:
+        denominator = np.sqrt((scores ** 2).sum(axis=1))
+    denominator = np.asarray(denominator, dtype=np.float64)
+    # 0で割らないように，分母が0の文書はスコア0のままにする
+    return np.divide(scores, denominator[:, None], out=np.zeros_like(scores), where=denominator[:, None] > 0)
+
+def score_interned(corpus, matcher, normalize=None):
+    '''
+    token_interning.InternedCorpus のJMFDスコアを計算する．
+    辞書は語彙（トークンID）ごとに一度だけ引き，文書はトークンIDの行列として扱う．
+    '''
+    return score_matrix(corpus.document_term_matrix(), corpus.vocabulary.tokens, matcher, normalize=normalize)
 
+def score_dataframe(df, matcher, column='tokenized_body', normalize=None, id_columns=('key', 'urlname')):
+    '''preprocessing.main の出力（DataFrame）のスコアを計算し，キーとスコア列のDataFrameで返す'''
+    scores = score_corpus(df[column], matcher, normalize=normalize)
+    score_df = pd.DataFrame(scores, columns=matcher.foundations, index=df.index)
+    id_columns = [c for c in id_columns if c in df.columns]
+    return pd.concat([df[id_columns], score_df], axis=1).reset_index(drop=True)
 
+def score_notes_table(file_path, engine=None, normalize=None):
+    '''notesテーブルに保存されている tokenized_body のスコアを一括で計算する'''
+    if engine is None:
+        from my_codes.database_setting import Engine as engine
+    df = pd.read_sql('SELECT key, urlname, tokenized_body FROM notes', con=engine)
+    return score_dataframe(df, load_matcher(file_path), normalize=normalize)
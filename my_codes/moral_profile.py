@@ -0,0 +1,268 @@
+import itertools
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+from sklearn.cluster import MiniBatchKMeans
+
+from my_codes import corpus_storage
+from my_codes import jmfd_calculation
+
+########
+# ユーザーごとの道徳基盤プロファイルとモラルクラスター
+########
+# 記事ごとのJMFDスコアをurlnameごとに合計し，記事数で割った平均をユーザーのプロファイルにする．
+# 合計と記事数を持っておくので，新しくスコアを計算した記事は足すだけで反映できる．
+# 記事ごとのスコアも持っておき，スコアを計算し直した記事は前のスコアを引いてから足す（同じ記事を二重に数えない）．
+# ユーザーはMiniBatchKMeansでクラスタリングし，search_bodies が読むCSVに書き出す．
+
+DEFAULT_BATCH_SIZE = 4096
+
+
+def profile_path(query):
+    return f'data/{query}/{query}_moral_profiles.pkl'
+
+def cluster_path(query, n_clusters):
+    '''search_bodies.extract_bodies_on_moral_cluster が読むCSV'''
+    return f'data/{query}/{query}_data_MoralClusterIntegrated_{n_clusters}clusters.csv'
+
+
+def aggregate_by_user(urlnames, scores):
+    '''
+    記事ごとのスコア（N×基盤数）をユーザーごとに合計する．
+    ユーザーのコードで並べ替え，np.add.reduceat で区間ごとに一度に足す．
+    (ユーザー名の配列, 合計の配列, 記事数の配列) を返す（urlnameが欠けた記事は除く）．
+    '''
+    codes, users = pd.factorize(pd.Series(urlnames, copy=False))
+    scores = np.asarray(scores, dtype=np.float64)
+    valid = codes >= 0
+    if not valid.all():
+        codes, scores = codes[valid], scores[valid]
+    if len(codes) == 0:
+        return np.array([], dtype=object), np.zeros((0, scores.shape[1])), np.zeros(0, dtype=np.int64)
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    sums = np.add.reduceat(scores[order], starts, axis=0)
+    counts = np.diff(np.r_[starts, len(sorted_codes)])
+    return np.asarray(users, dtype=object)[sorted_codes[starts]], sums, counts
+
+
+class MoralProfiles:
+    '''
+    ユーザーごとのスコアの合計と記事数．update で記事のスコアを反映し，
+    fit_clusters / update_clusters でプロファイル（記事あたりの平均スコア）をクラスタリングする．
+    記事ごとのスコアとユーザー（note_keys の順）も持つ．配列は倍々に確保し，先頭の len(note_keys) 行だけを使う．
+    '''
+
+    def __init__(self, foundations):
+        self.foundations = list(foundations)
+        self.usernames = np.array([], dtype=object)
+        self.sums = np.zeros((0, len(self.foundations)))
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.kmeans = None
+        self.note_keys = []
+        self._note_users = np.zeros(0, dtype=np.int64)
+        self._note_scores = np.zeros((0, len(self.foundations)))
+        self._index = pd.Index([], dtype=object)
+        self._positions = {}
+
+    @classmethod
+    def from_scores(cls, score_df, foundations=None):
+        '''jmfd_calculation.score_dataframe の出力（urlnameとスコア列）から作る'''
+        foundations = foundations if foundations is not None else [c for c in score_df.columns if c not in ('key', 'urlname')]
+        profiles = cls(foundations)
+        profiles.update(score_df)
+        return profiles
+
+    def __len__(self):
+        return len(self.usernames)
+
+    def _user_rows(self, users):
+        '''ユーザー名の行番号を返す．まだいないユーザーは行を追加する'''
+        # 重複を除いたユーザーだけを索引で引く
+        codes, uniques = pd.factorize(pd.Series(users, copy=False))
+        rows = self._index.get_indexer(uniques)
+        new = rows < 0
+        if new.any():
+            rows[new] = np.arange(len(self.usernames), len(self.usernames) + new.sum())
+            self.usernames = np.concatenate([self.usernames, np.asarray(uniques, dtype=object)[new]])
+            self.sums = np.vstack([self.sums, np.zeros((new.sum(), len(self.foundations)))])
+            self.counts = np.concatenate([self.counts, np.zeros(new.sum(), dtype=np.int64)])
+            self._index = pd.Index(self.usernames)
+        return rows[codes]
+
+    def _reserve(self, n):
+        '''記事ごとの配列を n 行以上にする'''
+        if n <= len(self._note_users):
+            return
+        capacity = max(n, 2 * len(self._note_users), 1024)
+        note_users = np.zeros(capacity, dtype=np.int64)
+        note_scores = np.zeros((capacity, len(self.foundations)))
+        note_users[:len(self.note_keys)] = self._note_users[:len(self.note_keys)]
+        note_scores[:len(self.note_keys)] = self._note_scores[:len(self.note_keys)]
+        self._note_users, self._note_scores = note_users, note_scores
+
+    def update(self, score_df):
+        '''
+        記事のスコア（key・urlnameとスコア列）を反映する．まだ反映していない記事は足し，
+        反映済みの記事は前のスコアを引いてから足すので，同じ記事を何度渡しても1回分だけ数える．
+        更新したユーザーの行番号を返す．
+        '''
+        if 'key' not in score_df.columns:
+            raise ValueError("score_df must have a 'key' column")
+        score_df = score_df[score_df['urlname'].notnull()].drop_duplicates(subset='key', keep='last')
+        keys = score_df['key'].tolist()
+        scores = score_df[self.foundations].to_numpy(dtype=np.float64)
+        user_rows = self._user_rows(score_df['urlname'].to_numpy(dtype=object))
+
+        # 反映済みの記事は，前のスコアをそのユーザーから引く
+        positions = np.fromiter(map(self._positions.get, keys, itertools.repeat(-1)), dtype=np.int64, count=len(keys))
+        seen = positions >= 0
+        old_positions = positions[seen]
+        old_users, old_sums, old_counts = aggregate_by_user(
+            self._note_users[old_positions], self._note_scores[old_positions])
+        old_users = old_users.astype(np.int64)
+        self.sums[old_users] -= old_sums
+        self.counts[old_users] -= old_counts
+
+        # 記事ごとのスコアを書き換え，まだない記事は末尾に加える
+        new_keys = list(itertools.compress(keys, ~seen))
+        start = len(self.note_keys)
+        self._reserve(start + len(new_keys))
+        positions[~seen] = np.arange(start, start + len(new_keys))
+        self._positions.update(zip(new_keys, range(start, start + len(new_keys))))
+        self.note_keys.extend(new_keys)
+        self._note_users[positions] = user_rows
+        self._note_scores[positions] = scores
+
+        users, sums, counts = aggregate_by_user(user_rows, scores)
+        users = users.astype(np.int64)
+        # usersに重複はないので，そのまま足せる
+        self.sums[users] += sums
+        self.counts[users] += counts
+        return np.union1d(users, old_users)
+
+    def features(self, rows=None):
+        '''記事あたりの平均スコア（ユーザー×基盤）'''
+        sums = self.sums if rows is None else self.sums[rows]
+        counts = self.counts if rows is None else self.counts[rows]
+        return sums / np.maximum(counts, 1)[:, None]
+
+    def profiles(self):
+        '''urlname・記事数・平均スコアのDataFrame'''
+        df = pd.DataFrame(self.features(), columns=self.foundations)
+        df.insert(0, 'n_notes', self.counts)
+        df.insert(0, 'urlname', self.usernames)
+        return df
+
+    def fit_clusters(self, n_clusters=5, random_state=42, batch_size=DEFAULT_BATCH_SIZE, **kmeans_kwargs):
+        '''
+        全ユーザーのプロファイルを MiniBatchKMeans でクラスタリングし直し，クラスター番号を返す．
+        ユーザーがクラスター数より少なければクラスタリングせず None を返す（ユーザーが増えたら update で行う）．
+        '''
+        if len(self) < n_clusters:
+            print(f'{len(self)} users are fewer than {n_clusters} clusters. Skipping clustering.')
+            return None
+        self.kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=random_state, batch_size=batch_size,
+                                      n_init=3, **kmeans_kwargs)
+        self.kmeans.fit(self.features())
+        return self.labels()
+
+    def update_clusters(self, rows):
+        '''
+        更新したユーザー（update の戻り値）のプロファイルで partial_fit してクラスターの中心を動かし，
+        全ユーザーのクラスター番号を返す．まだクラスタリングしていなければ何もせず None を返す．
+        '''
+        if self.kmeans is None:
+            return None
+        rows = np.asarray(rows)
+        # partial_fit はクラスター数以上の行が必要なので，少ないときは中心だけを使って番号を付け直す
+        if len(rows) >= self.kmeans.n_clusters:
+            self.kmeans.partial_fit(self.features(rows))
+        return self.labels()
+
+    def labels(self):
+        return self.kmeans.predict(self.features())
+
+    def cluster_frame(self):
+        '''urlname・moral_cluster と，プロファイルの列のDataFrame'''
+        df = self.profiles()
+        df.insert(1, 'moral_cluster', self.labels())
+        return df
+
+    def save(self, path):
+        '''一時ファイルに書いてから置き換えるので，書き込み中に止まっても前のものが残る'''
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(f'{path}.tmp', 'wb') as f:
+            pickle.dump(self, f)
+        os.replace(f'{path}.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._index = pd.Index(self.usernames)
+        self._positions = {key: i for i, key in enumerate(self.note_keys)}
+
+    def __getstate__(self):
+        # 索引は読み込むときに作り直し，記事ごとの配列は使っている行だけを保存する
+        state = dict(self.__dict__)
+        del state['_index'], state['_positions']
+        state['_note_users'] = self._note_users[:len(self.note_keys)]
+        state['_note_scores'] = self._note_scores[:len(self.note_keys)]
+        return state
+
+
+def write_clusters(query, profiles):
+    '''クラスター番号をsearch_bodiesが読むCSVに書き出し，そのパスを返す'''
+    path = cluster_path(query, profiles.kmeans.n_clusters)
+    profiles.cluster_frame().to_csv(path, index=False)
+    return path
+
+
+########
+# メイン関数
+########
+def main(query, dictionary_path, n_clusters=5, normalize=None, random_state=42, batch_size=50000):
+    '''
+    前処理したデータの全記事のスコアを batch_size 件ずつ計算してユーザーごとに集計し，
+    ユーザーをクラスタリングして data/{query}/{query}_data_MoralClusterIntegrated_{n_clusters}clusters.csv に書き出す．
+    集計したプロファイルは profile_path(query) に保存し，update で新しい記事を足せる．
+    '''
+    matcher = jmfd_calculation.load_matcher(dictionary_path)
+    profiles = MoralProfiles(matcher.foundations)
+    for batch in corpus_storage.iter_table(query, 'preprocessed', columns=['key', 'urlname', 'tokenized_body'],
+                                           batch_size=batch_size):
+        profiles.update(jmfd_calculation.score_dataframe(batch, matcher, normalize=normalize))
+    profiles.fit_clusters(n_clusters, random_state=random_state)
+    profiles.save(profile_path(query))
+    if profiles.kmeans is not None:
+        write_clusters(query, profiles)
+    return profiles
+
+def update(query, score_df, n_clusters=None, random_state=42):
+    '''
+    新しく計算した記事のスコア（pipeline.stream の出力など）を保存済みのプロファイルに反映し，
+    クラスターを更新してCSVを書き直す．保存したものがなければ新しく作り，n_clusters でクラスタリングする．
+    '''
+    path = profile_path(query)
+    if os.path.exists(path):
+        profiles = MoralProfiles.load(path)
+        rows = profiles.update(score_df)
+        if profiles.kmeans is not None:
+            profiles.update_clusters(rows)
+    else:
+        profiles = MoralProfiles.from_scores(score_df)
+    if profiles.kmeans is None and n_clusters is not None:
+        profiles.fit_clusters(n_clusters, random_state=random_state)
+    profiles.save(path)
+    if profiles.kmeans is not None:
+        write_clusters(query, profiles)
+    return profiles
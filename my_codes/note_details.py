@@ -0,0 +1,154 @@
+import json
+
+from my_codes import http_session
+from my_codes import response_cache
+
+#######
+# 記事一覧から記事本文（/api/v3/notes/{key}）を取得するかどうかの方針
+#######
+# ユーザーの記事一覧（/api/v2/creators/{username}/contents）は記事ごとの情報をある程度含むので，
+# 一覧で必要な列がそろっている記事や，前回取得したときから更新されていない記事は本文を取得し直さない．
+
+# 記事の列と，ネストしたuserから取り出す列（userの列名 -> 出力の列名）．fetch_articles.select_columns で残す列
+NOTE_COLUMNS = ['id','user_id','status','type','key','slug','name','body','created_at','can_read']
+USER_COLUMNS = {'key':'user_key','urlname':'urlname','nickname':'nickname','note_count':'note_count','created_at':'user_created_at'}
+
+# 更新を判定する時刻の列（一覧と本文の両方にある最初の列で比べる）．
+# publish_at は編集しても変わらないので使わない
+TIMESTAMP_FIELDS = ('updated_at', 'body_updated_at')
+# 本文の長さの列．一覧にこの列があり，本文がその長さだけあるときだけ本文が切られていないとみなす
+BODY_LENGTH_FIELDS = ('body_length',)
+
+
+def _camel(name):
+    head, *rest = name.split('_')
+    return head + ''.join(word.capitalize() for word in rest)
+
+
+def _field(item, name, default=None):
+    """snake_case の列を引く．一覧のAPIは camelCase で返すことがあるので，そちらも見る"""
+    if name in item:
+        return item[name]
+    return item.get(_camel(name), default)
+
+
+def _has_field(item, name):
+    return name in item or _camel(name) in item
+
+
+def timestamp(item):
+    """記事の更新時刻（TIMESTAMP_FIELDSの最初にある列）を (列名, 値) で返す．なければNone"""
+    for name in TIMESTAMP_FIELDS:
+        value = _field(item, name)
+        if value is not None:
+            return name, value
+    return None
+
+
+class DetailPolicy:
+    """
+    記事一覧の1件ごとに，本文を取得せずに済むかを決める．
+    use_listing=Trueなら，一覧にNOTE_COLUMNSとuserの列がそろっていて，本文の長さの列から本文が切られていないと
+    確かめられる記事は一覧をそのまま使う（一覧の本文は省略されていることがあるので，既定では使わない）．
+    use_cache=Trueなら，ディスクキャッシュにある本文の更新時刻が一覧と同じ記事はキャッシュを使う（TTL切れでも通信しない）．
+    更新時刻が違う記事は，TTL内でも編集されたものとして取得し直す．
+    どちらでも決まらなかった記事だけを取得する．
+    """
+
+    def __init__(self, use_listing=False, use_cache=True, note_columns=NOTE_COLUMNS, user_columns=tuple(USER_COLUMNS)):
+        self.use_listing = use_listing
+        self.use_cache = use_cache
+        self.note_columns = list(note_columns)
+        self.user_columns = list(user_columns)
+        self.from_listing_count = 0
+        self.from_cache_count = 0
+        self.fetched_count = 0
+
+    def from_listing(self, item):
+        """一覧の1件で足りれば，本文と同じ形（snake_caseの列名）の辞書を返す．足りなければNone"""
+        if not all(_has_field(item, name) for name in self.note_columns):
+            return None
+        user = item.get('user')
+        if not isinstance(user, dict) or not all(_has_field(user, name) for name in self.user_columns):
+            return None
+        body = _field(item, 'body')
+        lengths = [_field(item, name) for name in BODY_LENGTH_FIELDS if _field(item, name) is not None]
+        # 本文の長さがわからなければ，切られていないと確かめられないので使わない
+        if body is None or not lengths or any(len(body) < length for length in lengths):
+            return None
+        note = dict(item)
+        for name in self.note_columns:
+            note[name] = _field(item, name)
+        note['user'] = dict(user, **{name: _field(user, name) for name in self.user_columns})
+        return note
+
+    def from_cache(self, item):
+        """
+        キャッシュにある本文の更新時刻が一覧と同じなら，その本文を返す（TTL切れでも使う）．違えばNone．
+        一覧に更新時刻がないときだけ，TTL内のキャッシュをそのまま使う．
+        """
+        cache = http_session.get_cache()
+        if cache is None:
+            return None
+        entry = cache.lookup(response_cache.note_cache_key(item['key']))
+        if entry is None:
+            return None
+        note = json.loads(entry.content)['data']
+        listed = timestamp(item)
+        if listed is None:
+            # 一覧に更新時刻がなければ比べられないので，TTL内のときだけキャッシュを使う
+            return note if entry.is_fresh() else None
+        # TTL内でも，一覧の更新時刻が違えば編集されているので取得し直す
+        if _field(note, listed[0]) != listed[1]:
+            return None
+        if not entry.is_fresh():
+            # 変わっていないと確認できたので，TTLを延ばしておく
+            cache.touch(entry.cache_key)
+        return note
+
+    def plan(self, items):
+        """
+        一覧の記事ごとに本文を決める．(記事のリスト, 取得が必要なkeyのリスト) を返し，
+        取得が必要な記事の位置はNoneにしておく（fill で埋める）．
+        """
+        notes = []
+        missing = []
+        for item in items:
+            note = self.from_listing(item) if self.use_listing else None
+            if note is not None:
+                self.from_listing_count += 1
+            elif self.use_cache:
+                note = self.from_cache(item)
+                if note is not None:
+                    self.from_cache_count += 1
+            if note is None:
+                missing.append(item['key'])
+            notes.append(note)
+        return notes, missing
+
+    def fill(self, notes, fetched):
+        """plan で None にした位置に，取得した本文を順番に入れる"""
+        fetched = iter(fetched)
+        for i, note in enumerate(notes):
+            if note is None:
+                notes[i] = next(fetched)
+                self.fetched_count += 1
+        return notes
+
+    def stats(self):
+        """一覧・キャッシュで済んだ件数と，取得した件数"""
+        return {
+            'from_listing': self.from_listing_count,
+            'from_cache': self.from_cache_count,
+            'fetched': self.fetched_count,
+        }
+
+
+def resolve(items, fetch_many, policy=None):
+    """
+    一覧の記事の本文を返す．policyで決まらなかった記事だけを fetch_many(keyのリスト) でまとめて取得する．
+    fetch_many はkeyと同じ順番で本文のリストを返す関数．
+    """
+    policy = policy if policy is not None else DetailPolicy()
+    notes, missing = policy.plan(items)
+    return policy.fill(notes, fetch_many(missing) if missing else [])
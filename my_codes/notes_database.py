@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, Boolean, DateTime
+from sqlalchemy import create_engine, Column, Integer, String, Text, Boolean, DateTime, Index
 
 from my_codes.database_setting import Engine
 from my_codes.database_setting import Base
@@ -6,6 +6,12 @@ from my_codes.database_setting import Base
 # Notes クラスの定義
 class Notes(Base):
     __tablename__ = 'notes'
+    # 分析でよく絞り込む列の索引（既存のDBには database_migration.migrate で追加する）
+    __table_args__ = (
+        Index('ix_notes_urlname', 'urlname'),
+        Index('ix_notes_user_id', 'user_id'),
+        Index('ix_notes_created_at', 'created_at'),
+    )
     
     id = Column(Integer)
     user_id = Column(Integer)
@@ -24,6 +30,16 @@ class Notes(Base):
     user_created_at = Column(DateTime)
     tokenized_body = Column(Text)
 
+# 前処理済みの本文とトークンのキャッシュ．元の本文のハッシュで編集されたかどうかを判定する
+class TokenCache(Base):
+    __tablename__ = 'token_cache'
+
+    key = Column(String, primary_key=True, unique=True)
+    body_hash = Column(String)
+    body = Column(Text)
+    tokenized_body = Column(Text)
+
 if __name__ == "__main__":
-    Base.metadata.create_all(Engine, checkfirst=True)
+    from my_codes.database_migration import migrate
+    migrate(Engine)
 
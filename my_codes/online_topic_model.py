@@ -0,0 +1,262 @@
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from collections import Counter
+import hashlib
+import logging
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import LatentDirichletAllocation
+from sqlalchemy import text
+
+from my_codes import corpus_storage
+from my_codes import document_term_matrix
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_CHECKPOINT_PATH = 'data/online_lda/checkpoint.pkl'
+# 学習済みの記事の一覧が大きくなると保存に時間がかかるので，このミニバッチ数ごとに保存する
+DEFAULT_CHECKPOINT_EVERY = 10
+
+
+########
+# Minibatch sources
+########
+def iter_file_batches(filename: str, batch_size: int = DEFAULT_BATCH_SIZE, column: str = 'tokenized_body') -> Iterator[pd.DataFrame]:
+    """
+    Read a Parquet or CSV file with a token-list column (e.g. the output of preprocessing.main) in minibatches.
+    Only the key and token columns are read.
+
+    Parameters:
+    - filename: The path to the Parquet or CSV file.
+    - batch_size: The number of rows per minibatch.
+    - column: The column holding the token lists.
+
+    Yields:
+    - batch: A DataFrame with the columns key (if present) and tokens.
+    """
+    columns = [c for c in ('key', column) if c in corpus_storage.file_columns(filename)]
+    for chunk in corpus_storage.iter_file(filename, columns=columns, batch_size=batch_size):
+        chunk = chunk[chunk[column].notnull()]
+        if chunk.empty:
+            continue
+        batch = pd.DataFrame({'tokens': chunk[column].values})
+        if 'key' in chunk.columns:
+            batch.insert(0, 'key', chunk['key'].values)
+        yield batch
+
+
+def iter_notes_batches(engine, batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[pd.DataFrame]:
+    """
+    Read all tokenized notes stored in the notes table in key order (using the key index).
+    Which of them are new or edited is decided by OnlineTopicModel.new_documents.
+
+    Yields:
+    - batch: A DataFrame with the columns key and tokens.
+    """
+    sql = text(
+        'SELECT key, tokenized_body AS tokens FROM notes '
+        'WHERE key > :after AND tokenized_body IS NOT NULL ORDER BY key LIMIT :limit'
+    )
+    after_key = ''
+    while True:
+        with engine.connect() as conn:
+            batch = pd.read_sql(sql, conn, params={'after': after_key, 'limit': batch_size})
+        if batch.empty:
+            return
+        yield batch
+        after_key = batch['key'].iloc[-1]
+
+
+def content_hash(tokens) -> bytes:
+    """Return a short hash of a document's tokens, used to tell whether a note changed after it was learned."""
+    joined = '\0'.join(document_term_matrix.parse_tokenized_body(tokens))
+    return hashlib.blake2b(joined.encode('utf-8'), digest_size=16).digest()
+
+
+def build_vocabulary(batches: Iterable[pd.DataFrame], min_df: int = 2, max_features: Optional[int] = None) -> Dict[str, int]:
+    """
+    Build a fixed vocabulary in one streaming pass over the minibatches.
+
+    Parameters:
+    - batches: Minibatches with a tokens column.
+    - min_df: Ignore tokens that appear in fewer documents than this.
+    - max_features: Keep only this many tokens with the highest document frequency.
+
+    Returns:
+    - vocabulary: A mapping from tokens to column indices, in sorted token order.
+    """
+    document_frequency = Counter()
+    for batch in batches:
+        for tokens in batch['tokens']:
+            document_frequency.update({token.lower() for token in document_term_matrix.parse_tokenized_body(tokens) if token})
+    terms = [term for term, df in document_frequency.items() if df >= min_df]
+    if max_features is not None and len(terms) > max_features:
+        terms = sorted(terms, key=lambda term: (-document_frequency[term], term))[:max_features]
+    return {term: i for i, term in enumerate(sorted(terms))}
+
+
+########
+# Online LDA with checkpoints
+########
+class OnlineTopicModel:
+    """
+    LDA trained by online variational Bayes on minibatches with a fixed vocabulary.
+    Tokens outside the vocabulary are ignored, so new notes can be added with partial_fit
+    without refitting the model. The whole object is saved as a checkpoint with pickle.
+    The key and content hash of every learned document are kept in learned, so that later updates
+    only learn new or edited documents (documents without a key are identified by their content).
+    """
+
+    def __init__(self, vocabulary: Dict[str, int], n_components: int = 10, batch_size: int = DEFAULT_BATCH_SIZE,
+                 random_state: int = 42, **lda_kwargs):
+        self.vocabulary = dict(vocabulary)
+        self.batch_size = batch_size
+        self.lda = LatentDirichletAllocation(
+            n_components=n_components, learning_method='online', batch_size=batch_size,
+            random_state=random_state, **lda_kwargs,
+        )
+        self.n_documents = 0
+        self.n_updates = 0
+        # 学習した文書のkey -> トークンのハッシュ
+        self.learned: Dict[str, bytes] = {}
+
+    def __setstate__(self, state):
+        # rowidで進み具合を持っていた以前のチェックポイントは，全文書を新しいものとして扱う
+        state.pop('last_rowid', None)
+        state.setdefault('learned', {})
+        self.__dict__.update(state)
+
+    def _matrix(self, token_lists):
+        X, _ = document_term_matrix.build_document_term_matrix(
+            token_lists, vocabulary=self.vocabulary, lowercase=True, grow_vocabulary=False,
+        )
+        return X
+
+    def new_documents(self, batch: pd.DataFrame) -> pd.DataFrame:
+        """
+        Return the rows of a minibatch that have not been learned yet or whose tokens changed since,
+        with a content_hash column (and a key column filled with the hash where there was no key).
+        """
+        hashes = [content_hash(tokens) for tokens in batch['tokens']]
+        keys = batch['key'].tolist() if 'key' in batch.columns else [h.hex() for h in hashes]
+        batch = batch.assign(key=keys, content_hash=hashes)
+        return batch[[self.learned.get(key) != h for key, h in zip(keys, hashes)]]
+
+    def partial_fit(self, token_lists) -> 'OnlineTopicModel':
+        """Update the model with one minibatch of token lists."""
+        X = self._matrix(token_lists)
+        if X.shape[0] == 0:
+            return self
+        self.lda.partial_fit(X)
+        self.n_documents += X.shape[0]
+        self.n_updates += 1
+        return self
+
+    def transform(self, token_lists) -> np.ndarray:
+        """Return the topic distributions of the documents."""
+        return self.lda.transform(self._matrix(token_lists))
+
+    def feature_names(self) -> np.ndarray:
+        return document_term_matrix.feature_names(self.vocabulary)
+
+    def save(self, path: str) -> None:
+        """Save a checkpoint. It is written to a temporary file first so an interrupted save keeps the old one."""
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(f'{path}.tmp', 'wb') as f:
+            pickle.dump(self, f)
+        os.replace(f'{path}.tmp', path)
+
+    @classmethod
+    def load(cls, path: str) -> 'OnlineTopicModel':
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+def _topic_frame(batch: pd.DataFrame, doc_topic: np.ndarray) -> pd.DataFrame:
+    frame = pd.DataFrame(doc_topic, index=batch.index)
+    if 'key' in batch.columns:
+        frame.insert(0, 'key', batch['key'])
+    return frame.reset_index(drop=True)
+
+
+def fit_batches(model: OnlineTopicModel, batches: Iterable[pd.DataFrame], checkpoint_path: Optional[str] = None,
+                transform: bool = True, checkpoint_every: int = DEFAULT_CHECKPOINT_EVERY) -> pd.DataFrame:
+    """
+    Update the model with the new or edited documents of each minibatch (see OnlineTopicModel.new_documents)
+    and return their topic distributions.
+
+    Parameters:
+    - model: The model to update.
+    - batches: Minibatches with a tokens column (and a key column if available).
+    - checkpoint_path: If given, the model is saved every checkpoint_every minibatches and at the end.
+    - transform: Whether to compute the topic distributions of the new documents.
+    - checkpoint_every: The number of learned minibatches between checkpoints.
+
+    Returns:
+    - doc_topic_df: A DataFrame with key and one column per topic for the new documents.
+    """
+    frames = []
+    n_unsaved = 0
+    for batch in batches:
+        batch = model.new_documents(batch)
+        if batch.empty:
+            continue
+        model.partial_fit(batch['tokens'])
+        model.learned.update(zip(batch['key'], batch['content_hash']))
+        n_unsaved += 1
+        if checkpoint_path is not None and n_unsaved >= checkpoint_every:
+            model.save(checkpoint_path)
+            n_unsaved = 0
+        logging.info(f'Updated the topic model with {len(batch)} documents ({model.n_documents} in total).')
+        if transform:
+            frames.append(_topic_frame(batch, model.transform(batch['tokens'])))
+    if checkpoint_path is not None and n_unsaved:
+        model.save(checkpoint_path)
+    if not frames:
+        return pd.DataFrame(columns=['key'] + list(range(model.lda.n_components)))
+    return pd.concat(frames, ignore_index=True)
+
+
+def update_from_notes(engine, checkpoint_path: str = DEFAULT_CHECKPOINT_PATH, n_components: int = 10,
+                      batch_size: int = DEFAULT_BATCH_SIZE, min_df: int = 2, max_features: Optional[int] = None,
+                      vocabulary: Optional[Dict[str, int]] = None, **lda_kwargs) -> Tuple[OnlineTopicModel, pd.DataFrame]:
+    """
+    Train or update the online topic model with the notes in the database that it has not seen yet.
+
+    On the first run the vocabulary is built from the notes currently in the table (unless given) and kept
+    fixed afterwards. Later runs load the checkpoint and only learn notes added or edited since the previous run.
+
+    Returns:
+    - model: The updated model.
+    - doc_topic_df: The topic distributions of the newly added notes.
+    """
+    if os.path.exists(checkpoint_path):
+        model = OnlineTopicModel.load(checkpoint_path)
+        logging.info(f'Loaded the topic model checkpoint ({model.n_documents} documents, {len(model.learned)} notes learned).')
+    else:
+        if vocabulary is None:
+            vocabulary = build_vocabulary(iter_notes_batches(engine, batch_size), min_df=min_df, max_features=max_features)
+        model = OnlineTopicModel(vocabulary, n_components=n_components, batch_size=batch_size, **lda_kwargs)
+    doc_topic_df = fit_batches(model, iter_notes_batches(engine, batch_size), checkpoint_path=checkpoint_path)
+    return model, doc_topic_df
+
+
+def update_from_file(filename: str, checkpoint_path: str = DEFAULT_CHECKPOINT_PATH, n_components: int = 10,
+                    batch_size: int = DEFAULT_BATCH_SIZE, min_df: int = 2, max_features: Optional[int] = None,
+                    vocabulary: Optional[Dict[str, int]] = None, **lda_kwargs) -> Tuple[OnlineTopicModel, pd.DataFrame]:
+    """
+    Update the online topic model with the documents of a Parquet or CSV file (e.g. a newly crawled batch)
+    that it has not learned yet or that changed since. A new model is created (with a vocabulary built from
+    this file unless given) if there is no checkpoint.
+    """
+    if os.path.exists(checkpoint_path):
+        model = OnlineTopicModel.load(checkpoint_path)
+    else:
+        if vocabulary is None:
+            vocabulary = build_vocabulary(iter_file_batches(filename, batch_size), min_df=min_df, max_features=max_features)
+        model = OnlineTopicModel(vocabulary, n_components=n_components, batch_size=batch_size, **lda_kwargs)
+    doc_topic_df = fit_batches(model, iter_file_batches(filename, batch_size), checkpoint_path=checkpoint_path)
+    return model, doc_topic_df
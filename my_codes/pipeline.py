@@ -0,0 +1,316 @@
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import pandas as pd
+
+from my_codes import corpus_storage
+from my_codes import crawl_jobs
+from my_codes import database_operation
+from my_codes import fetch_articles
+from my_codes import jmfd_calculation
+from my_codes import note_details
+from my_codes import preprocessing
+
+########
+# 取得 → クリーニング → トークン化 → DBへのupsert → JMFDスコア を流れ作業で行うパイプライン
+########
+# 各段階は「バッチ（DataFrame）のイテレータを受け取り，バッチを返すジェネレーター」で，
+# run_stages が段階ごとに別のスレッドで動かし，段階の間を大きさに上限のあるキューでつなぐ．
+# 後ろの段階が詰まると前の段階はキューが空くまで待つので，メモリにあるバッチは
+# およそ (段階の数 × キューの大きさ) 個までになり，コーパスの大きさによらない．
+# ジョブ表への進み具合の記録は，バッチがスコアの段階まで届いてから行う（バッチの attrs に載せて運ぶ）．
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_QUEUE_SIZE = 4
+PIPELINE_WORKER = 'pipeline'
+
+# 取得した記事のうち，後の段階に渡す列（fetch_articles.select_columns と同じ）
+OUTPUT_COLUMNS = note_details.NOTE_COLUMNS + list(note_details.USER_COLUMNS.values())
+
+# バッチの attrs で，そのバッチを処理し終えたらジョブ表に記録する進み具合を運ぶ
+PROGRESS_ATTR = 'crawl_progress'
+
+_END = object()
+
+
+class _StageError:
+    """前の段階で起きた例外を，後ろの段階に伝えるための入れ物"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def _put(q, item, stop):
+    """キューが空くまで待って入れる．止めるよう言われたらFalseを返す"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _iter_queue(q, stop):
+    """キューから取り出すイテレータ．前の段階の例外はここで投げ直す"""
+    while not stop.is_set():
+        try:
+            item = q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _END:
+            return
+        if isinstance(item, _StageError):
+            raise item.error
+        yield item
+
+
+def _drive(iterable, out, stop):
+    """段階のジェネレーターを最後まで回し，結果をキューに入れる（スレッドで実行する）"""
+    try:
+        for item in iterable:
+            if not _put(out, item, stop):
+                return
+    except BaseException as e:
+        _put(out, _StageError(e), stop)
+        return
+    finally:
+        # 途中で止めたときも，ジェネレーターの後始末（ジョブの返却など）を行う
+        close = getattr(iterable, 'close', None)
+        if close is not None:
+            close()
+    _put(out, _END, stop)
+
+
+def run_stages(source, *stages, maxsize=DEFAULT_QUEUE_SIZE):
+    """
+    source（バッチのイテラブル）に stages を順に適用したバッチを返すジェネレーター．
+    各段階は別のスレッドで動き，段階の間のキューには maxsize 個までしかバッチを溜めない．
+    どこかの段階で例外が起きると，ここでその例外を投げる．途中でやめると全段階を止める．
+    """
+    stop = threading.Event()
+    threads = []
+    out = queue.Queue(maxsize=maxsize)
+    threads.append(threading.Thread(target=_drive, args=(iter(source), out, stop), daemon=True))
+    for stage in stages:
+        upstream, out = out, queue.Queue(maxsize=maxsize)
+        threads.append(threading.Thread(target=_drive, args=(stage(_iter_queue(upstream, stop)), out, stop), daemon=True))
+    for thread in threads:
+        thread.start()
+    try:
+        yield from _iter_queue(out, stop)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def _carry(batch, source):
+    """sourceのバッチが運んでいた進み具合を，その段階が作ったバッチに引き継ぐ"""
+    batch.attrs[PROGRESS_ATTR] = source.attrs.get(PROGRESS_ATTR, [])
+    return batch
+
+
+def record_progress(jobs, batch):
+    """バッチが運んできた進み具合（ページを書き終えた・ユーザーを取得し終えた）をジョブ表に記録する"""
+    for entry in batch.attrs.get(PROGRESS_ATTR, []):
+        if entry[0] == 'page':
+            jobs.record_page(*entry[1:])
+        else:
+            jobs.complete(entry[1])
+
+
+########
+# 段階
+########
+def fetch_notes(query, maxpage=10000, interval=1, batch_size=DEFAULT_BATCH_SIZE, worker=None,
+                detail_policy=None, **fetcher_kwargs):
+    """
+    ジョブ表（crawl_jobs）の未処理のユーザーを1人ずつ取得し，記事をbatch_size件ずつのDataFrameで返す．
+    取得したページは fetch_articles.UserPostSink にも書く．ジョブ表への進み具合はバッチの attrs に載せ，
+    最後の段階まで届いてから record_progress で記録するので，中断しても後の段階に届かなかったページは次に取得し直す．
+    workerを省略すると crawl_jobs.worker_id(PIPELINE_WORKER) を使う．
+    """
+    worker = worker if worker is not None else crawl_jobs.worker_id(PIPELINE_WORKER)
+    detail_policy = detail_policy if detail_policy is not None else note_details.DetailPolicy()
+    buffer = []
+    progress = []
+    # この実行で取得し終えたページ．失敗して取り直したユーザーは，まだ記録していないページも取得しない
+    fetched = {}
+
+    def flush():
+        batch = pd.DataFrame(buffer).reindex(columns=OUTPUT_COLUMNS)
+        batch.attrs[PROGRESS_ATTR] = list(progress)
+        buffer.clear()
+        progress.clear()
+        return batch
+
+    with crawl_jobs.CrawlJobs(crawl_jobs.crawl_jobs_path(query)) as jobs, \
+            fetch_articles.UserPostSink(query, part=worker) as sink:
+        try:
+            while True:
+                claimed = jobs.claim(worker)
+                if not claimed:
+                    break
+                job = claimed[0]
+                try:
+                    pages = fetch_articles.iter_user_note_pages(
+                        job.username, maxpage=maxpage, interval=interval,
+                        start_page=max(job.next_page, fetched.get(job.username, 0) + 1),
+                        detail_policy=detail_policy, **fetcher_kwargs)
+                    for numpage, contents in pages:
+                        sink.write(contents)
+                        fetched[job.username] = numpage
+                        progress.append(('page', job.username, numpage,
+                                         contents[-1]['key'] if contents else None, len(contents)))
+                        buffer.extend(fetch_articles.flatten_note(content) for content in contents)
+                        if len(buffer) >= batch_size:
+                            yield flush()
+                    progress.append(('complete', job.username))
+                except Exception as e:
+                    print(f"Error fetching data for user {job.username}. Error: {e}")
+                    jobs.fail(job.username, e)
+            if buffer or progress:
+                yield flush()
+        finally:
+            jobs.release(worker)
+
+
+def clean_notes(batches):
+    """
+    本文のない記事・全文を読めない記事を除き，本文をクリーニングする．元の本文のハッシュを body_hash 列に残す．
+    記事が残らなかったバッチも，進み具合を運ぶために空のまま次の段階に渡す．
+    """
+    for source in batches:
+        batch = source[source['body'].notnull() & (source['can_read'] == True)]
+        batch = batch.drop_duplicates(subset='key', keep='last').reset_index(drop=True)
+        texts = batch['body'].tolist()
+        batch = batch.assign(
+            body_hash=[preprocessing.body_hash(text) for text in texts],
+            body=[preprocessing.clean_text(text) for text in texts],
+        )
+        yield _carry(batch, source)
+
+
+def tokenize_notes(batches, n_workers=None, chunksize=100, incremental=True, engine=None,
+                   tagger_option='', stop_words=None, pos_list=preprocessing.TOKENIZE_POS):
+    """
+    クリーニング後の本文をトークン化し，tokenized_body 列を加える．プロセスプールはパイプラインの間ずっと使い回す．
+    incremental=Trueなら，トークンキャッシュに同じ本文（body_hashが一致）がある記事はトークン化しない．
+    """
+    initargs = (tagger_option, stop_words, pos_list)
+    if n_workers == 1:
+        preprocessing._init_worker(*initargs)
+        executor = None
+    else:
+        # スレッドを使うプロセスからforkしないように，ワーカーは新しく起動する
+        executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=preprocessing._init_worker, initargs=initargs)
+    try:
+        for batch in batches:
+            keys = batch['key'].tolist()
+            hashes = batch['body_hash'].tolist()
+            texts = batch['body'].tolist()
+            tokenized = [None] * len(batch)
+
+            misses = list(range(len(batch)))
+            if incremental:
+                cached = preprocessing.load_token_cache(keys, engine)
+                misses = []
+                for i, (key, hash_) in enumerate(zip(keys, hashes)):
+                    entry = cached.get(key)
+                    if entry is not None and entry[0] == hash_:
+                        tokenized[i] = entry[2]
+                    else:
+                        misses.append(i)
+
+            chunks = [[texts[i] for i in misses[j:j + chunksize]] for j in range(0, len(misses), chunksize)]
+            if executor is None:
+                results = [preprocessing._process_chunk(chunk, False) for chunk in chunks]
+            else:
+                results = executor.map(preprocessing._process_chunk, chunks, [False] * len(chunks))
+            new_tokens = [tokens for _, chunk_tokens in results for tokens in chunk_tokens]
+            for i, tokens in zip(misses, new_tokens):
+                tokenized[i] = tokens
+
+            if incremental and misses:
+                preprocessing.save_token_cache(
+                    [(keys[i], hashes[i], texts[i], tokenized[i]) for i in misses], engine)
+            yield _carry(batch.assign(tokenized_body=tokenized), batch)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def upsert_notes(batches, engine=None, chunksize=10000):
+    """バッチを database_operation.bulk_upsert_notes でnotesテーブルに書き込み，そのまま次の段階に渡す"""
+    if engine is None:
+        from my_codes.database_setting import Engine as engine
+    for batch in batches:
+        if not batch.empty:
+            database_operation.bulk_upsert_notes(batch, engine, chunksize=chunksize)
+        yield batch
+
+
+def score_notes(batches, matcher, normalize=None):
+    """バッチのJMFDスコアを計算し，key・urlnameとスコア列のDataFrameを返す"""
+    for batch in batches:
+        if batch.empty:
+            scores = pd.DataFrame(columns=['key', 'urlname'] + list(matcher.foundations))
+        else:
+            scores = jmfd_calculation.score_dataframe(batch, matcher, normalize=normalize)
+        yield _carry(scores, batch)
+
+
+########
+# メイン関数
+########
+def stream(query, dictionary_path, data=None, maxpage=10000, interval=1, batch_size=DEFAULT_BATCH_SIZE,
+           maxsize=DEFAULT_QUEUE_SIZE, n_workers=None, incremental=True, engine=None, normalize=None, **fetcher_kwargs):
+    """
+    取得からJMFDスコアまでのパイプラインを組み，スコアのDataFrameをバッチごとに返すジェネレーター．
+    dataを渡すと，そのurlname列のユーザーをジョブ表に追加してから取得する（ジョブ表にすでにあるユーザーはそのまま）．
+    バッチの進み具合は，受け取った側がそのバッチを処理し終えて次のバッチを求めたときにジョブ表に記録する．
+    """
+    if engine is None:
+        from my_codes.database_setting import Engine as engine
+    if data is not None:
+        with crawl_jobs.CrawlJobs(crawl_jobs.crawl_jobs_path(query)) as jobs:
+            added = jobs.add_users(data['urlname'].tolist())
+            print(f'{added} users added to the crawl jobs: {jobs.progress()}')
+
+    matcher = jmfd_calculation.load_matcher(dictionary_path)
+    with crawl_jobs.CrawlJobs(crawl_jobs.crawl_jobs_path(query)) as jobs:
+        for scores in run_stages(
+            fetch_notes(query, maxpage=maxpage, interval=interval, batch_size=batch_size, **fetcher_kwargs),
+            clean_notes,
+            partial(tokenize_notes, n_workers=n_workers, incremental=incremental, engine=engine),
+            partial(upsert_notes, engine=engine),
+            partial(score_notes, matcher=matcher, normalize=normalize),
+            maxsize=maxsize,
+        ):
+            yield scores
+            record_progress(jobs, scores)
+
+
+def main(query, dictionary_path, data=None, **kwargs):
+    """
+    stream を最後まで流し，スコアを data/{query}/{query}_jmfd_scores に書き足していく．
+    スコアのファイルにはこの実行で処理した記事だけが入る（全記事のスコアは jmfd_calculation.score_notes_table で求める）．
+    処理した記事数と秒数を返す．
+    """
+    start = time.perf_counter()
+    first_batch_seconds = None
+    with corpus_storage.TableWriter(query, 'jmfd_scores') as writer:
+        for scores in stream(query, dictionary_path, data=data, **kwargs):
+            if scores.empty:
+                continue
+            writer.write(scores)
+            if first_batch_seconds is None:
+                first_batch_seconds = time.perf_counter() - start
+            print(f'{writer.rows} notes scored ({time.perf_counter() - start:.1f}s)')
+    return {'rows': writer.rows, 'seconds': time.perf_counter() - start, 'first_batch_seconds': first_batch_seconds}
@@ -2,10 +2,22 @@ import pandas as pd
 from bs4 import BeautifulSoup
 import pickle
 import re
+import time
+import ast
+import hashlib
+import json
 import numpy as np
 import MeCab
+from concurrent.futures import ProcessPoolExecutor
+from html.entities import html5, name2codepoint
+from html.parser import HTMLParser
+from sqlalchemy import inspect
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import sessionmaker
 
-def main(query, data_dict_path='data'):
+from my_codes import corpus_storage
+
+def main(query, data_dict_path='data', n_workers=None, chunksize=1000, incremental=True, engine=None):
     # データを読み込む
     data = read_data(query, data_dict_path)
 
@@ -20,19 +32,18 @@ def main(query, data_dict_path='data'):
     # 重複行を削除
     data = data.drop_duplicates(subset='key')
 
-    # テキストデータをクリーニングする
-    data['body'] = data['body'].apply(clean_text)
-
-    # MeCabのインスタンスを作成
-    mecab = MeCab.Tagger()
-    
-    # データフレームの各テキストをトークン化
-    data['tokenized_body'] = data['body'].apply(lambda x: tokenize(x, mecab))
+    # テキストデータをクリーニングし，各テキストをトークン化する（n_workers個のプロセスで並列に処理）
+    if incremental:
+        # トークン化済みの記事はキャッシュから読み，新しい記事と編集された記事だけを処理する
+        data['body'], data['tokenized_body'] = clean_and_tokenize_incremental(
+            data['key'], data['body'], engine=engine, n_workers=n_workers, chunksize=chunksize)
+    else:
+        data['body'], data['tokenized_body'] = clean_and_tokenize(data['body'], n_workers=n_workers, chunksize=chunksize)
 
     data = data.reset_index(drop = True)
 
-    # トークン化したデータを保存
-    data.to_csv(f'{data_dict_path}/{query}/{query}_data_preprocessed.csv')
+    # トークン化したデータを保存（tokenized_bodyはリストのまま保存される）
+    corpus_storage.write_table(data, query, 'preprocessed', data_dict_path=data_dict_path)
 
     return data
 
@@ -45,8 +56,7 @@ def main(query, data_dict_path='data'):
 
 def read_data(query, data_dict_path='data'):
     '''データを読み込む，queryは検索語，data_dict_pathはデータが保存されているディレクトリのパス'''
-    data_path = f'{data_dict_path}/{query}/{query}_user_all_post_df.csv'
-    data = pd.read_csv(data_path,index_col=0)
+    data = corpus_storage.read_table(query, 'user_posts', data_dict_path=data_dict_path)
     return data
 
 def remove_nan(data):
@@ -57,6 +67,80 @@ def remove_nan(data):
     data = data[data['can_read'] == True].reset_index(drop=True)
     return data
 
+########
+# HTMLタグの除去
+########
+# 本文として扱わない要素（BeautifulSoupのget_textも除外する）
+_SKIP_TAGS = frozenset(['script', 'style', 'template', 'rt', 'rp'])
+
+# clean_textで使う正規表現はあらかじめコンパイルしておく
+_HTTP_PATTERN = re.compile(r'http\S+')
+_WWW_PATTERN = re.compile(r'www\S+')
+# エスケープ文字・HTMLエンティティ・連続する空白をまとめて1つのスペースにする
+_SPACE_PATTERN = re.compile(r'(?:&[\w#]+;|\s)+')
+
+class _TextExtractor(HTMLParser):
+    '''タグを読み飛ばしてテキストだけを集めるパーサー．
+    文字参照の扱いは BeautifulSoup(text, "html.parser").get_text() に合わせている'''
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.parts = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP_TAGS:
+            self.skip_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+
+    def handle_entityref(self, name):
+        # 知らない実体参照は "&name" のまま残す（BeautifulSoupと同じ）
+        character = html5.get(name + ';')
+        if character is None and name in name2codepoint:
+            character = chr(name2codepoint[name])
+        self.handle_data(character if character is not None else '&' + name)
+
+    def handle_charref(self, name):
+        try:
+            codepoint = int(name[1:], 16) if name[:1] in ('x', 'X') else int(name)
+        except ValueError:
+            codepoint = None
+        character = None
+        if codepoint is not None and codepoint < 256:
+            # 0〜255はwindows-1252として解釈する（BeautifulSoupと同じ）
+            try:
+                character = bytes([codepoint]).decode('windows-1252')
+            except UnicodeDecodeError:
+                pass
+        if not character and codepoint is not None:
+            try:
+                character = chr(codepoint)
+            except (ValueError, OverflowError):
+                pass
+        self.handle_data(character or '\N{REPLACEMENT CHARACTER}')
+
+    def unknown_decl(self, data):
+        # CDATAの中身は本文として残す
+        if data.upper().startswith('CDATA['):
+            self.handle_data(data[len('CDATA['):])
+
+def strip_tags(text):
+    '''HTMLタグを取り除いたテキストを返す'''
+    # タグも文字参照もなければ解析する必要はない
+    if '<' not in text and '&' not in text:
+        return text
+    parser = _TextExtractor()
+    parser.feed(text)
+    parser.close()
+    return ''.join(parser.parts)
+
 def clean_text(text):
     '''テキストをクリーニングする関数'''
     # もしtextがNaN（浮動小数点数）なら、空の文字列に置き換える
@@ -65,6 +149,24 @@ def clean_text(text):
     else:
         # もし既に文字列でない場合は、文字列に変換する
         text = str(text)
+
+    # HTMLタグを削除する
+    text = strip_tags(text)
+    # 正規表現を使ってURLを削除する
+    text = _HTTP_PATTERN.sub('', text)
+    text = _WWW_PATTERN.sub('', text)  # wwwで始まるURLを削除する
+    # エスケープ文字・HTMLエンティティ・余分なスペースを1つのスペースにまとめる
+    text = _SPACE_PATTERN.sub(' ', text).strip()
+    return text
+
+def clean_text_bs4(text):
+    '''BeautifulSoupを使っていた以前のclean_text．compare_clean_textで結果を照合するために残している'''
+    # もしtextがNaN（浮動小数点数）なら、空の文字列に置き換える
+    if pd.isna(text):
+        text = ''
+    else:
+        # もし既に文字列でない場合は、文字列に変換する
+        text = str(text)
     
     # BeautifulSoupを使ってHTMLタグを削除する
     text = BeautifulSoup(text, "html.parser").get_text()
@@ -78,16 +180,209 @@ def clean_text(text):
     text = re.sub(r'\s+', ' ', text).strip()
     return text
 
-def tokenize(text, mecab, stop_words= None):
+def compare_clean_text(texts):
+    '''clean_text と clean_text_bs4 の結果と処理時間を比べる．
+    一致しなかったテキストの (位置, clean_text_bs4の結果, clean_text の結果) のリストと，それぞれの秒数を返す'''
+    texts = list(texts)
+    start = time.perf_counter()
+    expected = [clean_text_bs4(text) for text in texts]
+    bs4_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = [clean_text(text) for text in texts]
+    fast_seconds = time.perf_counter() - start
+
+    mismatches = [(i, e, a) for i, (e, a) in enumerate(zip(expected, actual)) if e != a]
+    return {'mismatches': mismatches, 'bs4_seconds': bs4_seconds, 'fast_seconds': fast_seconds}
+
+TOKENIZE_POS = ("名詞", "動詞", "形容詞",'副詞','形容動詞')
+
+def tokenize(text, mecab, stop_words= None, pos_list=TOKENIZE_POS):
     '''テキストを形態素解析して、名詞、動詞、形容詞、副詞、形容動詞の単語のリストを返す関数, 
-    textはテキストデータ，mecabはMeCabのインスタンス，stop_wordsは除外する単語のリスト'''
+    textはテキストデータ，mecabはMeCabのインスタンス，stop_wordsは除外する単語のリスト，pos_listは残す品詞'''
     mecab.parse('')  
     node = mecab.parseToNode(text)
     words = []
     while node:
-        pos = node.feature.split(",")[0]
-        if pos in ["名詞", "動詞", "形容詞",'副詞','形容動詞']:
-            if (len(node.surface) > 1 or (len(node.surface) == 1 and node.feature.split(",")[1] in ["一般", "固有名詞"])) and (stop_words is None or node.surface not in stop_words):
-                words.append(node.surface)
+        # 品詞と品詞細分類1だけが必要なので，素性は一度だけ先頭から分割する
+        feature = node.feature.split(",", 2)
+        if feature[0] in pos_list:
+            surface = node.surface
+            if (len(surface) > 1 or (len(surface) == 1 and feature[1] in ["一般", "固有名詞"])) and (stop_words is None or surface not in stop_words):
+                words.append(surface)
         node = node.next
-    return words if words else ['']
\ No newline at end of file
+    return words if words else ['']
+
+
+########
+# プロセスプールによる並列トークン化
+########
+# ワーカープロセスごとに1つだけ作るTaggerと設定
+_worker_mecab = None
+_worker_options = None
+
+def _init_worker(tagger_option, stop_words, pos_list):
+    '''ワーカーの起動時に一度だけTaggerを作る'''
+    global _worker_mecab, _worker_options
+    _worker_mecab = MeCab.Tagger(tagger_option)
+    _worker_options = (stop_words, pos_list)
+
+def _process_chunk(texts, clean):
+    '''ワーカーで1チャンク分のテキストをクリーニング（clean=Trueのとき）・トークン化する'''
+    stop_words, pos_list = _worker_options
+    if clean:
+        texts = [clean_text(text) for text in texts]
+    tokens = [tokenize(text, _worker_mecab, stop_words=stop_words, pos_list=pos_list) for text in texts]
+    return texts, tokens
+
+def _run_chunks(texts, clean, n_workers, chunksize, tagger_option, stop_words, pos_list):
+    '''テキストをchunksize件ずつに分けて処理し，(テキスト, トークン) を入力と同じ順番で返す'''
+    texts = list(texts)
+    chunks = [texts[i:i + chunksize] for i in range(0, len(texts), chunksize)]
+    initargs = (tagger_option, stop_words, pos_list)
+
+    if n_workers == 1 or len(chunks) <= 1:
+        # 並列化する意味がないときは，このプロセスで処理する
+        _init_worker(*initargs)
+        results = [_process_chunk(chunk, clean) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=initargs) as executor:
+            # mapは入力の順番で結果を返す
+            results = list(executor.map(_process_chunk, chunks, [clean] * len(chunks)))
+
+    processed_texts, tokenized = [], []
+    for chunk_texts, chunk_tokens in results:
+        processed_texts.extend(chunk_texts)
+        tokenized.extend(chunk_tokens)
+    return processed_texts, tokenized
+
+def tokenize_parallel(texts, n_workers=None, chunksize=1000, tagger_option='', stop_words=None, pos_list=TOKENIZE_POS):
+    '''テキストの列を複数プロセスでトークン化し，入力と同じ順番のトークンのリストを返す．
+    結果は tokenize(text, MeCab.Tagger(tagger_option), stop_words, pos_list) と同じ．n_workers=Noneでコア数'''
+    _, tokenized = _run_chunks(texts, False, n_workers, chunksize, tagger_option, stop_words, pos_list)
+    return tokenized
+
+def clean_and_tokenize(texts, n_workers=None, chunksize=1000, tagger_option='', stop_words=None, pos_list=TOKENIZE_POS):
+    '''clean_text と tokenize をまとめて複数プロセスで行い，(クリーニング後のテキスト, トークン) のリストを返す'''
+    return _run_chunks(texts, True, n_workers, chunksize, tagger_option, stop_words, pos_list)
+
+########
+# 記事のkeyごとのトークンキャッシュを使った差分処理
+########
+# SQLiteの1文で使えるパラメータ数の上限より小さくする
+_SQL_CHUNK = 500
+
+def body_hash(text):
+    '''クリーニング前の本文のハッシュ．本文が編集されたかどうかの判定に使う'''
+    return hashlib.sha1(('' if pd.isna(text) else str(text)).encode('utf-8')).hexdigest()
+
+def _get_engine(engine):
+    if engine is None:
+        from my_codes.database_setting import Engine as engine
+    from my_codes.notes_database import TokenCache
+    TokenCache.__table__.create(engine, checkfirst=True)
+    return engine
+
+def load_token_cache(keys, engine=None):
+    '''キャッシュから key -> (本文のハッシュ, クリーニング後の本文, トークンのリスト) の辞書を読み込む'''
+    from my_codes.notes_database import TokenCache
+    engine = _get_engine(engine)
+    keys = list(keys)
+    cached = {}
+    session = sessionmaker(bind=engine)()
+    try:
+        for i in range(0, len(keys), _SQL_CHUNK):
+            rows = session.query(TokenCache.key, TokenCache.body_hash, TokenCache.body, TokenCache.tokenized_body)\
+                          .filter(TokenCache.key.in_(keys[i:i + _SQL_CHUNK])).all()
+            for key, hash_, body, tokenized_body in rows:
+                cached[key] = (hash_, body, json.loads(tokenized_body))
+    finally:
+        session.close()
+    return cached
+
+def load_notes_tokens(keys, engine=None):
+    '''notesテーブルにすでにある key -> (クリーニング後の本文, トークンのリスト) の辞書を読み込む'''
+    from my_codes.notes_database import Notes
+    engine = _get_engine(engine)
+    keys = list(keys)
+    stored = {}
+    # notesテーブルがまだないDB（前処理だけを使う場合など）では何も読まない
+    if not keys or not inspect(engine).has_table('notes'):
+        return stored
+    session = sessionmaker(bind=engine)()
+    try:
+        for i in range(0, len(keys), _SQL_CHUNK):
+            rows = session.query(Notes.key, Notes.body, Notes.tokenized_body)\
+                          .filter(Notes.key.in_(keys[i:i + _SQL_CHUNK]), Notes.tokenized_body.isnot(None)).all()
+            for key, body, tokenized_body in rows:
+                # notesテーブルのトークンはCSVを経由してリストの文字列表現で保存されている
+                stored[key] = (body, ast.literal_eval(tokenized_body))
+    finally:
+        session.close()
+    return stored
+
+def save_token_cache(records, engine=None):
+    '''(key, 本文のハッシュ, クリーニング後の本文, トークンのリスト) のリストをキャッシュに書き込む'''
+    from my_codes.notes_database import TokenCache
+    engine = _get_engine(engine)
+    rows = [
+        {'key': key, 'body_hash': hash_, 'body': body, 'tokenized_body': json.dumps(tokens, ensure_ascii=False)}
+        for key, hash_, body, tokens in records
+    ]
+    with engine.begin() as conn:
+        for i in range(0, len(rows), _SQL_CHUNK):
+            stmt = sqlite_insert(TokenCache).values(rows[i:i + _SQL_CHUNK])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['key'],
+                set_={c: stmt.excluded[c] for c in ('body_hash', 'body', 'tokenized_body')},
+            )
+            conn.execute(stmt)
+
+def clean_and_tokenize_incremental(keys, texts, engine=None, n_workers=None, chunksize=1000):
+    '''
+    clean_and_tokenize と同じ結果を返すが，トークンキャッシュに同じ本文（ハッシュが一致）があればそれを使う．
+    キャッシュになくても，notesテーブルにクリーニング後の本文が一致する記事があればそのトークンを使う．
+    新しく処理した記事とnotesテーブルから取り込んだ記事はキャッシュに書き戻す．
+    '''
+    keys = list(keys)
+    texts = list(texts)
+    hashes = [body_hash(text) for text in texts]
+    cleaned = [None] * len(texts)
+    tokenized = [None] * len(texts)
+
+    # 1. 本文のハッシュが一致するキャッシュを使う
+    cached = load_token_cache(keys, engine)
+    misses = []
+    for i, (key, hash_) in enumerate(zip(keys, hashes)):
+        entry = cached.get(key)
+        if entry is not None and entry[0] == hash_:
+            cleaned[i], tokenized[i] = entry[1], entry[2]
+        else:
+            misses.append(i)
+    n_cached = len(texts) - len(misses)
+
+    # 2. notesテーブルにすでにトークン化された記事があれば，クリーニング後の本文が同じときだけ使う
+    new_records = []
+    stored = load_notes_tokens([keys[i] for i in misses], engine)
+    remaining = []
+    for i in misses:
+        entry = stored.get(keys[i])
+        if entry is not None:
+            body = clean_text(texts[i])
+            if body == entry[0]:
+                cleaned[i], tokenized[i] = body, entry[1]
+                new_records.append((keys[i], hashes[i], body, entry[1]))
+                continue
+        remaining.append(i)
+    n_stored = len(misses) - len(remaining)
+
+    # 3. 残った新しい記事・編集された記事だけをクリーニングしてトークン化する
+    if remaining:
+        bodies, tokens = clean_and_tokenize([texts[i] for i in remaining], n_workers=n_workers, chunksize=chunksize)
+        for i, body, token in zip(remaining, bodies, tokens):
+            cleaned[i], tokenized[i] = body, token
+            new_records.append((keys[i], hashes[i], body, token))
+
+    save_token_cache(new_records, engine)
+    print(f'token cache: {n_cached} cached, {n_stored} from notes table, {len(remaining)} tokenized')
+    return cleaned, tokenized
@@ -0,0 +1,224 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+#######
+# note.com のレスポンスをディスクに保存するキャッシュ
+#######
+DEFAULT_CACHE_PATH = 'data/cache/http_cache.db'
+
+# 記事本文はほとんど変わらないので長め，ユーザーの記事一覧は新しい投稿で変わるので短めにする
+NOTE_TTL = 30 * 24 * 60 * 60
+CONTENTS_TTL = 24 * 60 * 60
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# 何回書き込むごとにサイズを確認して追い出すか
+EVICT_EVERY = 500
+
+# 最後に使った時刻（追い出す順番に使う）は，この秒数より古くなったときだけ書き直す．ヒットのたびに書き込まないため
+ACCESS_GRANULARITY = 60 * 60
+
+
+def note_cache_key(key):
+    """/api/v3/notes/{key} のキャッシュキー"""
+    return f'note:{key}'
+
+def contents_cache_key(username, page):
+    """/api/v2/creators/{username}/contents のページごとのキャッシュキー"""
+    return f'contents:{username}:{page}'
+
+
+class CacheEntry:
+    """キャッシュに保存されている1件分の情報"""
+
+    def __init__(self, cache_key, content, etag, last_modified, fetched_at, ttl):
+        self.cache_key = cache_key
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+        self.ttl = ttl
+
+    def is_fresh(self, now=None):
+        return (now or time.time()) < self.fetched_at + self.ttl
+
+
+class ResponseCache:
+    """
+    SQLiteを使ったレスポンスキャッシュ．本文はSHA-256で内容アドレス化して圧縮保存し，
+    同じ本文は1つだけ持つ．TTLを過ぎたものは条件付きリクエストの検証子としてだけ使い，
+    合計サイズが max_bytes を超えたら最後に使われたのが古いものから追い出す．
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES, keep_stale=NOTE_TTL):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.keep_stale = keep_stale
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.revalidated = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                content BLOB NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS entries (
+                cache_key TEXT PRIMARY KEY,
+                hash TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                ttl REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_entries_accessed_at ON entries (accessed_at);
+            CREATE INDEX IF NOT EXISTS ix_entries_hash ON entries (hash);
+        ''')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        """ロックを取ってトランザクションを張る．失敗したらロールバックする"""
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def lookup(self, cache_key):
+        """TTLに関係なくエントリを返す．なければNone"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT e.etag, e.last_modified, e.fetched_at, e.ttl, e.accessed_at, b.content '
+                'FROM entries e JOIN blobs b ON e.hash = b.hash WHERE e.cache_key = ?',
+                (cache_key,),
+            ).fetchone()
+            if row is None:
+                return None
+            etag, last_modified, fetched_at, ttl, accessed_at, content = row
+            now = time.time()
+            if accessed_at is None or now - accessed_at >= ACCESS_GRANULARITY:
+                self._conn.execute('UPDATE entries SET accessed_at = ? WHERE cache_key = ?', (now, cache_key))
+        return CacheEntry(cache_key, zlib.decompress(content), etag, last_modified, fetched_at, ttl)
+
+    def get(self, cache_key):
+        """
+        (本文, エントリ) を返す．TTL内ならヒットとして本文を返し，
+        TTLを過ぎていれば本文はNoneで，再検証に使うエントリだけを返す．
+        """
+        entry = self.lookup(cache_key)
+        # 複数のスレッドから呼ばれるので，回数もロックを取って数える
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            elif entry.is_fresh():
+                self.hits += 1
+            else:
+                self.stale += 1
+        if entry is None:
+            return None, None
+        return (entry.content if entry.is_fresh() else None), entry
+
+    def put(self, cache_key, content, ttl, etag=None, last_modified=None):
+        """本文を保存する"""
+        digest = hashlib.sha256(content).hexdigest()
+        compressed = zlib.compress(content)
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO blobs (hash, content, size) VALUES (?, ?, ?)',
+                (digest, compressed, len(compressed)),
+            )
+            conn.execute(
+                'INSERT OR REPLACE INTO entries (cache_key, hash, etag, last_modified, fetched_at, accessed_at, ttl) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (cache_key, digest, etag, last_modified, now, now, ttl),
+            )
+            self._puts += 1
+            evict = self._puts % EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def touch(self, cache_key, ttl=None):
+        """304で変更がないと確認できたエントリの取得時刻を更新する"""
+        now = time.time()
+        with self._lock:
+            if ttl is None:
+                self._conn.execute('UPDATE entries SET fetched_at = ?, accessed_at = ? WHERE cache_key = ?', (now, now, cache_key))
+            else:
+                self._conn.execute('UPDATE entries SET fetched_at = ?, accessed_at = ?, ttl = ? WHERE cache_key = ?', (now, now, ttl, cache_key))
+            self.revalidated += 1
+
+    def total_bytes(self):
+        with self._lock:
+            return self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+
+    def evict(self):
+        """期限切れから keep_stale 秒以上たったものを消し，max_bytes に収まるまで古いものから追い出す"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM entries WHERE fetched_at + ttl + ? < ?', (self.keep_stale, now))
+            conn.execute('DELETE FROM blobs WHERE hash NOT IN (SELECT hash FROM entries)')
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+            if total > self.max_bytes:
+                # 最後に使われた時刻が古い順に，上限の9割まで減らす
+                target = self.max_bytes * 0.9
+                # 本文は複数のエントリで共有されるので，最後のエントリを消したときだけその大きさが減る
+                references = dict(conn.execute('SELECT hash, COUNT(*) FROM entries GROUP BY hash').fetchall())
+                rows = conn.execute(
+                    'SELECT e.cache_key, e.hash, b.size FROM entries e JOIN blobs b ON e.hash = b.hash '
+                    'ORDER BY e.accessed_at'
+                ).fetchall()
+                victims = []
+                for cache_key, digest, size in rows:
+                    if total <= target:
+                        break
+                    victims.append((cache_key,))
+                    references[digest] -= 1
+                    if references[digest] == 0:
+                        total -= size
+                conn.executemany('DELETE FROM entries WHERE cache_key = ?', victims)
+                conn.execute('DELETE FROM blobs WHERE hash NOT IN (SELECT hash FROM entries)')
+
+    def clear(self):
+        """すべてのエントリと本文を消す"""
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM entries')
+            conn.execute('DELETE FROM blobs')
+
+    def stats(self):
+        """ヒット・ミスの回数と，保存している件数・サイズを返す"""
+        with self._lock:
+            entries = self._conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+            total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+            hits, misses, stale, revalidated = self.hits, self.misses, self.stale, self.revalidated
+        requests = hits + misses + stale
+        return {
+            'hits': hits,
+            'misses': misses,
+            'stale': stale,
+            'revalidated': revalidated,
+            'hit_rate': hits / requests if requests else 0.0,
+            'entries': entries,
+            'bytes': total,
+        }
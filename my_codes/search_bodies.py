@@ -1,45 +1,83 @@
 # データを読み込む
+import numpy as np
 import pandas as pd
 import logging
 
+from my_codes import corpus_storage
+
 # ロギングの基本設定。デフォルトではWARNING以上のログが出力される
 logging.basicConfig(level=logging.INFO)
 # ファイルを読み込む
 
 
-def main(query,n_topics,n_moral_clusters,n_samples=50):
-    data = pd.read_pickle(f'data/{query}/{query}_data_preprocessed.pickle')
-    extract_bodies_on_topics(data=data,n_topics=n_topics,n_samples=n_samples)
-    extract_bodies_on_moral_cluster(data=data,n_moral_clusters=n_moral_clusters,n_samples=n_samples)
+def main(query,n_topics,n_moral_clusters,n_samples=50,random_state=None):
+    data = load_preprocessed_data(query)
+    key_index = build_key_index(data)
+    extract_bodies_on_topics(query,data=data,n_topics=n_topics,n_samples=n_samples,key_index=key_index)
+    extract_bodies_on_moral_cluster(query,data=data,n_moral_clusters=n_moral_clusters,n_samples=n_samples,random_state=random_state)
+
+def load_preprocessed_data(query):
+    '''前処理したデータから，書き出しに使う列だけを読み込む'''
+    return corpus_storage.read_table(query, 'preprocessed', columns=['urlname','key','body'])
+
+def build_key_index(data):
+    '''文書のkeyからdataの行番号を引く索引を作る（同じkeyが複数あれば最初の行）'''
+    keys = data['key']
+    first = ~keys.duplicated()
+    return pd.Series(np.flatnonzero(first.values), index=keys[first].values)
+
+def top_documents_per_topic(topic_df,topic_columns,n_samples=50):
+    '''
+    全トピックの上位n_samples件の文書を一度に選ぶ．
+    トピックの列名 -> (topic_dfの行番号, スコア)（スコアの降順）の辞書を返す
+    '''
+    scores = topic_df[topic_columns].to_numpy(dtype=float)
+    n = min(n_samples, len(scores))
+    if n < len(scores):
+        rows = np.argpartition(-scores, n - 1, axis=0)[:n]
+    else:
+        rows = np.broadcast_to(np.arange(len(scores))[:, None], scores.shape)
+    top = np.take_along_axis(scores, rows, axis=0)
+    order = np.argsort(-top, axis=0, kind='stable')
+    rows = np.take_along_axis(rows, order, axis=0)
+    top = np.take_along_axis(top, order, axis=0)
+    return {column: (rows[:, j], top[:, j]) for j, column in enumerate(topic_columns)}
 
-def extract_bodies_on_topics(query==None,data,n_topics,n_samples=50):
-    if query == True:
-        data = pd.read_pickle(f'data/{query}/{query}_data_preprocessed.pickle')
+def extract_bodies_on_topics(query,data=None,n_topics=5,n_samples=50,key_index=None):
+    '''各トピックでスコアが高い文書の本文を，トピックごとのCSVにスコアの降順で書き出す'''
+    if data is None:
+        data = load_preprocessed_data(query)
+    if key_index is None:
+        key_index = build_key_index(data)
     #トピックのデータを読み込む
     keys = pd.read_csv(f'data/{query}/{query}_TopicAnalysis_{n_topics}topics_df.csv',index_col=0)
+    topic_columns = [f'Topic_{str(i)}' for i in range(n_topics)]
+    top = top_documents_per_topic(keys,topic_columns,n_samples=n_samples)
     #文書のキーから文書を取り出す
-    for i in range(n_topics):
-        dat = keys.sort_values(by=f'Topic_{str(i)}',ascending=False).iloc[:n_samples]
-        body = data[data.key.isin(dat['key'])][['urlname','key','body']]
-        body[f'Topic_{str(i)}'] = dat[f'Topic_{str(i)}']
+    for i, column in enumerate(topic_columns):
+        rows, scores = top[column]
+        positions = key_index.reindex(keys['key'].values[rows]).to_numpy()
+        found = ~np.isnan(positions)
+        body = data.iloc[positions[found].astype(np.int64)][['urlname','key','body']].copy()
+        body[column] = scores[found]
         body.to_csv(f'data/{query}/{query}_bodys_{n_topics}Topics_Topic{str(i)}.csv')
         logging.info(f'topic{i} has completed')
-    
-def extract_bodies_on_moral_cluster(query==None,data,n_moral_clusters,n_samples=50):
-    if query == True:
-        data = pd.read_pickle(f'data/{query}/{query}_data_preprocessed.pickle')
-    else:
-        data = data
+
+def extract_bodies_on_moral_cluster(query,data=None,n_moral_clusters=5,n_samples=50,random_state=None):
+    '''各モラルクラスターに属するユーザーの記事から，n_samples件（少なければ全件）を無作為に選んで書き出す'''
+    if data is None:
+        data = load_preprocessed_data(query)
     #特定のモラルクラスターに属する記事を読み込む
     keys = pd.read_csv(f'data/{query}/{query}_data_MoralClusterIntegrated_{n_moral_clusters}clusters.csv')
-    doc_keys_dic = dict()
-    #特定のモラルクラスターに属するユーザーのurlnameの辞書を作成する
-    for mc in range(n_moral_clusters):
-        mc_name = f'mc{str(mc)}'
-        doc_keys_dic[mc_name] = keys[keys.moral_cluster == mc][['urlname','moral_cluster']]
-    #mc_urlnameの辞書を参照し，bodyを抽出する
+    #urlnameからモラルクラスターを引き，記事ごとのクラスターを一度に求める
+    cluster_of_user = keys.drop_duplicates('urlname').set_index('urlname')['moral_cluster']
+    clusters = data['urlname'].map(cluster_of_user)
+    groups = data.groupby(clusters.values).indices
+    rng = np.random.RandomState(random_state)
     for mc in range(n_moral_clusters):
-        mc_name = f'mc{mc}'
-        body = data[data.urlname.isin(doc_keys_dic[mc_name].urlname)][['urlname','key','body']].sample(n_samples)
+        rows = groups.get(mc, np.array([], dtype=np.int64))
+        if len(rows) > n_samples:
+            rows = rng.choice(rows, n_samples, replace=False)
+        body = data.iloc[rows][['urlname','key','body']]
         body.to_csv(f'data/{query}/{query}_bodys_{str(n_moral_clusters)}MC_mc{str(mc)}.csv')
-        logging.info(f'topic{mc} has completed')
\ No newline at end of file
+        logging.info(f'moral cluster{mc} has completed')
@@ -0,0 +1,166 @@
+from array import array
+
+import numpy as np
+from scipy import sparse
+
+from my_codes.document_term_matrix import (
+    decode_terms, encode_terms, load_npz_arrays, parse_tokenized_body, save_npz_arrays,
+)
+
+########
+# トークンの整数ID化
+########
+# トークンのリスト（strのリスト）は1トークンあたり50バイト以上を使うので，
+# 語彙表でトークンを整数IDにし，全文書のIDを1つのint32の配列に，文書の区切りを別の配列に持つ．
+# 空文字のトークンは document_term_matrix.build_document_term_matrix と同じく数えない（IDも振らない）．
+
+class TokenVocabulary:
+    '''トークン -> ID の表．IDは登録した順に0から振る'''
+
+    def __init__(self, tokens=()):
+        self._ids = {}
+        self._tokens = []
+        for token in tokens:
+            if token:
+                self.add(token)
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def __contains__(self, token):
+        return token in self._ids
+
+    def add(self, token):
+        '''トークンのIDを返す．まだなければ登録する'''
+        token_id = self._ids.get(token)
+        if token_id is None:
+            token_id = self._ids[token] = len(self._tokens)
+            self._tokens.append(token)
+        return token_id
+
+    def get(self, token, default=-1):
+        return self._ids.get(token, default)
+
+    def token(self, token_id):
+        return self._tokens[token_id]
+
+    @property
+    def tokens(self):
+        '''IDの順に並べたトークンのリスト'''
+        return self._tokens
+
+    def as_dict(self):
+        '''トークン -> ID の辞書（document_term_matrix や CountVectorizer の語彙として使える）'''
+        return dict(self._ids)
+
+    def encode(self, tokens, grow=True):
+        '''トークンのリストをint32の配列にする．空文字のトークンと，grow=Falseなら語彙にないトークンは落とす'''
+        ids = array('i')
+        if grow:
+            for token in tokens:
+                if token:
+                    ids.append(self.add(token))
+        else:
+            get = self._ids.get
+            for token in tokens:
+                token_id = get(token) if token else None
+                if token_id is not None:
+                    ids.append(token_id)
+        return np.frombuffer(ids, dtype=np.int32) if len(ids) else np.zeros(0, dtype=np.int32)
+
+    def decode(self, ids):
+        '''IDの配列をトークンのリストに戻す'''
+        tokens = self._tokens
+        return [tokens[i] for i in ids]
+
+
+class InternedCorpus:
+    '''
+    全文書のトークンIDを1つのint32の配列（ids）にまとめ，i番目の文書を ids[offsets[i]:offsets[i+1]] で表す．
+    語彙（TokenVocabulary）は複数のコーパスで共有できる．
+    '''
+
+    def __init__(self, vocabulary, ids, offsets):
+        self.vocabulary = vocabulary
+        self.ids = ids
+        self.offsets = offsets
+
+    @classmethod
+    def from_token_lists(cls, token_lists, vocabulary=None, grow=True):
+        '''
+        トークンのリストの列（tokenized_body列．文字列化されたリストでもよい）から作る．
+        vocabularyを渡すとそのIDを使い，grow=Falseなら語彙にないトークンは落とす．空文字のトークンは落とす．
+        '''
+        vocabulary = vocabulary if vocabulary is not None else TokenVocabulary()
+        ids = array('i')
+        offsets = array('q', [0])
+        add = vocabulary.add
+        get = vocabulary._ids.get
+        for tokens in token_lists:
+            for token in parse_tokenized_body(tokens):
+                if not token:
+                    continue
+                if grow:
+                    ids.append(add(token))
+                else:
+                    token_id = get(token)
+                    if token_id is not None:
+                        ids.append(token_id)
+            offsets.append(len(ids))
+        return cls(
+            vocabulary,
+            np.frombuffer(ids, dtype=np.int32) if len(ids) else np.zeros(0, dtype=np.int32),
+            np.frombuffer(offsets, dtype=np.int64),
+        )
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        '''i番目の文書のID（コピーしないスライス）'''
+        return self.ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def nbytes(self):
+        '''IDと区切りの配列が使うバイト数（語彙は含まない）'''
+        return self.ids.nbytes + self.offsets.nbytes
+
+    def document_lengths(self):
+        return np.diff(self.offsets)
+
+    def to_token_lists(self):
+        '''今までの形式（文書ごとのトークンのリスト）に戻す'''
+        tokens = np.asarray(self.vocabulary.tokens, dtype=object)
+        return [tokens[self[i]].tolist() for i in range(len(self))]
+
+    def document_term_matrix(self, n_terms=None):
+        '''文書×語彙（列はトークンID）の出現回数のCSR行列を作る．n_termsを省略すると語彙の大きさ'''
+        n_terms = len(self.vocabulary) if n_terms is None else n_terms
+        # sum_duplicates はindicesを書き換えるので，idsはコピーして渡す
+        index_dtype = np.int32 if len(self.ids) < np.iinfo(np.int32).max else np.int64
+        X = sparse.csr_matrix(
+            (np.ones(len(self.ids), dtype=np.int32), self.ids.astype(index_dtype),
+             self.offsets.astype(index_dtype)),
+            shape=(len(self), n_terms),
+        )
+        # 同じ文書内の重複トークンを出現回数にまとめる
+        X.sum_duplicates()
+        return X
+
+    def save(self, path):
+        '''IDと区切りと語彙を非圧縮の.npzに保存する（load でメモリマップで読める）'''
+        vocabulary_bytes, vocabulary_offsets = encode_terms(self.vocabulary.tokens)
+        save_npz_arrays(
+            path, ids=self.ids, offsets=self.offsets,
+            vocabulary_bytes=vocabulary_bytes, vocabulary_offsets=vocabulary_offsets,
+        )
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        arrays = load_npz_arrays(path, mmap=mmap)
+        vocabulary = TokenVocabulary(decode_terms(arrays['vocabulary_bytes'], arrays['vocabulary_offsets']))
+        return cls(vocabulary, arrays['ids'], arrays['offsets'])
@@ -1,23 +1,35 @@
 from typing import Tuple, List, Union, Optional, Dict
+import hashlib
+import json
+import os
+import weakref
+import numpy as np
 import pandas as pd
 import pickle
 import matplotlib.pyplot as plt
 import logging
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.decomposition import LatentDirichletAllocation
-import MeCab
+from scipy import sparse
+
+from my_codes import corpus_storage
+from my_codes import document_term_matrix
+from my_codes import online_topic_model
+from my_codes import preprocessing
+from my_codes import topic_sweep
 
 logging.basicConfig(level=logging.INFO)
 
-def main(filename: str, n_components: int = 5, random_state: int = 42, stop_words: Optional[List[str]] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+def main(filename: str, n_components: int = 5, random_state: int = 42, stop_words: Optional[List[str]] = None, dtm_path: Optional[str] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
     Perform topic analysis on the input data and identify the dominant topics.
 
     Parameters:
-    - filename: The path to the pickle file containing the data.
+    - filename: The path to the Parquet or CSV file containing the data.
     - n_components: The number of topics for the LDA model.
     - random_state: The random state for the LDA model.
     - stop_words: A list of stop words to be excluded during tokenization.
+    - dtm_path: The path of a .npz file caching the document-term matrix (see load_and_preprocess_data).
 
     Returns:
     - df: A pandas DataFrame containing the data with an additional column for the dominant topic.
@@ -25,7 +37,7 @@ def main(filename: str, n_components: int = 5, random_state: int = 42, stop_word
     """
     try:
         # データの読み込みと前処理
-        df, X, vectorizer = load_and_preprocess_data(filename, stop_words)
+        df, X, vectorizer = load_and_preprocess_data(filename, stop_words, dtm_path=dtm_path)
 
         # LDAモデルの構築
         lda = LatentDirichletAllocation(n_components=n_components, random_state=random_state)
@@ -47,38 +59,153 @@ def main(filename: str, n_components: int = 5, random_state: int = 42, stop_word
 
 
 
-def load_and_preprocess_data(filename: str, stop_words: Optional[List[str]] = None) -> Tuple[pd.DataFrame, CountVectorizer]:
+def main_online(filename: Optional[str] = None, n_components: int = 5, random_state: int = 42, batch_size: int = 1000, checkpoint_path: str = online_topic_model.DEFAULT_CHECKPOINT_PATH, engine=None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Perform topic analysis with online LDA, reading the documents in minibatches instead of loading them all.
+    The model is checkpointed, so later calls only learn from the documents added or edited since the previous call.
+
+    Parameters:
+    - filename: The path to a Parquet or CSV file with a tokenized_body column. If None, the notes table of the database is used.
+    - n_components: The number of topics (only used when there is no checkpoint yet).
+    - random_state: The random state for the LDA model.
+    - batch_size: The number of documents per minibatch.
+    - checkpoint_path: The path of the model checkpoint.
+    - engine: The SQLAlchemy engine of the notes database (defaults to database_setting.Engine).
+
+    Returns:
+    - df: A pandas DataFrame containing the key and topic distribution of each newly learned document.
+    - topic_importance_df: A pandas DataFrame containing the topic importances.
+    """
+    try:
+        if filename is None:
+            if engine is None:
+                from my_codes.database_setting import Engine as engine
+            model, df = online_topic_model.update_from_notes(
+                engine, checkpoint_path=checkpoint_path, n_components=n_components,
+                batch_size=batch_size, random_state=random_state,
+            )
+        else:
+            model, df = online_topic_model.update_from_file(
+                filename, checkpoint_path=checkpoint_path, n_components=n_components,
+                batch_size=batch_size, random_state=random_state,
+            )
+        topic_importance_df = extract_topic_importance(lda=model.lda, vectorizer=vectorizer_from_vocabulary(model.vocabulary))
+        return df, topic_importance_df
+
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        return None, None
+
+
+
+# トピック分析で残す品詞
+TOPIC_POS = ("名詞", "動詞", "形容詞")
+
+def load_and_preprocess_data(filename: str, stop_words: Optional[List[str]] = None, n_workers: Optional[int] = None, chunksize: int = 1000, dtm_path: Optional[str] = None) -> Tuple[pd.DataFrame, sparse.csr_matrix, CountVectorizer]:
     """
     Load and preprocess the data.
 
     Parameters:
-    - filename: The path to the pickle file containing the data.
+    - filename: The path to the Parquet or CSV file containing the data.
     - stop_words: A list of stop words to be excluded during tokenization.
+    - n_workers: The number of tokenizer processes (None uses all cores).
+    - chunksize: The number of texts sent to a tokenizer process at a time.
+    - dtm_path: The path of a .npz file caching the document-term matrix. If it exists and its signature
+      (see dtm_signature) matches the data and settings, the matrix is memory-mapped from it instead of
+      re-tokenizing; otherwise it is built and saved there together with the signature.
 
     Returns:
     - df: A pandas DataFrame containing the preprocessed data.
-    - vectorizer: A CountVectorizer object fitted to the data.
+    - X: The document-term matrix (scipy CSR matrix).
+    - vectorizer: A CountVectorizer object holding the vocabulary of X.
     """
-    # データの読み込み
-    df = pd.read_csv(filename)
+    # データの読み込み（全本文が公開されていない行は読み込まない）
+    df = corpus_storage.read_file(filename, filters=[('can_read', '==', True)])
 
     # 本文がNoneとなっている行を削除
     df = df[df['body'].notnull()].reset_index(drop=True)
-    # 全本文が公開されていない行を削除
-    df = df[df['can_read'] == True].reset_index(drop=True)
 
-    # 形態素分析の準備
-    mecab = MeCab.Tagger("-Ochasen")
+    # 保存済みの文書-単語行列が同じデータ・同じ設定から作ったものなら，トークン化せずに使う
+    signature = dtm_signature(df, stop_words) if dtm_path is not None else None
+    if dtm_path is not None and os.path.exists(dtm_path):
+        if read_dtm_signature(dtm_path) == signature:
+            X, vocabulary = document_term_matrix.load_document_term_matrix(dtm_path)
+            logging.info(f'Loaded document-term matrix from {dtm_path}.')
+            return df, X, vectorizer_from_vocabulary(vocabulary)
+        logging.info(f'{dtm_path} does not match the data. Rebuilding the document-term matrix...')
+
+    # データフレームの各テキストをトークン化（preprocessingと同じ並列処理を使う）
+    df['tokenized_body'] = preprocessing.tokenize_parallel(
+        df['body'], n_workers=n_workers, chunksize=chunksize,
+        tagger_option="-Ochasen", stop_words=stop_words, pos_list=TOPIC_POS,
+    )
+
+    # トークンのリストから直接文書-単語行列を作成（CountVectorizerと同じく小文字にし，語彙を辞書順に並べる）
+    X, vocabulary = document_term_matrix.build_document_term_matrix(
+        df['tokenized_body'], lowercase=True, sort_vocabulary=True,
+    )
+    if dtm_path is not None:
+        document_term_matrix.save_document_term_matrix(dtm_path, X, vocabulary)
+        write_dtm_signature(dtm_path, signature)
+
+    return df, X, vectorizer_from_vocabulary(vocabulary)
+
+def dtm_signature(df: pd.DataFrame, stop_words: Optional[List[str]] = None) -> Dict[str, object]:
+    """
+    Describe what a cached document-term matrix was built from.
 
-    # データフレームの各テキストをトークン化
-    # データフレームの各テキストをトークン化
-    df['tokenized_body'] = df['body'].apply(lambda x: tokenize(x, mecab, stop_words=stop_words))
-    
-    # CountVectorizerを使って文書-単語行列を作成
-    vectorizer = CountVectorizer(tokenizer=lambda x: x.split())
-    X = vectorizer.fit_transform(df['tokenized_body'].apply(' '.join))
-    
-    return df, X, vectorizer
+    Parameters:
+    - df: The loaded data (the key and body columns are hashed, so edited or reordered notes change the signature).
+    - stop_words: The stop words used during tokenization.
+
+    Returns:
+    - signature: A JSON-serializable dictionary of the data hash and the tokenization and vectorizer settings.
+    """
+    digest = hashlib.sha256()
+    keys = df['key'] if 'key' in df.columns else pd.Series([''] * len(df))
+    for key, body in zip(keys, df['body']):
+        digest.update(f'{key}\0{body}\0'.encode('utf-8'))
+    return {
+        'data': digest.hexdigest(),
+        'n_documents': len(df),
+        'stop_words': sorted(set(stop_words or [])),
+        'tagger_option': '-Ochasen',
+        'pos_list': list(TOPIC_POS),
+        'lowercase': True,
+        'sort_vocabulary': True,
+    }
+
+def _signature_path(dtm_path: str) -> str:
+    return f'{dtm_path}.signature.json'
+
+def read_dtm_signature(dtm_path: str) -> Optional[Dict[str, object]]:
+    """Return the signature saved next to dtm_path, or None if there is none."""
+    try:
+        with open(_signature_path(dtm_path), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_dtm_signature(dtm_path: str, signature: Dict[str, object]) -> None:
+    """Save the signature next to dtm_path."""
+    with open(_signature_path(dtm_path), 'w', encoding='utf-8') as f:
+        json.dump(signature, f, ensure_ascii=False)
+
+def _lowercase_tokens(tokens):
+    return [token.lower() for token in document_term_matrix.parse_tokenized_body(tokens) if token]
+
+def vectorizer_from_vocabulary(vocabulary: Dict[str, int]) -> CountVectorizer:
+    """
+    Create a CountVectorizer that uses a fixed vocabulary and takes token lists as input.
+
+    Parameters:
+    - vocabulary: A mapping from tokens to column indices of the document-term matrix.
+
+    Returns:
+    - vectorizer: A fitted CountVectorizer (get_feature_names_out and transform work as usual).
+    """
+    # 語彙を指定しているので，空のデータでfitしても語彙はそのまま使われる
+    return CountVectorizer(vocabulary=vocabulary, analyzer=_lowercase_tokens).fit([])
 
 def tokenize(text: str, mecab, stop_words: Optional[List[str]] = None) -> List[str]:
     """
@@ -92,68 +219,135 @@ def tokenize(text: str, mecab, stop_words: Optional[List[str]] = None) -> List[s
     Returns:
     - words: A list of tokens extracted from the input text.
     """
-    mecab.parse('')  
-    node = mecab.parseToNode(text)
-    words = []
-    while node:
-        pos = node.feature.split(",")[0]
-        if pos in ["名詞", "動詞", "形容詞"]:
-            if (len(node.surface) > 1 or (len(node.surface) == 1 and node.feature.split(",")[1] in ["一般", "固有名詞"])) and (stop_words is None or node.surface not in stop_words):
-                words.append(node.surface)
-        node = node.next
-    return words if words else ['']
+    return preprocessing.tokenize(text, mecab, stop_words=stop_words, pos_list=TOPIC_POS)
 
-def extract_topic_importance(lda, vectorizer) -> pd.DataFrame:
+# vectorizerごとに get_feature_names_out の結果を使い回す
+_feature_names_cache = weakref.WeakKeyDictionary()
+
+def get_feature_names(vectorizer) -> np.ndarray:
+    """
+    Return vectorizer.get_feature_names_out(), computed once per vectorizer and vocabulary.
+
+    Parameters:
+    - vectorizer: A fitted CountVectorizer.
+
+    Returns:
+    - feature_names: An array of the tokens in column order.
+    """
+    cached = _feature_names_cache.get(vectorizer)
+    if cached is None or cached[0] is not vectorizer.vocabulary_:
+        cached = (vectorizer.vocabulary_, vectorizer.get_feature_names_out())
+        _feature_names_cache[vectorizer] = cached
+    return cached[1]
+
+def top_terms(components: np.ndarray, feature_names: np.ndarray, n_top: int = 10, normalize: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the top-N terms of every topic at once.
+
+    Parameters:
+    - components: The topic-word weights (e.g. lda.components_), shape (n_topics, n_features).
+    - feature_names: The tokens of the columns.
+    - n_top: The number of terms per topic.
+    - normalize: If True, return weights normalized to the topic-word distribution (each row sums to 1).
+
+    Returns:
+    - terms: An array of shape (n_topics, n_top) with the terms in descending order of weight.
+    - weights: An array of shape (n_topics, n_top) with their weights.
+    """
+    components = np.asarray(components)
+    n_top = min(n_top, components.shape[1])
+    if normalize:
+        components = components / components.sum(axis=1, keepdims=True)
+    rows = np.arange(components.shape[0])[:, None]
+    # 全トピックの上位n_top個をまとめて選び，その中だけを降順に並べる
+    if n_top < components.shape[1]:
+        candidates = np.argpartition(components, -n_top, axis=1)[:, -n_top:]
+    else:
+        candidates = np.broadcast_to(np.arange(components.shape[1]), components.shape)
+    order = np.argsort(-components[rows, candidates], axis=1, kind='stable')
+    indices = candidates[rows, order]
+    return np.asarray(feature_names)[indices], components[rows, indices]
+
+def extract_topic_importance(lda, vectorizer, n_top: int = 10, normalize: bool = False) -> pd.DataFrame:
     """
     Extract the importance of different topics.
 
     Parameters:
     - lda: The LDA model.
     - vectorizer: The CountVectorizer object.
+    - n_top: The number of terms per topic.
+    - normalize: If True, report the topic-word probabilities instead of the raw weights.
 
     Returns:
     - topic_importance_df: A pandas DataFrame containing the topic importances.
     """
+    terms, weights = top_terms(lda.components_, get_feature_names(vectorizer), n_top=n_top, normalize=normalize)
     topic_importance = dict()
-    for idx, topic in enumerate(lda.components_):
-        topic_importance[f'Topic{idx}:'] = [(vectorizer.get_feature_names_out()[i], topic[i]) for i in topic.argsort()[:-10 - 1:-1]]
+    for idx in range(len(terms)):
+        topic_importance[f'Topic{idx}:'] = list(zip(terms[idx], weights[idx]))
     
     topic_importance_df = pd.DataFrame(topic_importance)
     return topic_importance_df
 
-def find_optimal_number_of_topics(filename: str, min_topics: int = 2, max_topics: int = 10, stop_words: Optional[List[str]] = None, save_fig: Optional[bool] = None) -> Tuple[int, List[float]]:
+def default_sweep_dir(filename: str) -> str:
+    """
+    Return the default sweep directory of a data file, so that different corpora do not share cached results.
+
+    Parameters:
+    - filename: The path to the Parquet or CSV file containing the data.
+
+    Returns:
+    - sweep_dir: topic_sweep.DEFAULT_SWEEP_DIR/{file name}_{hash of the absolute path}.
     """
-    Find the optimal number of topics for LDA using perplexity.
+    name = os.path.splitext(os.path.basename(filename))[0]
+    digest = hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()[:8]
+    return os.path.join(topic_sweep.DEFAULT_SWEEP_DIR, f'{name}_{digest}')
+
+def find_optimal_number_of_topics(filename: str, min_topics: int = 2, max_topics: int = 10, stop_words: Optional[List[str]] = None, save_fig: Optional[bool] = None, dtm_path: Optional[str] = None, sweep_dir: Optional[str] = None, test_size: float = 0.1, n_workers: Optional[int] = None, patience: Optional[int] = None) -> Tuple[int, List[float]]:
+    """
+    Find the optimal number of topics for LDA using perplexity on held-out documents.
+    The candidate numbers of topics are fitted in parallel (see topic_sweep.sweep_topics), and the models
+    and perplexities stored in sweep_dir are reused by later calls.
 
     Parameters:
-    - filename: The path to the pickle file containing the data.
+    - filename: The path to the Parquet or CSV file containing the data.
     - min_topics: The minimum number of topics to consider.
     - max_topics: The maximum number of topics to consider.
     - stop_words: A list of stop words to be excluded during tokenization.
+    - save_fig: Whether to save the perplexity plot.
+    - dtm_path: The path of a .npz file caching the document-term matrix (see load_and_preprocess_data).
+      Defaults to dtm.npz in sweep_dir.
+    - sweep_dir: The directory where the models and perplexities of each number of topics are stored.
+      Defaults to a directory for this file under topic_sweep.DEFAULT_SWEEP_DIR (see default_sweep_dir).
+    - test_size: The fraction of documents held out for computing perplexity.
+    - n_workers: The number of processes fitting models in parallel (None uses all cores).
+    - patience: Stop when the perplexity has not improved for this many consecutive numbers of topics.
 
     Returns:
     - optimal_topics: The optimal number of topics.
-    - perplexities: A list of perplexities for different numbers of topics.
+    - perplexities: A list of perplexities for the numbers of topics that were evaluated.
     """
     try:
         logging.info('Starting to find the optimal number of topics...')
     
-        # データの読み込みと前処理
-        df, X, vectorizer = load_and_preprocess_data(filename, stop_words)
+        # データの読み込みと前処理（文書-単語行列は各プロセスがファイルからメモリマップで読む）
+        if sweep_dir is None:
+            sweep_dir = default_sweep_dir(filename)
+        if dtm_path is None:
+            dtm_path = os.path.join(sweep_dir, 'dtm.npz')
+        load_and_preprocess_data(filename, stop_words, dtm_path=dtm_path)
 
         logging.info('Data loaded successfully.')
 
-        perplexities = []
-        topic_range = range(min_topics, max_topics+1)
-        
-        for n_topics in topic_range:
-            logging.info(f'Training LDA model with {n_topics} topics...')
-            lda = LatentDirichletAllocation(n_components=n_topics, random_state=42)
-            lda.fit(X)
-            perplexities.append(lda.perplexity(X))
+        results = topic_sweep.sweep_topics(
+            dtm_path, range(min_topics, max_topics+1), sweep_dir=sweep_dir,
+            test_size=test_size, random_state=42, n_workers=n_workers, patience=patience,
+        )
+        topic_range = list(results)
+        perplexities = [results[k]['perplexity'] for k in topic_range]
 
         # Find the optimal number of topics
-        optimal_topics = topic_range[perplexities.index(min(perplexities))]
+        optimal_topics = topic_sweep.best_number_of_topics(results)
 
         logging.info(f'The optimal number of topics is: {optimal_topics}')
 
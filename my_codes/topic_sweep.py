@@ -0,0 +1,212 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import hashlib
+import json
+import logging
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.decomposition import LatentDirichletAllocation
+
+from my_codes import document_term_matrix
+
+# 学習したモデルと評価結果の保存先
+DEFAULT_SWEEP_DIR = 'data/lda_sweep'
+METRICS_FILENAME = 'metrics.json'
+# 学習用と評価用に分けた行列（sweep_topics が一度だけ書き，各プロセスはメモリマップで開く）
+TRAIN_FILENAME = 'train.npz'
+HELDOUT_FILENAME = 'heldout.npz'
+
+
+def split_rows(n_rows: int, test_size: float = 0.1, random_state: int = 42) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Split the row indices of the document-term matrix into training and held-out rows.
+
+    Parameters:
+    - n_rows: The number of documents.
+    - test_size: The fraction of documents held out for evaluation (0 evaluates on the training rows).
+    - random_state: The seed of the split.
+
+    Returns:
+    - train_rows: The sorted indices of the training documents.
+    - test_rows: The sorted indices of the held-out documents.
+    """
+    rows = np.random.RandomState(random_state).permutation(n_rows)
+    n_test = int(round(n_rows * test_size))
+    if test_size > 0 and n_rows > 1:
+        n_test = min(max(n_test, 1), n_rows - 1)
+    else:
+        n_test = 0
+    return np.sort(rows[n_test:]), np.sort(rows[:n_test])
+
+
+def model_path(sweep_dir: str, n_topics: int) -> str:
+    return os.path.join(sweep_dir, f'lda_{n_topics}topics.pkl')
+
+
+def load_model(sweep_dir: str, n_topics: int) -> LatentDirichletAllocation:
+    """Load the LDA model stored by sweep_topics for n_topics."""
+    with open(model_path(sweep_dir, n_topics), 'rb') as f:
+        return pickle.load(f)
+
+
+def _write_splits(dtm_path: str, sweep_dir: str, test_size: float, random_state: int) -> Tuple[str, Optional[str]]:
+    """
+    Write the training and held-out rows of the matrix to their own .npz files under sweep_dir.
+
+    Returns:
+    - train_path: The path of the training matrix.
+    - heldout_path: The path of the held-out matrix (None when no documents are held out).
+    """
+    X, vocabulary = document_term_matrix.load_document_term_matrix(dtm_path)
+    train_rows, test_rows = split_rows(X.shape[0], test_size, random_state)
+    train_path = os.path.join(sweep_dir, TRAIN_FILENAME)
+    document_term_matrix.save_document_term_matrix(train_path, X[train_rows], vocabulary)
+    if not len(test_rows):
+        return train_path, None
+    heldout_path = os.path.join(sweep_dir, HELDOUT_FILENAME)
+    document_term_matrix.save_document_term_matrix(heldout_path, X[test_rows], vocabulary)
+    return train_path, heldout_path
+
+
+def _fit_one(train_path: str, heldout_path: Optional[str], n_topics: int, random_state: int,
+             lda_kwargs: Dict[str, Any], sweep_dir: str) -> Dict[str, Any]:
+    """Fit one LDA model in a worker process. The split matrices are memory-mapped, not pickled or copied."""
+    X_train, _ = document_term_matrix.load_document_term_matrix(train_path)
+    X_test = document_term_matrix.load_document_term_matrix(heldout_path)[0] if heldout_path else X_train
+
+    start = time.perf_counter()
+    lda = LatentDirichletAllocation(n_components=n_topics, random_state=random_state, n_jobs=1, **lda_kwargs)
+    lda.fit(X_train)
+    seconds = time.perf_counter() - start
+    perplexity = lda.perplexity(X_test)
+
+    # 書き込み途中のファイルを読まないように，一時ファイルに書いてから置き換える
+    path = model_path(sweep_dir, n_topics)
+    with open(f'{path}.tmp', 'wb') as f:
+        pickle.dump(lda, f)
+    os.replace(f'{path}.tmp', path)
+
+    return {
+        'n_topics': n_topics,
+        'perplexity': float(perplexity),
+        'n_iter': int(lda.n_iter_),
+        'fit_seconds': seconds,
+    }
+
+
+def _signature(dtm_path: str, test_size: float, random_state: int, lda_kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """Data and settings that must match for stored results to be reused."""
+    X, _ = document_term_matrix.load_document_term_matrix(dtm_path)
+    # 形と非ゼロ数が同じでも中身が違う行列があるので，中身のハッシュも比べる（メモリマップのまま読む）
+    content = hashlib.blake2b(digest_size=16)
+    for array in (X.indptr, X.indices, X.data):
+        content.update(memoryview(np.ascontiguousarray(array)).cast('B'))
+    return {
+        'shape': list(X.shape),
+        'nnz': int(X.nnz),
+        'content': content.hexdigest(),
+        'test_size': test_size,
+        'random_state': random_state,
+        'lda_kwargs': {key: lda_kwargs[key] for key in sorted(lda_kwargs)},
+    }
+
+
+def _load_metrics(sweep_dir: str, signature: Dict[str, Any]) -> Dict[int, Dict[str, Any]]:
+    path = os.path.join(sweep_dir, METRICS_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        stored = json.load(f)
+    if stored.get('signature') != signature:
+        logging.info('Stored sweep results were made with different data or settings. Starting over.')
+        return {}
+    return {
+        int(k): metrics for k, metrics in stored.get('results', {}).items()
+        if os.path.exists(model_path(sweep_dir, int(k)))
+    }
+
+
+def _save_metrics(sweep_dir: str, signature: Dict[str, Any], results: Dict[int, Dict[str, Any]]) -> None:
+    path = os.path.join(sweep_dir, METRICS_FILENAME)
+    with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'signature': signature, 'results': {str(k): results[k] for k in sorted(results)}}, f, indent=2)
+    os.replace(f'{path}.tmp', path)
+
+
+def _should_stop(results: Dict[int, Dict[str, Any]], topic_range: List[int], patience: Optional[int]) -> bool:
+    """True if the held-out perplexity has not improved for `patience` consecutive k after the best one."""
+    if patience is None:
+        return False
+    done = []
+    for k in topic_range:
+        if k not in results:
+            break
+        done.append(k)
+    if not done:
+        return False
+    best = min(done, key=lambda k: results[k]['perplexity'])
+    return len(done) - 1 - done.index(best) >= patience
+
+
+def sweep_topics(dtm_path: str, topic_range: Iterable[int], sweep_dir: str = DEFAULT_SWEEP_DIR,
+                 test_size: float = 0.1, random_state: int = 42, n_workers: Optional[int] = None,
+                 patience: Optional[int] = None, **lda_kwargs) -> Dict[int, Dict[str, Any]]:
+    """
+    Fit LDA models for several numbers of topics in parallel and score them on held-out documents.
+
+    The document-term matrix saved at dtm_path (see document_term_matrix.save_document_term_matrix) is
+    split once into training and held-out matrices under sweep_dir, which every worker memory-maps. Each model is stored under sweep_dir together with its metrics, and
+    numbers of topics that were already fitted with the same data and settings are not fitted again.
+
+    Parameters:
+    - dtm_path: The path of the .npz document-term matrix.
+    - topic_range: The numbers of topics to try.
+    - sweep_dir: The directory where models and metrics are stored.
+    - test_size: The fraction of documents held out for computing perplexity.
+    - random_state: The seed of the split and of the LDA models.
+    - n_workers: The number of processes (None uses all cores).
+    - patience: Stop when the perplexity has not improved for this many consecutive numbers of topics
+      (None tries all of them). The numbers of topics are fitted in waves of n_workers in ascending order.
+    - lda_kwargs: Other arguments for LatentDirichletAllocation (e.g. max_iter, learning_method).
+
+    Returns:
+    - results: A dict from the number of topics to its metrics (perplexity, n_iter, fit_seconds).
+    """
+    topic_range = sorted(set(topic_range))
+    if not os.path.exists(sweep_dir):
+        os.makedirs(sweep_dir)
+    signature = _signature(dtm_path, test_size, random_state, lda_kwargs)
+    results = _load_metrics(sweep_dir, signature)
+    if results:
+        logging.info(f'Reusing stored results for {sorted(results)} topics.')
+
+    n_workers = n_workers or os.cpu_count() or 1
+    if any(k not in results for k in topic_range):
+        train_path, heldout_path = _write_splits(dtm_path, sweep_dir, test_size, random_state)
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        # 早期終了しない場合はすべてを一度に投入し，する場合は n_workers 個ずつ小さいkから進める
+        wave_size = len(topic_range) if patience is None else n_workers
+        todo = [k for k in topic_range if k not in results]
+        while todo and not _should_stop(results, topic_range, patience):
+            wave, todo = todo[:wave_size], todo[wave_size:]
+            logging.info(f'Training LDA models with {wave} topics...')
+            futures = [
+                executor.submit(_fit_one, train_path, heldout_path, k, random_state, lda_kwargs, sweep_dir)
+                for k in wave
+            ]
+            for future in futures:
+                metrics = future.result()
+                results[metrics['n_topics']] = metrics
+                _save_metrics(sweep_dir, signature, results)
+                logging.info(f"{metrics['n_topics']} topics: perplexity {metrics['perplexity']:.2f} "
+                             f"({metrics['fit_seconds']:.1f} s)")
+
+    return {k: results[k] for k in topic_range if k in results}
+
+
+def best_number_of_topics(results: Dict[int, Dict[str, Any]]) -> int:
+    """Return the number of topics with the lowest held-out perplexity."""
+    return min(results, key=lambda k: results[k]['perplexity'])